@@ -0,0 +1,331 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An append-only archive of wavelet snapshots and event bundles.
+
+The file starts with the magic 'WVAR' and a format version byte, followed
+by records:
+
+  length of the rest of the record: 4 bytes
+  kind: 1 byte, SNAPSHOT or EVENTS
+  timestamp in milliseconds: 8 bytes
+  length of the wave id, length of the wavelet id: 2 bytes each
+  wave id, wavelet id: utf-8
+  payload: the rest of the record
+
+All numbers are big endian. The reader maps the file into memory and only
+reads the record headers to build its index, payloads are handed out as
+buffers on the mapping without copying them.
+"""
+
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+
+import simplejson
+
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None
+
+MAGIC = 'WVAR'
+FORMAT_VERSION = 1
+
+# Kinds of records.
+SNAPSHOT = 1
+EVENTS = 2
+
+_FILE_HEADER = '>4sB'
+_FILE_HEADER_SIZE = struct.calcsize(_FILE_HEADER)
+_RECORD_HEADER = '>IBqHH'
+_RECORD_HEADER_SIZE = struct.calcsize(_RECORD_HEADER)
+# the length field does not count itself
+_LENGTH_SIZE = struct.calcsize('>I')
+
+
+def _now_millis():
+  return int(time.time() * 1000)
+
+
+class Record(object):
+  """The header of a record in the archive.
+
+  Attributes:
+    offset: position of the record in the archive file.
+    kind: SNAPSHOT or EVENTS.
+    timestamp: time of the record in milliseconds since the epoch.
+    wave_id: the id of the wave the record is about.
+    wavelet_id: the id of the wavelet the record is about.
+  """
+
+  __slots__ = ('offset', 'kind', 'timestamp', 'wave_id', 'wavelet_id',
+               '_payload_start', '_payload_end')
+
+  def __init__(self, offset, kind, timestamp, wave_id, wavelet_id,
+               payload_start, payload_end):
+    self.offset = offset
+    self.kind = kind
+    self.timestamp = timestamp
+    self.wave_id = wave_id
+    self.wavelet_id = wavelet_id
+    self._payload_start = payload_start
+    self._payload_end = payload_end
+
+  def __len__(self):
+    """Returns the length of the payload."""
+    return self._payload_end - self._payload_start
+
+
+class ArchiveWriter(object):
+  """Appends records to an archive file, creating it if needed."""
+
+  def __init__(self, path):
+    self._file = open(path, 'ab')
+    if not os.path.getsize(path):
+      self._file.write(struct.pack(_FILE_HEADER, MAGIC, FORMAT_VERSION))
+      self._file.flush()
+
+  def append(self, kind, wave_id, wavelet_id, payload, timestamp=None):
+    """Appends a record and returns its offset in the file.
+
+    Args:
+      kind: SNAPSHOT or EVENTS.
+      wave_id: the id of the wave the record is about.
+      wavelet_id: the id of the wavelet the record is about.
+      payload: the data of the record, a string.
+      timestamp: milliseconds since the epoch, defaults to now.
+    """
+    if timestamp is None:
+      timestamp = _now_millis()
+    if isinstance(payload, unicode):
+      payload = payload.encode('utf-8')
+    wave_id = wave_id.encode('utf-8')
+    wavelet_id = wavelet_id.encode('utf-8')
+    length = (_RECORD_HEADER_SIZE - _LENGTH_SIZE + len(wave_id) +
+              len(wavelet_id) + len(payload))
+    self._file.seek(0, 2)
+    offset = self._file.tell()
+    # written in one go so readers never see a record header without data
+    self._file.write(''.join([
+        struct.pack(_RECORD_HEADER, length, kind, timestamp, len(wave_id),
+                    len(wavelet_id)),
+        wave_id, wavelet_id, payload]))
+    self._file.flush()
+    return offset
+
+  def append_wavelet(self, wavelet, timestamp=None, compress=True):
+    """Appends a snapshot of a wavelet, see Wavelet.to_bytes."""
+    return self.append(SNAPSHOT, wavelet.wave_id, wavelet.wavelet_id,
+                       wavelet.to_bytes(compress), timestamp)
+
+  def append_events(self, json, wave_id, wavelet_id, timestamp=None):
+    """Appends an event bundle as the json text it came in."""
+    return self.append(EVENTS, wave_id, wavelet_id, json, timestamp)
+
+  def close(self):
+    self._file.close()
+
+
+class ArchiveReader(object):
+  """Gives random access to the records of an archive file.
+
+  The records are indexed by wave id, wavelet id and timestamp when the
+  archive is opened. Records appended after that are not seen.
+  """
+
+  def __init__(self, path):
+    self._path = path
+    self._file = open(path, 'rb')
+    size = os.path.getsize(path)
+    if size < _FILE_HEADER_SIZE:
+      raise ValueError('Not a wave archive: %s' % path)
+    self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+    magic, version = struct.unpack(_FILE_HEADER,
+                                   self._map[:_FILE_HEADER_SIZE])
+    if magic != MAGIC:
+      raise ValueError('Not a wave archive: %s' % path)
+    if version != FORMAT_VERSION:
+      raise ValueError('Unsupported archive version %d' % version)
+    self._records = []
+    self._by_offset = {}
+    self._by_wave = {}
+    self._by_wavelet = {}
+    self._read_index()
+
+  def _read_index(self):
+    size = len(self._map)
+    offset = _FILE_HEADER_SIZE
+    while offset + _RECORD_HEADER_SIZE <= size:
+      record = self._record_at(offset)
+      if record is None:
+        logging.warning('Ignoring incomplete record at %d in %s' %
+                        (offset, self._path))
+        break
+      self._records.append(record)
+      self._by_offset[offset] = record
+      self._by_wave.setdefault(record.wave_id, []).append(record)
+      self._by_wavelet.setdefault((record.wave_id, record.wavelet_id),
+                                  []).append(record)
+      offset = record._payload_end
+    self._by_time = [(record.timestamp, index)
+                     for index, record in enumerate(self._records)]
+    self._by_time.sort()
+
+  def _record_at(self, offset):
+    """Decodes the record header at offset, None if it is cut off."""
+    length, kind, timestamp, wave_id_length, wavelet_id_length = (
+        struct.unpack(_RECORD_HEADER,
+                      self._map[offset:offset + _RECORD_HEADER_SIZE]))
+    ids_start = offset + _RECORD_HEADER_SIZE
+    payload_start = ids_start + wave_id_length + wavelet_id_length
+    end = offset + _LENGTH_SIZE + length
+    if end > len(self._map) or payload_start > end:
+      return None
+    wave_id = self._map[ids_start:ids_start + wave_id_length].decode('utf-8')
+    wavelet_id = self._map[ids_start + wave_id_length:
+                           payload_start].decode('utf-8')
+    return Record(offset, kind, timestamp, wave_id, wavelet_id,
+                  payload_start, end)
+
+  def __len__(self):
+    return len(self._records)
+
+  def __iter__(self):
+    """Iterates over the records in the order they were appended."""
+    return iter(self._records)
+
+  def record_at(self, offset):
+    """Returns the record at offset in the file."""
+    return self._by_offset[offset]
+
+  def find(self, wave_id=None, wavelet_id=None, start=None, end=None,
+           kind=None):
+    """Returns the matching records in the order they were appended.
+
+    Args:
+      wave_id: only records of this wave.
+      wavelet_id: only records of this wavelet, requires wave_id.
+      start: only records with a timestamp from start on.
+      end: only records with a timestamp before end.
+      kind: only records of this kind.
+    """
+    if wavelet_id is not None:
+      records = self._by_wavelet.get((wave_id, wavelet_id), [])
+    elif wave_id is not None:
+      records = self._by_wave.get(wave_id, [])
+    elif start is not None or end is not None:
+      low = 0
+      high = len(self._by_time)
+      if start is not None:
+        low = bisect.bisect_left(self._by_time, (start, -1))
+      if end is not None:
+        high = bisect.bisect_left(self._by_time, (end, -1))
+      records = [self._records[index]
+                 for timestamp, index in self._by_time[low:high]]
+      records.sort(key=lambda record: record.offset)
+    else:
+      records = self._records
+    return [record for record in records
+            if (start is None or record.timestamp >= start) and
+            (end is None or record.timestamp < end) and
+            (kind is None or record.kind == kind)]
+
+  def payload(self, record):
+    """Returns the payload of a record as a buffer on the mapped file.
+
+    The buffer is only valid until the reader is closed.
+    """
+    return buffer(self._map, record._payload_start, len(record))
+
+  def wavelet(self, record, robot):
+    """Restores the wavelet of a SNAPSHOT record with robot."""
+    return robot.wavelet_from_bytes(self.payload(record))
+
+  def events(self, record):
+    """Returns the decoded json of an EVENTS record."""
+    return simplejson.loads(str(self.payload(record)))
+
+  def close(self):
+    self._map.close()
+    self._file.close()
+
+
+# the reader of a worker process of parallel_scan, by path
+_worker_readers = {}
+
+
+def _scan_offsets(args):
+  """Runs a scan function over the records at some offsets of an archive."""
+  path, func, offsets = args
+  reader = _worker_readers.get(path)
+  if reader is None:
+    reader = ArchiveReader(path)
+    _worker_readers.clear()
+    _worker_readers[path] = reader
+  res = []
+  for offset in offsets:
+    record = reader.record_at(offset)
+    res.append(func(record, reader.payload(record)))
+  return res
+
+
+def parallel_scan(path, func, records=None, processes=None, chunk_size=64):
+  """Calls func for records of an archive in a pool of processes.
+
+  Every process maps the archive itself, only the record offsets and the
+  results are passed between processes. Without the multiprocessing module
+  the records are scanned in this process.
+
+  Args:
+    path: the archive file.
+    func: function taking a Record and the payload buffer. It and what it
+        returns have to be picklable, so a function at module level.
+    records: the records to scan, from ArchiveReader.find, or None for all.
+    processes: the number of processes, defaults to the number of cpus.
+    chunk_size: the number of records handed to a process at a time.
+  Returns:
+    The results of func, in the order of records.
+  """
+  if multiprocessing is None or processes == 1:
+    reader = ArchiveReader(path)
+    try:
+      if records is None:
+        records = list(reader)
+      return [func(record, reader.payload(record)) for record in records]
+    finally:
+      reader.close()
+  if records is None:
+    reader = ArchiveReader(path)
+    offsets = [record.offset for record in reader]
+    reader.close()
+  else:
+    offsets = [record.offset for record in records]
+  chunks = [(path, func, offsets[start:start + chunk_size])
+            for start in xrange(0, len(offsets), chunk_size)]
+  pool = multiprocessing.Pool(processes)
+  try:
+    results = pool.map(_scan_offsets, chunks)
+  finally:
+    pool.close()
+    pool.join()
+  res = []
+  for chunk_results in results:
+    res.extend(chunk_results)
+  return res
@@ -0,0 +1,122 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the archive module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import archive
+import blip
+import ops
+import snapshot
+import wavelet
+import wavelet_test
+
+WAVE_ID = wavelet_test.TEST_WAVELET_DATA['waveId']
+WAVELET_ID = wavelet_test.TEST_WAVELET_DATA['waveletId']
+
+
+def payload_length(record, payload):
+  return record.wave_id, len(payload)
+
+
+class TestArchive(unittest.TestCase):
+  """Tests writing and reading archives."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'waves.archive')
+    operation_queue = ops.OperationQueue()
+    blips = blip.Blips({})
+    blips._add(blip.Blip(wavelet_test.TEST_BLIP_DATA, blips, operation_queue))
+    self.wavelet = wavelet.Wavelet(wavelet_test.TEST_WAVELET_DATA, blips,
+                                   None, operation_queue)
+    writer = archive.ArchiveWriter(self.path)
+    writer.append_wavelet(self.wavelet, timestamp=3000)
+    writer.append_events('{"events": []}', WAVE_ID, WAVELET_ID,
+                         timestamp=1000)
+    writer.close()
+    writer = archive.ArchiveWriter(self.path)
+    writer.append_events(u'{"events": ["caf\xe9"]}', 'test.com!w+other',
+                         WAVELET_ID, timestamp=2000)
+    writer.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testReadBack(self):
+    reader = archive.ArchiveReader(self.path)
+    self.assertEquals(3, len(reader))
+    records = list(reader)
+    self.assertEquals([archive.SNAPSHOT, archive.EVENTS, archive.EVENTS],
+                      [record.kind for record in records])
+    self.assertEquals([3000, 1000, 2000],
+                      [record.timestamp for record in records])
+    self.assertTrue(isinstance(reader.payload(records[0]), buffer))
+    loaded = snapshot.loads(reader.payload(records[0]))
+    self.assertEquals(self.wavelet.title, loaded['title'])
+    self.assertEquals({'events': [u'caf\xe9']}, reader.events(records[2]))
+    self.assertTrue(reader.record_at(records[1].offset) is records[1])
+    reader.close()
+
+  def testFind(self):
+    reader = archive.ArchiveReader(self.path)
+    offsets = lambda records: [record.offset for record in records]
+    everything = list(reader)
+    self.assertEquals(offsets(everything[:2]), offsets(reader.find(WAVE_ID)))
+    self.assertEquals(offsets(everything[:2]),
+                      offsets(reader.find(WAVE_ID, WAVELET_ID)))
+    self.assertEquals([], reader.find(WAVE_ID, 'unknown'))
+    self.assertEquals(offsets(everything[1:]),
+                      offsets(reader.find(start=1000, end=3000)))
+    self.assertEquals(offsets(everything[:1]),
+                      offsets(reader.find(WAVE_ID, start=2000)))
+    self.assertEquals(offsets(everything[1:2]),
+                      offsets(reader.find(WAVE_ID, kind=archive.EVENTS)))
+    reader.close()
+
+  def testIncompleteRecordIgnored(self):
+    f = open(self.path, 'ab')
+    f.write('\x00\x00\x01\x00\x02')
+    f.close()
+    reader = archive.ArchiveReader(self.path)
+    self.assertEquals(3, len(reader))
+    reader.close()
+
+  def testNotAnArchive(self):
+    f = open(self.path, 'wb')
+    f.write('{"json": 1}')
+    f.close()
+    self.assertRaises(ValueError, archive.ArchiveReader, self.path)
+
+  def testParallelScan(self):
+    reader = archive.ArchiveReader(self.path)
+    expected = [(record.wave_id, len(record)) for record in reader]
+    self.assertEquals(expected, archive.parallel_scan(
+        self.path, payload_length, processes=1))
+    self.assertEquals(expected, archive.parallel_scan(
+        self.path, payload_length, processes=2, chunk_size=1))
+    self.assertEquals(expected[:2], archive.parallel_scan(
+        self.path, payload_length, reader.find(WAVE_ID), processes=2))
+    reader.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -15,8 +15,16 @@
 # limitations under the License.
 
 
+import bisect
 import logging
 import element
+import intervals
+import rope
+import search
+import textdiff
+import util
+
+import simplejson
 
 class Annotation(object):
   """Models an annotation on a document.
@@ -26,6 +34,8 @@ class Annotation(object):
   the data.
   """
 
+  __slots__ = ('_name', '_value', '_start', '_end')
+
   def __init__(self, name, value, start, end):
     self._name = name
     self._value = value
@@ -48,22 +58,21 @@ class Annotation(object):
   def end(self):
     return self._end
 
-  def _shift(self, where, inc):
-    """Shift this annotation if it completely or partly stretches where."""
-    if self._start > where:
-      self._start += inc
-    if self._end > where:
-      self._end += inc
-  
   def serialize(self):
     return {'name': self._name,
             'value': self._value,
             'range': {'start': self._start,
                       'end': self._end}}
 
+util.register_serializer(Annotation, Annotation.serialize)
+
 
 class Annotations(object):
-  """Models a list of annotations as a dictionary like object on the key."""
+  """Models a list of annotations as a dictionary like object on the key.
+
+  The ranges for each key are kept in an intervals.IntervalTree. Indexing
+  returns a list of Annotation instances for the ranges at that moment.
+  """
 
   def __init__(self, operation_queue, blip):
     self._operation_queue = operation_queue
@@ -77,100 +86,476 @@ class Annotations(object):
 
   def _add_internal(self, name, value, start, end):
     """Internal add annotation does not send out operations."""
-    if name in self._store:
-      # this could be done more efficient if the list was sorted
-      new_list = []
-      for existing in self._store[name]:
-        if start > existing.end or end < existing.start:
-          new_list.append(existing)
-        else:
-          if existing.value == value:
-            # merge the annotations:
-            start = min(existing.start, start)
-            end = max(existing.end, end)
-          else:
-            # chop the bits off the existing annotation
-            if existing.start < start:
-              new_list.append(Annotation(
-                  existing.name, existing.value, existing.start, start))
-            if existing.end > end:
-              new_list.append(Annotation(
-                  existing.name, existing.value, existing.end, end))
-      new_list.append(Annotation(name, value, start, end))
-      self._store[name] = new_list
-    else:
-      self._store[name] = [Annotation(name, value, start, end)]
+    tree = self._store.get(name)
+    if tree is None:
+      tree = intervals.IntervalTree()
+      self._store[name] = tree
+    tree.set(start, end, value)
 
   def _delete_internal(self, name, start=0, end=-1):
     if not name in self._store:
       return
     if end < 0:
       end = len(self._blip) + end
-
-    new_list = []
-    for a in self._store[name]:
-      if start > a.end or end < a.start:
-        new_list.append(a)
-      elif start < a.start and end > a.end:
-        continue
-      else:
-        if a.start < start:
-          new_list.append(Annotation(name, a.value, a.start, start))
-        if a.end > end:
-          new_list.append(Annotation(name, a.value, a.end, end))
-    if new_list:
-      self._store[name] = new_list
-    else:
+    tree = self._store[name]
+    tree.clear(start, end)
+    if not tree:
       del self._store[name]
 
   def _shift(self, where, inc):
-    for annotations in self._store.values():
-      for annotation in annotations:
-        annotation._shift(where, inc)
+    for name, tree in self._store.items():
+      tree.shift(where, inc)
+      if not tree:
+        del self._store[name]
+
+  def _shift_many(self, shifts):
+    for name, tree in self._store.items():
+      tree.shift_many(shifts)
+      if not tree:
+        del self._store[name]
 
   def __len__(self):
     return len(self._store)
 
   def __getitem__(self, key):
-    return self._store[key]
-  
+    return [Annotation(key, value, start, end)
+            for start, end, value in self._store[key]]
+
+  def iter_sorted(self, name):
+    """Iterates over the annotations with name, sorted on start."""
+    tree = self._store.get(name)
+    if tree is None:
+      return
+    for start, end, value in tree:
+      yield Annotation(name, value, start, end)
+
+  def overlapping(self, start, end, name=None):
+    """Returns the annotations that overlap the range start..end.
+
+    Args:
+      start: start of the range.
+      end: end of the range.
+      name: if specified, only return annotations with this name.
+    Returns:
+      A list of Annotation instances, sorted on start per name.
+    """
+    if name is None:
+      names = self._store.keys()
+    elif name in self._store:
+      names = [name]
+    else:
+      names = []
+    res = []
+    for name in names:
+      res += [Annotation(name, value, ann_start, ann_end)
+              for ann_start, ann_end, value
+              in self._store[name].overlapping(start, end)]
+    return res
+
+  def at(self, index):
+    """Returns the annotations that cover the character at index."""
+    return self.overlapping(index, index + 1)
+
+  def names_at(self, index):
+    """Returns the set of annotation names that cover the character at index."""
+    res = set()
+    for name, tree in self._store.items():
+      for unused_range in tree.overlapping(index, index + 1):
+        res.add(name)
+        break
+    return res
+
   def serialize(self):
     res = []
-    for v in self._store.values():
-      res += [a.serialize() for a in v]
+    for name, tree in self._store.items():
+      res += [{'name': name,
+               'value': value,
+               'range': {'start': start,
+                         'end': end}}
+              for start, end, value in tree]
+    return res
+
+
+# Element properties that can be looked up through the index of Elements.
+INDEXED_PROPERTIES = ('url', 'name')
+
+
+def _element_matches(el, clz, restrictions):
+  """Returns whether el is an instance of clz with the restrictions."""
+  if not isinstance(el, clz):
+    return False
+  for key, val in restrictions.items():
+    if getattr(el, key) != val:
+      return False
+  return True
+
+
+class Elements(object):
+  """Models the elements of a blip as a dictionary like object on position.
+
+  Positions are kept in a sorted list next to the elements and looked up
+  with bisect, so iteration is in document order. Edits that move the
+  elements after some position are not applied to every stored position
+  but recorded in a Fenwick tree of offsets. The stored positions are only
+  rewritten when elements are added or removed while offsets are pending.
+
+  A secondary index maps element types and the INDEXED_PROPERTIES to the
+  indexes of the elements in the sorted lists. Moving elements does not
+  change those, so the index only has to be updated when elements are
+  added, removed or updated.
+
+  Elements report changes made to them directly, which drops the index
+  and counts as a modification of the owning blip.
+  """
+
+  def __init__(self, elements=(), owner=None):
+    pairs = list(elements)
+    pairs.sort(key=lambda pair: pair[0])
+    self._positions = [position for position, el in pairs]
+    self._elements = [el for position, el in pairs]
+    for el in self._elements:
+      el._container = self
+    # the Blip whose version is bumped when an element changes
+    self._owner = owner
+    # Pending offsets: _deltas[i] is added to the positions from index i on,
+    # _tree is the Fenwick tree over _deltas. Both are None if nothing is
+    # pending.
+    self._deltas = None
+    self._tree = None
+    # (type, property, value) or (type,) to the sorted list indexes, None
+    # if it needs to be rebuilt.
+    self._index = None
+
+  def _element_changed(self):
+    """Called by an element in this store after it was changed."""
+    self._index = None
+    if self._owner is not None:
+      self._owner._version += 1
+
+  def _detach(self, elements):
+    for el in elements:
+      if el._container is self:
+        el._container = None
+
+  def _index_keys(self, el):
+    """Returns the keys under which el is indexed."""
+    res = [(el.type,)]
+    for name in INDEXED_PROPERTIES:
+      value = getattr(el, name, None)
+      if isinstance(value, basestring):
+        res.append((el.type, name, value))
+    return res
+
+  def _get_index(self):
+    if self._index is None:
+      index = {}
+      for i, el in enumerate(self._elements):
+        for key in self._index_keys(el):
+          index.setdefault(key, []).append(i)
+      self._index = index
+    return self._index
+
+  def _candidates(self, clz, restrictions):
+    """Returns the sorted list indexes that could match, None for all."""
+    element_type = getattr(clz, 'type', None)
+    if not isinstance(element_type, basestring):
+      return None
+    index = self._get_index()
+    for name in INDEXED_PROPERTIES:
+      value = restrictions.get(name)
+      if isinstance(value, basestring):
+        return index.get((element_type, name, value), [])
+    return index.get((element_type,), [])
+
+  def find(self, clz, maxres=-1, **restrictions):
+    """Returns the positions of the elements matching clz and restrictions.
+
+    Args:
+      clz: the element class to look for.
+      maxres: number of results to return at most, or <= 0 for all.
+      restrictions: property values the elements should have.
+    Returns:
+      A list of positions in document order.
+    """
+    candidates = self._candidates(clz, restrictions)
+    if candidates is None:
+      candidates = xrange(len(self._elements))
+    res = []
+    for index in candidates:
+      if _element_matches(self._elements[index], clz, restrictions):
+        res.append(self._position(index))
+        if 0 < maxres <= len(res):
+          break
+    return res
+
+  def update(self, position, properties):
+    """Sets properties on the element at position, keeping the index."""
+    index = self._find(position)
+    if index == -1:
+      raise KeyError(position)
+    el = self._elements[index]
+    if self._index is not None:
+      try:
+        for key in self._index_keys(el):
+          self._index[key].remove(index)
+      except (KeyError, ValueError):
+        # the element was changed behind our back
+        self._index = None
+    for key, value in properties.items():
+      el._set_property(key, value)
+    if self._index is not None:
+      for key in self._index_keys(el):
+        bisect.insort(self._index.setdefault(key, []), index)
+
+  def _offset(self, index):
+    """Returns the sum of the pending offsets for the element at index."""
+    res = 0
+    tree = self._tree
+    index += 1
+    while index > 0:
+      res += tree[index]
+      index -= index & -index
     return res
 
+  def _position(self, index):
+    if self._tree is None:
+      return self._positions[index]
+    return self._positions[index] + self._offset(index)
+
+  def _add_offset(self, index, inc):
+    if self._tree is None:
+      self._deltas = [0] * len(self._positions)
+      self._tree = [0] * (len(self._positions) + 1)
+    self._deltas[index] += inc
+    tree = self._tree
+    index += 1
+    while index < len(tree):
+      tree[index] += inc
+      index += index & -index
+
+  def _normalize(self):
+    """Applies the pending offsets to the stored positions."""
+    if self._tree is None:
+      return
+    running = 0
+    positions = self._positions
+    deltas = self._deltas
+    for i in xrange(len(positions)):
+      running += deltas[i]
+      positions[i] += running
+    self._deltas = None
+    self._tree = None
+
+  def _bisect_left(self, position):
+    """Returns the index of the first element at or after position."""
+    if self._tree is None:
+      return bisect.bisect_left(self._positions, position)
+    lo = 0
+    hi = len(self._positions)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._position(mid) < position:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def _find(self, position):
+    """Returns the index of the element at position or -1."""
+    index = self._bisect_left(position)
+    if index < len(self._positions) and self._position(index) == position:
+      return index
+    return -1
+
+  def shift(self, where, inc):
+    """Moves the elements at or after where by inc."""
+    index = self._bisect_left(where)
+    if index < len(self._positions) and inc:
+      self._add_offset(index, inc)
+
+  def shift_many(self, shifts):
+    """Applies sorted (where, inc) shifts in one pass over the elements.
+
+    The shifts are in the positions from before any of them, like for
+    IntervalTree.shift_many. Elements at or after where move by inc.
+    """
+    self._normalize()
+    positions = self._positions
+    offset = 0
+    k = 0
+    for i in xrange(len(positions)):
+      while k < len(shifts) and shifts[k][0] <= positions[i]:
+        offset += shifts[k][1]
+        k += 1
+      positions[i] += offset
+
+  def delete_range(self, start, end):
+    """Removes the elements from start up to end."""
+    first = self._bisect_left(start)
+    last = self._bisect_left(end)
+    if first < last:
+      self._normalize()
+      del self._positions[first:last]
+      self._detach(self._elements[first:last])
+      del self._elements[first:last]
+      self._index = None
+
+  def __contains__(self, position):
+    return self._find(position) != -1
+
+  def __getitem__(self, position):
+    index = self._find(position)
+    if index == -1:
+      raise KeyError(position)
+    return self._elements[index]
+
+  def get(self, position, default_value=None):
+    index = self._find(position)
+    if index == -1:
+      return default_value
+    return self._elements[index]
+
+  def __setitem__(self, position, el):
+    index = self._bisect_left(position)
+    if index < len(self._positions) and self._position(index) == position:
+      self._detach([self._elements[index]])
+      self._elements[index] = el
+    else:
+      self._normalize()
+      self._positions.insert(index, position)
+      self._elements.insert(index, el)
+    el._container = self
+    self._index = None
+
+  def __delitem__(self, position):
+    index = self._find(position)
+    if index == -1:
+      raise KeyError(position)
+    self._normalize()
+    del self._positions[index]
+    self._detach([self._elements[index]])
+    del self._elements[index]
+    self._index = None
+
+  def __len__(self):
+    return len(self._positions)
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def keys(self):
+    """Returns the positions of the elements in document order."""
+    self._normalize()
+    return list(self._positions)
+
+  def values(self):
+    """Returns the elements in document order."""
+    return list(self._elements)
+
+  def items(self):
+    """Returns (position, element) pairs in document order."""
+    self._normalize()
+    return zip(self._positions, self._elements)
+
 
 class Blips(object):
-  """Class modeling an immutable dictionary of blips."""
+  """Class modeling an immutable dictionary of blips.
 
-  def __init__(self, blips):
+  Blips can be passed in as raw JSON data together with a builder. They are
+  then only turned into Blip instances when they are first looked up.
+  """
+
+  def __init__(self, blips, raw_blips=None, builder=None):
+    """Inits the dictionary.
+
+    Args:
+      blips: dictionary from blip id to Blip instances.
+      raw_blips: dictionary from blip id to the JSON data, or util.RawJson,
+          of blips that have not been constructed yet.
+      builder: function taking a blip id and its JSON data and returning
+          the Blip. Required if raw_blips is passed.
+    """
     self._blips = blips
+    if raw_blips is None:
+      raw_blips = {}
+    self._raw_blips = raw_blips
+    self._builder = builder
+    # the conversation.Conversation over these blips, once it is built
+    self._conversation = None
+
+  def _materialize(self, blip_id):
+    raw = self._raw_blips.pop(blip_id)
+    res = self._builder(blip_id, raw)
+    self._blips[blip_id] = res
+    return res
 
   def __getitem__(self, blip_id):
-    return self._blips[blip_id]
+    res = self._blips.get(blip_id)
+    if res is None:
+      if blip_id in self._raw_blips:
+        return self._materialize(blip_id)
+      raise KeyError(blip_id)
+    return res
+
+  def __contains__(self, blip_id):
+    return blip_id in self._blips or blip_id in self._raw_blips
 
   def __iter__(self):
-    return self._blips.__iter__()
+    return iter(self._blips.keys() + self._raw_blips.keys())
 
   def __len__(self):
-    return len(self._blips)
+    return len(self._blips) + len(self._raw_blips)
 
   def _add(self, ablip):
+    self._raw_blips.pop(ablip.blip_id, None)
     self._blips[ablip.blip_id] = ablip
+    if self._conversation is not None:
+      self._conversation._add(ablip.blip_id, ablip.parent_blip_id)
 
   def _remove_with_id(self, blip_id):
-    del self._blips[blip_id]
+    if blip_id in self._raw_blips:
+      del self._raw_blips[blip_id]
+    else:
+      del self._blips[blip_id]
+    if self._conversation is not None:
+      self._conversation._remove(blip_id)
 
   def get(self, blip_id, default_value=None):
-    return self._blips.get(blip_id, default_value)
-  
+    if blip_id in self:
+      return self[blip_id]
+    return default_value
+
+  def with_element(self, clz, **restrictions):
+    """Returns the blips containing an element of clz with restrictions."""
+    return [ablip for ablip in [self[blip_id] for blip_id in self]
+            if ablip._elements.find(clz, 1, **restrictions)]
+
   def serialize(self):
     res = {}
     for id in self._blips:
       res[id] = self._blips[id].serialize()
+    # blips that were never looked up are still what was sent to us
+    for id in self._raw_blips:
+      res[id] = util.decode_raw(self._raw_blips[id])
     return res
 
+  def to_json(self):
+    """Returns serialize() encoded as json.
+
+    The cached json of every blip is reused. Blips that were never looked
+    up are copied as is from the body they came in, if that was kept.
+    """
+    parts = []
+    for id in self._blips:
+      parts.append('%s: %s' % (simplejson.dumps(id), self._blips[id].to_json()))
+    for id, raw in self._raw_blips.items():
+      if isinstance(raw, util.RawJson):
+        text = raw.text()
+      else:
+        text = simplejson.dumps(raw)
+      parts.append('%s: %s' % (simplejson.dumps(id), text))
+    return '{%s}' % ', '.join(parts)
+
 
 class BlipRefs(object):
   """Represents a set of references to contents in a blip.
@@ -195,17 +580,30 @@ class BlipRefs(object):
   def __init__(self, blip, maxres=1):
     self._blip = blip
     self._maxres = maxres
+    self._search = None
+    self._cached_hits = None
+    self._cached_version = None
 
   @classmethod
-  def all(cls, blip, findwhat, maxres=-1, **restrictions):
-    """Construct an instance representing the search for text or elements."""
+  def all(cls, blip, findwhat, maxres=-1, ignore_case=False, **restrictions):
+    """Construct an instance representing the search for text or elements.
+
+    findwhat can be a string, a compiled regular expression or an element
+    class. Regular expression and case insensitive matches can't be
+    evaluated by the server, so operations on them are sent with the
+    explicit ranges of the matches instead.
+    """
     obj = cls(blip, maxres)
     obj._findwhat = findwhat
     obj._restrictions = restrictions
-    obj._hits = lambda: obj._find(findwhat, maxres, **restrictions)
+    obj._search = lambda: obj._find(findwhat, maxres, ignore_case,
+                                    **restrictions)
     if findwhat is None:
       # No findWhat, take the entire blip
       obj._params = {}
+    elif (search.is_pattern(findwhat) or
+          (isinstance(findwhat, basestring) and ignore_case)):
+      obj._params = None
     else:
       query = {'maxRes': maxres}
       if isinstance(findwhat, basestring):
@@ -222,22 +620,39 @@ class BlipRefs(object):
     obj = cls(blip)
     obj._begin = begin
     obj._end = end
-    obj._hits = lambda: [(begin, end)]
+    obj._search = lambda: [(begin, end)]
     obj._params = {'range': {'start': begin, 'end': end}}
     return obj
+
+  @classmethod
+  def ranges(cls, blip, ranges):
+    """Constructs an instance for a list of explicit, ordered ranges.
+
+    The ranges should not overlap. Operations are sent for each range
+    separately.
+    """
+    obj = cls(blip, len(ranges))
+    ranges = list(ranges)
+    obj._search = lambda: ranges
+    obj._params = None
+    return obj
   
-  def _elem_matches(self, elem, clz, **restrictions):
-    if not isinstance(elem, clz):
-      return False
-    for key, val in restrictions.items():
-      if getattr(elem, key) != val:
-        return False
-    return True
+  def _hits(self):
+    """Returns the list of (start, end) tuples this instance refers to.
+
+    The result is cached until the blip is modified.
+    """
+    version = self._blip._version
+    if self._cached_hits is None or self._cached_version != version:
+      self._cached_hits = list(self._search())
+      self._cached_version = version
+    return self._cached_hits
 
-  def _find(self, what, maxres=-1, **restrictions):
+  def _find(self, what, maxres=-1, ignore_case=False, **restrictions):
     """Iterates where 'what' occurs in the blip.
 
-    What can be either a string or a class reference.
+    What can be either a string, a compiled regular expression or a class
+    reference.
     Examples:
         blip.Find('hello') will return the first occurence of the word hello
         blip.Find(element.Gadget, url='http://example.com/gadget.xml')
@@ -247,6 +662,7 @@ class BlipRefs(object):
       what: what to search for. Can be a class or a string. The class
           should be
       maxres: number of results to return at most, or <= 0 for all.
+      ignore_case: if what is text, whether to match case insensitively.
       restrictions: if what specifies a class, further restrictions
          of the found instances.
     Returns:
@@ -257,23 +673,12 @@ class BlipRefs(object):
     if what is None:
       yield 0, len(blip)
       raise StopIteration
-    if isinstance(what, basestring):
-      idx = blip._content.find(what)
-      count = 0
-      while idx != -1:
-        yield idx, idx + len(what)
-        count += 1
-        if count == maxres:
-          raise StopIteration
-        idx = blip._content.find(what, idx + len(what))
+    if isinstance(what, basestring) or search.is_pattern(what):
+      for hit in search.find_text(blip._content, what, maxres, ignore_case):
+        yield hit
     else:
-      count = 0
-      for idx, el in blip._elements.items():
-        if self._elem_matches(el, what, **restrictions):
-          yield idx, idx + 1
-          count += 1
-          if count == maxres:
-            raise StopIteration
+      for idx in blip._elements.find(what, maxres, **restrictions):
+        yield idx, idx + 1
 
   def _execute(self, modify_how, what):
     """Executes this BlipRefs object
@@ -285,20 +690,19 @@ class BlipRefs(object):
             what to do; for ANNOTATE tuples of (key, value), for the others
             either string or elements.
             If what is a function, it takes three parameters, the content of
-            the blip, the beginning of the matching range and the end.
+            the blip, the beginning of the matching range and the end, all
+            as they were before any of the matches was modified.
     """
     blip = self._blip
 
     if modify_how != BlipRefs.DELETE:
-      if type(what) != list:
+      if type(what) != list and not callable(what):
         what = [what]
       next_index = 0
 
-    matched = []
-    # updated_elements is used to store the element type of the
-    # element to update
-    updated_elements = []
-
+    # Collect all hits up front, so that the search is done against the
+    # content as it was before any modification.
+    hits = []
     for start, end in self._hits():
       if start < 0:
         start += len(blip)
@@ -311,55 +715,106 @@ class BlipRefs(object):
           raise IndexError('Start and end have to be 0 for empty document')
       elif start < 0 or end < 1 or start >= len(blip) or end > len(blip):
         raise IndexError('Position outside the document')
-      if modify_how == BlipRefs.DELETE:
-        for i in range(start, end):
-          if i in blip._elements:
-            del blip._elements[i]
-        blip._shift(end, start - end)
-        blip._content = blip._content[:start] + blip._content[end:]
-      else:
+      hits.append((start, end))
+
+    matched = []
+    # updated_elements is used to store the element type of the
+    # element to update
+    updated_elements = []
+
+    # Work out the values for all hits from left to right. A callable gets
+    # the unmodified content and the position of the hit within it.
+    values = []
+    if modify_how != BlipRefs.DELETE:
+      if callable(what):
+        content = blip._content
+      for start, end in hits:
         if callable(what):
-          next = what(blip._content, start, end)
+          next = what(content, start, end)
           matched.append(next)
         else:
           next = what[next_index]
           next_index = (next_index + 1) % len(what)
         if isinstance(next, str):
           next = next.decode('utf-8')
-        if modify_how == BlipRefs.ANNOTATE:
-          key, value = next
-          blip.annotations._add_internal(key, value, start, end)
-        elif modify_how == BlipRefs.CLEAR_ANNOTATION:
-          blip.annotations._delete_internal(next, start, end)
-        elif modify_how == BlipRefs.UPDATE_ELEMENT:
-          el = blip._elements.get(start)
-          if not element:
-            raise ValueError('No element found at index %s' % start)
-          # the passing around of types this way feels a bit dirty:
-          updated_elements.append(element.Element(el.type, properties=next))
-          for k, b in next.items():
-            setattr(el, k, b)
+        values.append(next)
+
+    if modify_how == BlipRefs.ANNOTATE:
+      for (start, end), (key, value) in zip(hits, values):
+        blip.annotations._add_internal(key, value, start, end)
+    elif modify_how == BlipRefs.CLEAR_ANNOTATION:
+      for (start, end), name in zip(hits, values):
+        blip.annotations._delete_internal(name, start, end)
+    elif modify_how == BlipRefs.UPDATE_ELEMENT:
+      for (start, end), next in zip(hits, values):
+        el = blip._elements.get(start)
+        if el is None:
+          raise ValueError('No element found at index %s' % start)
+        # the passing around of types this way feels a bit dirty:
+        updated_elements.append(element.Element(el.type, properties=next))
+        blip._elements.update(start, next)
+    elif modify_how == BlipRefs.DELETE:
+      # Going from right to left, every hit still has its original position
+      # when it gets applied.
+      for start, end in reversed(hits):
+        blip._elements.delete_range(start, end)
+        blip._rope.delete(start, end)
+      blip._shift_many([(end, start - end) for start, end in hits])
+    else:
+      if modify_how not in (BlipRefs.INSERT, BlipRefs.INSERT_AFTER,
+                            BlipRefs.REPLACE):
+        raise ValueError('Unexpected modify_how: ' + modify_how)
+      shifts = []
+      for index in xrange(len(hits) - 1, -1, -1):
+        start, end = hits[index]
+        next = values[index]
+        if modify_how == BlipRefs.INSERT:
+          end = start
+        elif modify_how == BlipRefs.INSERT_AFTER:
+          start = end
+        # whatever elements were in the replaced range are gone
+        blip._elements.delete_range(start, end)
+        if isinstance(next, basestring):
+          shifts.append((start, end, len(next) + start - end, None))
+          blip._rope.replace(start, end, next)
         else:
-          if modify_how == BlipRefs.INSERT:
-            end = start
-          elif modify_how == BlipRefs.INSERT_AFTER:
-            start = end
-          elif modify_how == BlipRefs.REPLACE:
-            pass
-          else:
-            raise ValueError('Unexpected modify_how: ' + modify_how)
-          if isinstance(next, basestring):
-            blip._shift(end, len(next) + start - end)
-            blip._content = blip._content[:start] + next + blip._content[end:]
-          else:
-            blip._shift(end, 1 + start - end)
-            blip._content = blip._content[:start] + ' ' + blip._content[end:]
-            blip._elements[start] = next
+          shifts.append((start, end, 1 + start - end, next))
+          blip._rope.replace(start, end, ' ')
+      shifts.reverse()
+      blip._shift_many([(end, inc) for start, end, inc, el in shifts])
+      # new elements go in at their start, moved by the hits before them
+      offset = 0
+      for start, end, inc, el in shifts:
+        if el is not None:
+          blip._elements[start + offset] = el
+        offset += inc
+
+    blip._version += 1
+
+    if callable(what):
+      what = matched
+    if blip._batch is not None:
+      blip._batch._record(modify_how, hits, values, updated_elements)
+    elif self._params is None:
+      # The server can't repeat the search, so every hit goes out as its
+      # own explicit range, last one first to keep the positions valid.
+      for index in xrange(len(hits) - 1, -1, -1):
+        start, end = hits[index]
+        self._add_operation({'range': {'start': start, 'end': end}},
+                            modify_how, values[index:index + 1],
+                            updated_elements[index:index + 1])
+    else:
+      self._add_operation(self._params, modify_how, what, updated_elements)
+
+    return self
 
+  def _add_operation(self, params, modify_how, what, updated_elements):
+    """Adds the document modify operation for this BlipRefs to the queue."""
+    blip = self._blip
     operation = blip._operation_queue.DocumentModify(blip.wave_id,
                                                      blip.wavelet_id,
                                                      blip.blip_id)
-    for param, value in self._params.items():
+    for param, value in params.items():
       operation.set_param(param, value)
 
     modify_action = {'modifyHow': modify_how}
@@ -370,8 +825,6 @@ class BlipRefs(object):
     elif (modify_how == BlipRefs.REPLACE or
           modify_how == BlipRefs.INSERT or
           modify_how == BlipRefs.INSERT_AFTER):
-      if callable(what):
-        what = matched
       if what:
         if isinstance(what[0], basestring):
           modify_action['values'] = what
@@ -384,8 +837,6 @@ class BlipRefs(object):
       modify_action['annotationKey'] = what[0]
     operation.set_param('modifyAction', modify_action)
 
-    return self
-
   def insert(self, what):
     """Inserts what at the matched positions."""
     return self._execute(BlipRefs.INSERT, what)
@@ -459,6 +910,127 @@ class BlipRefs(object):
     return cmp(self.value(), other)
 
 
+class BlipBatch(object):
+  """Buffers the operations for the edits made to a blip.
+
+  Use as blip.batch(). Edits are still applied to the local model straight
+  away, so the blip can be inspected in between, but the operations are
+  held back. When the batch is flushed, text edits that touch each other
+  are combined into a single edit and adjacent annotations with the same
+  key and value are merged, and the result is sent as operations on
+  explicit ranges in the order the edits were made.
+  """
+
+  TEXT = 'TEXT'
+  ELEMENT = 'ELEMENT'
+
+  def __init__(self, blip):
+    self._blip = blip
+    self._depth = 0
+    self._start_length = len(blip)
+    # tuples of (kind, start, end, value) in the order of the edits
+    self._edits = []
+
+  def __enter__(self):
+    if self._depth == 0:
+      self._start_length = len(self._blip)
+      self._blip._batch = self
+    self._depth += 1
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._depth -= 1
+    if self._depth == 0:
+      self._blip._batch = None
+      # the local model has changed either way, so always send the edits
+      self.flush()
+    return False
+
+  def _record(self, modify_how, hits, values, updated_elements):
+    """Records the hits of one BlipRefs execution, last hit first."""
+    for index in xrange(len(hits) - 1, -1, -1):
+      start, end = hits[index]
+      if modify_how == BlipRefs.UPDATE_ELEMENT:
+        self._edits.append((modify_how, start, end, updated_elements[index]))
+        continue
+      if modify_how == BlipRefs.DELETE:
+        self._edits.append((BlipBatch.TEXT, start, end, u''))
+        continue
+      value = values[index]
+      if modify_how in (BlipRefs.ANNOTATE, BlipRefs.CLEAR_ANNOTATION):
+        self._edits.append((modify_how, start, end, value))
+        continue
+      if modify_how == BlipRefs.INSERT:
+        end = start
+      elif modify_how == BlipRefs.INSERT_AFTER:
+        start = end
+      if isinstance(value, basestring):
+        self._edits.append((BlipBatch.TEXT, start, end, value))
+      else:
+        self._edits.append((BlipBatch.ELEMENT, start, end, value))
+
+  def _coalesce(self):
+    """Returns the recorded edits with adjacent edits combined."""
+    res = []
+    for edit in self._edits:
+      kind, start, end, value = edit
+      if res:
+        last_kind, last_start, last_end, last_value = res[-1]
+        if kind == BlipBatch.TEXT and last_kind == BlipBatch.TEXT:
+          # last_value now sits at last_start..new_end
+          new_end = last_start + len(last_value)
+          if start <= new_end and end >= last_start:
+            prefix = last_value[:max(0, start - last_start)]
+            suffix = last_value[max(0, end - last_start):]
+            res[-1] = (BlipBatch.TEXT, min(start, last_start),
+                       max(end, new_end) - new_end + last_end,
+                       prefix + value + suffix)
+            continue
+        elif (kind == last_kind and value == last_value and
+              kind in (BlipRefs.ANNOTATE, BlipRefs.CLEAR_ANNOTATION) and
+              start <= last_end and end >= last_start):
+          res[-1] = (kind, min(start, last_start), max(end, last_end), value)
+          continue
+      res.append(edit)
+    return res
+
+  def flush(self):
+    """Sends the operations for the edits recorded so far."""
+    refs = BlipRefs(self._blip)
+    length = self._start_length
+    for kind, start, end, value in self._coalesce():
+      if kind in (BlipBatch.TEXT, BlipBatch.ELEMENT):
+        if kind == BlipBatch.TEXT:
+          inserted = len(value)
+        else:
+          inserted = 1
+        if start == end and not inserted:
+          continue
+        change = inserted - (end - start)
+        if not inserted:
+          modify_how = BlipRefs.DELETE
+        elif start < end:
+          modify_how = BlipRefs.REPLACE
+        elif start < length or length == 0:
+          modify_how = BlipRefs.INSERT
+          end = min(start + 1, length)
+        else:
+          # appending at the end of the document
+          modify_how = BlipRefs.INSERT_AFTER
+          start -= 1
+        length += change
+        refs._add_operation({'range': {'start': start, 'end': end}},
+                            modify_how, [value], [])
+      elif kind == BlipRefs.UPDATE_ELEMENT:
+        refs._add_operation({'range': {'start': start, 'end': end}},
+                            kind, [], [value])
+      else:
+        refs._add_operation({'range': {'start': start, 'end': end}},
+                            kind, [value], [])
+    self._edits = []
+    self._start_length = len(self._blip)
+
+
 class Blip(object):
   """Models a single blip instance.
 
@@ -476,7 +1048,8 @@ class Blip(object):
     content: Raw text content contained by this blip.
     contributors: Set of contributor ids that have contributed to this blip.
     creator: Participant string id of the creator.
-    raw_data: Dictionary of incoming raw JSON data.
+    raw_data: Dictionary of incoming raw JSON data, or None if the robot
+        dropped it.
     document: Document object for this blip.
     lastModifiedTime: Time that this blip was last modified on the server.
     parentBlipId: String id of the parent blip or None if this is the root.
@@ -484,35 +1057,85 @@ class Blip(object):
     waveletId: String id of the wavelet that this belongs to.
   """ 
 
-  def __init__(self, json, other_blips, operation_queue):
+  __slots__ = ('_blip_id', '_operation_queue', '_child_blip_ids',
+               '_child_blip_order', '_rope',
+               '_contributors', '_creator', '_last_modified_time',
+               '_parent_blip_id', '_wave_id', '_wavelet_id', '_other_blips',
+               '_version', '_batch', '_annotations_store', '_elements_store',
+               '_interner', '_raw_data', '_serialized', '_json')
+
+  def __init__(self, json, other_blips, operation_queue, interner=None):
     """Inits this blip with JSON data.
 
     Args:
       json: JSON data dictionary from Wave server.
+      other_blips: the blips of the wavelet, a dictionary or Blips.
+      operation_queue: the queue to add operations to.
+      interner: optional util.Interner shared by the blips of one bundle,
+          used to share ids and element properties between them.
     """
-    self._blip_id = json.get('blipId')
+    if interner is None:
+      interner = util.NULL_INTERNER
+    self._interner = interner
+    self._blip_id = interner.intern(json.get('blipId'))
     self._operation_queue = operation_queue
-    self._child_blip_ids = set(json.get('childBlipIds', []))
-    self._content = json.get('content', '')
-    self._contributors = set(json.get('contributors', []))
-    self._creator = json.get('creator')
+    # the ids in the order of the json, used to order the conversation
+    self._child_blip_order = interner.intern_all(json.get('childBlipIds', []))
+    self._child_blip_ids = set(self._child_blip_order)
+    self._rope = rope.Rope(json.get('content', ''))
+    self._contributors = set(interner.intern_all(
+        json.get('contributors', [])))
+    self._creator = interner.intern(json.get('creator'))
     self._last_modified_time = json.get('lastModifiedTime', 0)
-    self._parent_blip_id = json.get('parentBlipId')
-    self._wave_id = json.get('waveId')
-    self._wavelet_id = json.get('waveletId')
-    self._other_blips = Blips(other_blips)
-    self._annotations = Annotations(operation_queue, self)
-    for annjson in json.get('annotations', []):
-      range = annjson['range']
-      self._annotations._add_internal(annjson['name'],
-                                      annjson['value'],
-                                      range['start'],
-                                      range['end'])
-    self._elements = {}
-    json_elements = json.get('elements', {})
-    for elem in json_elements:
-      self._elements[int(elem)] = element.Element.from_json(json_elements[elem])
-    self.raw_data = json
+    self._parent_blip_id = interner.intern(json.get('parentBlipId'))
+    self._wave_id = interner.intern(json.get('waveId'))
+    self._wavelet_id = interner.intern(json.get('waveletId'))
+    if isinstance(other_blips, Blips):
+      self._other_blips = other_blips
+    else:
+      self._other_blips = Blips(other_blips)
+    # incremented on every modification, used to invalidate cached searches
+    # and serializations
+    self._version = 0
+    # (version, result) of the last serialize and to_json calls
+    self._serialized = None
+    self._json = None
+    # the BlipBatch collecting the operations, if any
+    self._batch = None
+    # annotations and elements are decoded from the json when first used
+    self._annotations_store = None
+    self._elements_store = None
+    self._raw_data = json
+
+  def _get_raw_data(self):
+    return util.decode_raw(self._raw_data)
+
+  def _set_raw_data(self, raw_data):
+    self._raw_data = raw_data
+
+  raw_data = property(_get_raw_data, _set_raw_data)
+
+  def _retain_raw_data(self, raw):
+    """Replaces the raw json that this blip holds on to.
+
+    Args:
+      raw: a util.RawJson to decode from when needed, or None to drop the
+          raw json. Annotations and elements are decoded first then.
+    """
+    if raw is None:
+      self._get_annotations()
+      self._get_elements()
+    self._raw_data = raw
+
+  def _raw_member(self, name, default):
+    """Returns a single member of the raw json, decoding only that."""
+    raw = self._raw_data
+    if isinstance(raw, util.RawJson):
+      raw = raw.member(name)
+      if raw is None:
+        return default
+      return raw.decode()
+    return raw.get(name, default)
 
   @property
   def blip_id(self):
@@ -587,8 +1210,50 @@ class Blip(object):
     """
     return self._elements.values()
 
+  def _get_annotations(self):
+    if self._annotations_store is None:
+      annotations = Annotations(self._operation_queue, self)
+      for annjson in self._raw_member('annotations', []):
+        range = annjson['range']
+        annotations._add_internal(annjson['name'],
+                                  annjson['value'],
+                                  range['start'],
+                                  range['end'])
+      self._annotations_store = annotations
+    return self._annotations_store
+
+  def _set_annotations(self, annotations):
+    self._annotations_store = annotations
+
+  _annotations = property(_get_annotations, _set_annotations)
+
+  def _get_elements(self):
+    if self._elements_store is None:
+      json_elements = self._raw_member('elements', {})
+      self._elements_store = Elements(
+          [(int(elem), element.Element.from_json(json_elements[elem],
+                                                 self._interner))
+           for elem in json_elements], self)
+    return self._elements_store
+
+  def _set_elements(self, elements):
+    self._elements_store = elements
+
+  _elements = property(_get_elements, _set_elements)
+
+  def _get_content(self):
+    return self._rope.text()
+
+  def _set_content(self, content):
+    self._rope = rope.Rope(content)
+    self._version += 1
+
+  # The text content of the blip is stored in a rope so edits don't
+  # need to copy the whole string. _content materializes it.
+  _content = property(_get_content, _set_content)
+
   def __len__(self):
-    return len(self._content)
+    return len(self._rope)
 
   def __getitem__(self, item):
     """blip[...] returns a BlipRefs of either range or at."""
@@ -609,19 +1274,24 @@ class Blip(object):
 
   def _shift(self, where, inc):
     """Move element and annotations after where up by inc."""
-    new_elements = {}
-    for idx, el in self._elements.items():
-      if idx >= where:
-        idx += inc
-      new_elements[idx] = el
-    self._elements = new_elements
+    self._elements.shift(where, inc)
     self._annotations._shift(where, inc)
 
-  def all(self, findwhat=None, maxres=-1, **restrictions):
-    return BlipRefs.all(self, findwhat, maxres, **restrictions)
+  def _shift_many(self, shifts):
+    """Applies sorted (where, inc) shifts in one pass, see Elements."""
+    if len(shifts) < 2:
+      # a lone shift only touches what comes after it
+      for where, inc in shifts:
+        self._shift(where, inc)
+      return
+    self._elements.shift_many(shifts)
+    self._annotations._shift_many(shifts)
+
+  def all(self, findwhat=None, maxres=-1, ignore_case=False, **restrictions):
+    return BlipRefs.all(self, findwhat, maxres, ignore_case, **restrictions)
 
-  def first(self, findwhat=None, **restrictions):
-    return BlipRefs.all(self, findwhat, 1, **restrictions)
+  def first(self, findwhat=None, ignore_case=False, **restrictions):
+    return BlipRefs.all(self, findwhat, 1, ignore_case, **restrictions)
 
   def at(self, index):
     return BlipRefs.range(self, index, index + 1)
@@ -630,8 +1300,15 @@ class Blip(object):
     return BlipRefs.range(self, start, end)
   
   def serialize(self):
-    """Return a dictionary representation of this blip ready for json."""
-    return {'blipId': self._blip_id,
+    """Return a dictionary representation of this blip ready for json.
+
+    The dictionary is cached until the blip is modified, callers should not
+    change it.
+    """
+    cached = self._serialized
+    if cached is not None and cached[0] == self._version:
+      return cached[1]
+    res = {'blipId': self._blip_id,
             'childBlipIds': list(self._child_blip_ids),
             'content': self._content,
             'creator': self._creator,
@@ -644,6 +1321,16 @@ class Blip(object):
             'elements': dict([(index, e.serialize())
                               for index, e in self._elements.items()])
           }
+    self._serialized = (self._version, res)
+    return res
+
+  def to_json(self):
+    """Returns the serialized blip encoded as json, cached like serialize."""
+    cached = self._json
+    if cached is None or cached[0] != self._version:
+      cached = (self._version, simplejson.dumps(self.serialize()))
+      self._json = cached
+    return cached[1]
   
   def proxy_for(self, proxy_for_id):
     """Return a view on this blip that will proxy for the specified id.
@@ -660,6 +1347,7 @@ class Blip(object):
                operation_queue=operation_queue)
     res._blip_id = self._blip_id
     res._child_blip_ids = self._child_blip_ids
+    res._child_blip_order = self._child_blip_order
     res._content = self._content
     res._contributors = self._contributors
     res._creator = self._creator
@@ -670,7 +1358,7 @@ class Blip(object):
     res._other_blips = self._other_blips
     res._annotations = self._annotations
     res._elements = self._elements
-    res.raw_data = self.raw_data
+    res._raw_data = self._raw_data
     return res
 
   @property
@@ -678,19 +1366,106 @@ class Blip(object):
     """Returns the raw text content of this document."""
     return self._content
 
-  def find(self, what, **restrictions):
+  def find(self, what, ignore_case=False, **restrictions):
     """Iterate to matching bits of contents.
 
     Yield either elements or pieces of text.
     """
-    br = BlipRefs.all(self, what, **restrictions)
+    br = BlipRefs.all(self, what, ignore_case=ignore_case, **restrictions)
     for start, end in br._hits():
       if end - start == 1 and start in self._elements:
         yield self._elements[start]
       else:
-        yield self._content[start:end]
+        yield self._rope[start:end]
     raise StopIteration
 
+  def batch(self):
+    """Returns a context in which the operations for edits are combined.
+
+    Example:
+      with blip.batch():
+        blip.first('hello').replace('hi')
+        blip.all('world').annotate('style/fontWeight', 'bold')
+
+    The local blip is modified right away, the operations are sent
+    combined when the outermost batch ends. See BlipBatch.
+    """
+    if self._batch is not None:
+      return self._batch
+    return BlipBatch(self)
+
+  def _flush_batch(self):
+    """Sends the operations of a running batch before a direct operation."""
+    if self._batch is not None:
+      self._batch.flush()
+
+  def set_text(self, text):
+    """Changes the text of the blip to text, touching as little as possible.
+
+    The current and the new text are diffed and only the changed stretches
+    are replaced, so annotations and elements on the unchanged parts are
+    kept and the operations sent are proportional to the change.
+    """
+    if isinstance(text, str):
+      text = text.decode('utf-8')
+    edits = textdiff.diff(self._content, text)
+    batch = self.batch()
+    batch.__enter__()
+    try:
+      # last to first, so the positions of the others stay valid
+      for start, end, replacement in reversed(edits):
+        if start < end:
+          refs = BlipRefs.range(self, start, end)
+          if replacement:
+            refs.replace(replacement)
+          else:
+            refs.delete()
+        elif start < len(self) or len(self) == 0:
+          BlipRefs.range(self, start, min(start + 1, len(self))).insert(
+              replacement)
+        else:
+          BlipRefs.range(self, start - 1, start).insert_after(replacement)
+    finally:
+      batch.__exit__(None, None, None)
+
+  def find_many(self, patterns):
+    """Finds all occurrences of any of patterns in a single pass.
+
+    Where matches overlap, the first and then the longest one is taken.
+
+    Args:
+      patterns: a sequence of strings.
+    Returns:
+      A list of (start, end, pattern) tuples in document order.
+    """
+    return search.find_many(self._content, patterns)
+
+  def replace_many(self, mapping):
+    """Replaces all occurrences of the keys of mapping by their values.
+
+    The blip is searched once for all keys. Matches that are directly
+    next to each other are combined, and the result is sent as one
+    operation per remaining range.
+
+    Args:
+      mapping: a dictionary from strings to their replacement strings.
+    Returns:
+      The BlipRefs for the replaced ranges.
+    """
+    ranges = []
+    values = []
+    for start, end, pattern in self.find_many(mapping.keys()):
+      value = mapping[pattern]
+      if isinstance(value, str):
+        value = value.decode('utf-8')
+      if ranges and ranges[-1][1] == start:
+        ranges[-1] = (ranges[-1][0], end)
+        values[-1] += value
+      else:
+        ranges.append((start, end))
+        values.append(value)
+    return BlipRefs.ranges(self, ranges).replace(values)
+
   def append(self, what):
     """Convenience method covering a common pattern."""
     return BlipRefs.all(self, findwhat=None).insert_after(what)
@@ -700,22 +1475,33 @@ class Blip(object):
     blip_data = self._operation_queue.BlipCreateChild(self.wave_id,
                                                       self.wavelet_id,
                                                       self.blip_id)
-    new_blip = Blip(blip_data, self._other_blips, self._operation_queue)
-    self._other_blips._add(new_blip)
+    new_blip = Blip(blip_data, self._other_blips, self._operation_queue,
+                    self._interner)
+    self._add_child(new_blip)
     return new_blip
 
+  def _add_child(self, new_blip):
+    """Records a newly created blip as the last child of this blip."""
+    new_blip._parent_blip_id = self._blip_id
+    self._child_blip_ids.add(new_blip.blip_id)
+    self._child_blip_order.append(new_blip.blip_id)
+    self._version += 1
+    self._other_blips._add(new_blip)
+
   def append_markup(self, markup):
     """Interpret the markup text as xhtml and append the result to the doc.
 
     Args:
       markup: The markup'ed text to append.
     """
+    self._flush_batch()
     self._operation_queue.DocumentAppendMarkup(self.wave_id,
                                                self.wavelet_id,
                                                self.blip_id,
                                                markup)
     #TODO(Douwe): at least strip the html out
-    self._content += markup
+    self._rope.insert(len(self._rope), markup)
+    self._version += 1
 
   def insert_inline_blip(self, position):
     """Inserts an inline blip into this blip at a specific position.
@@ -726,11 +1512,13 @@ class Blip(object):
     Returns:
       The JSON data of the blip that was created.
     """
+    self._flush_batch()
     blip_data = self._operation_queue.DocumentInlineBlipInsert(
         self.wave_id,
         self.wavelet_id,
         self.blip_id,
         position)
-    new_blip = Blip(blip_data, self._other_blips, self._operation_queue)
-    self._other_blips._add(new_blip)
+    new_blip = Blip(blip_data, self._other_blips, self._operation_queue,
+                    self._interner)
+    self._add_child(new_blip)
     return new_blip
@@ -16,11 +16,15 @@
 
 """Unit tests for the blip module."""
 
+from __future__ import with_statement
 
+import random
+import re
 import unittest
 
 import blip
 import element
+import intervals
 import ops
 import simplejson
 
@@ -40,6 +44,28 @@ CHILD_BLIP_ID = 'b+42'
 ROOT_BLIP_ID = 'b+43'
 
 
+def apply_range_operations(content, operations):
+  """Applies serialized document.modify operations on ranges to content."""
+  for op in operations:
+    params = op['params']
+    if 'range' not in params:
+      continue
+    start = params['range']['start']
+    end = params['range']['end']
+    action = params['modifyAction']
+    value = ''.join(action.get('values', []))
+    how = action['modifyHow']
+    if how == 'DELETE':
+      content = content[:start] + content[end:]
+    elif how == 'REPLACE':
+      content = content[:start] + value + content[end:]
+    elif how == 'INSERT':
+      content = content[:start] + value + content[start:]
+    elif how == 'INSERT_AFTER':
+      content = content[:end] + value + content[end:]
+  return content
+
+
 class TestBlip(unittest.TestCase):
   """Tests the primary data structures for the wave model."""
 
@@ -142,6 +168,55 @@ class TestBlip(unittest.TestCase):
     elem = blip[1].value()
     self.assertTrue(isinstance(elem, element.Image))
 
+  def testElementsInDocumentOrder(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID)
+    for i in range(20):
+      blip.append(element.Gadget('http://test.com/gadget%d.xml' % i))
+    self.assertEquals('http://test.com/gadget0.xml',
+                      blip.first(element.Gadget).url)
+    blip.at(1).insert('more text')
+    del blip[3:5]
+    positions = [start for start, end in blip.all(element.Gadget)._hits()]
+    self.assertEquals(range(len(blip) - 20, len(blip)), positions)
+    urls = [gadget.url for gadget in blip.find(element.Gadget)]
+    self.assertEquals(['http://test.com/gadget%d.xml' % i for i in range(20)],
+                      urls)
+    blip.all(element.Gadget, url='http://test.com/gadget3.xml').delete()
+    self.assertEquals(19, len(blip.elements))
+    self.assertEquals(range(len(blip) - 19, len(blip)),
+                      [start for start, end in blip.all(element.Gadget)._hits()])
+
+  def testElementIndex(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID)
+    for i in range(5):
+      blip.append(element.Gadget('http://test.com/gadget%d.xml' % i))
+      blip.append(element.Input('field%d' % i))
+    gadget = blip.first(element.Gadget, url='http://test.com/gadget3.xml')
+    self.assertEquals('http://test.com/gadget3.xml', gadget.url)
+    self.assertEquals(5, len(list(blip.find(element.Gadget))))
+    self.assertEquals(['field2'],
+                      [el.name for el in blip.find(element.Input,
+                                                   name='field2')])
+    blip.at(1).insert('moving things')
+    position = blip.first(element.Input, name='field2')._hits()[0][0]
+    self.assertTrue(isinstance(blip[position].value(), element.Input))
+
+    gadget.update_element({'url': 'http://test.com/other.xml'})
+    self.assertFalse(blip.first(element.Gadget,
+                                url='http://test.com/gadget3.xml'))
+    self.assertTrue(blip.first(element.Gadget, url='http://test.com/other.xml'))
+    blip.all(element.Gadget, url='http://test.com/gadget1.xml').delete()
+    self.assertEquals(4, len(list(blip.find(element.Gadget))))
+    self.assertEquals(['http://test.com/gadget0.xml',
+                       'http://test.com/gadget2.xml',
+                       'http://test.com/other.xml',
+                       'http://test.com/gadget4.xml'],
+                      [el.url for el in blip.find(element.Gadget)])
+    self.assertEquals([blip], blip._other_blips.with_element(
+        element.Input, name='field4'))
+    self.assertEquals([], blip._other_blips.with_element(
+        element.Input, name='field5'))
+
   def testAnnotationHandling(self):
     key = 'style/fontWeight'
 
@@ -178,6 +253,32 @@ class TestBlip(unittest.TestCase):
     # getting to the key should now throw an exception
     self.assertRaises(KeyError, blip.annotations.__getitem__, key)
 
+  def testAnnotationQueries(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID, content='hello world',
+                         annotations=[])
+    blip.range(0, 5).annotate('style/fontWeight', 'bold')
+    blip.range(3, 8).annotate('link/manual', 'http://a.b')
+    blip.range(9, 11).annotate('style/fontWeight', 'italic')
+    self.assertEquals(set(['style/fontWeight', 'link/manual']),
+                      blip.annotations.names_at(4))
+    self.assertEquals(set(['link/manual']), blip.annotations.names_at(6))
+    self.assertEquals(set(), blip.annotations.names_at(8))
+    self.assertEquals(['http://a.b'],
+                      [a.value for a in blip.annotations.at(7)])
+    hits = blip.annotations.overlapping(4, 10, 'style/fontWeight')
+    self.assertEquals([(0, 5, 'bold'), (9, 11, 'italic')],
+                      [(a.start, a.end, a.value) for a in hits])
+    self.assertEquals(3, len(blip.annotations.overlapping(0, 11)))
+    self.assertEquals([], blip.annotations.overlapping(0, 5, 'unknown'))
+
+    # the index follows edits of the content
+    blip.range(0, 2).delete()
+    self.assertEquals([(0, 3, 'bold'), (7, 9, 'italic')],
+                      [(a.start, a.end, a.value) for a in
+                       blip.annotations.iter_sorted('style/fontWeight')])
+    self.assertEquals(set(['link/manual']), blip.annotations.names_at(5))
+    self.assertEquals([], list(blip.annotations.iter_sorted('unknown')))
+
   def testBlipOperations(self):
     blip = self.new_blip(blipId=ROOT_BLIP_ID)
     self.assertEquals(1, len(self.all_blips))
@@ -197,6 +298,227 @@ class TestBlip(unittest.TestCase):
     self.assertEquals('a thing thing with thing and then some thing',
                       blip.text)
 
+  def testReplaceAllHits(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID, content='aaaa b aaaa',
+                         annotations=[])
+    blip.append(element.Gadget('http://test.com/gadget.xml'))
+    blip.range(5, 6).annotate('style/fontWeight', 'bold')
+    # the callable sees the original content and positions
+    seen = []
+    def upper(content, start, end):
+      seen.append(start)
+      return content[start:end].upper() + 'x'
+    blip.all('aa').replace(upper)
+    self.assertEquals([0, 2, 7, 9], seen)
+    self.assertEquals('AAxAAx b AAxAAx ', blip.text)
+    self.assertEquals([(7, 8)],
+                      [(a.start, a.end) for a in
+                       blip.annotations['style/fontWeight']])
+    self.assertEquals(15, list(blip.all(element.Gadget)._hits())[0][0])
+    blip.all('x').delete()
+    self.assertEquals('AAAA b AAAA ', blip.text)
+    self.assertEquals(11, list(blip.first(element.Gadget)._hits())[0][0])
+
+  def testManyHitsShiftOnce(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID, content='ab ' * 200,
+                         annotations=[])
+    blip.append(element.Gadget('http://test.com/gadget.xml'))
+    blip.range(0, 600).annotate('style/fontWeight', 'bold')
+    blip.range(6, 8).annotate('style/color', 'red')
+    calls = []
+    shift = intervals.IntervalTree.shift
+    shift_many = intervals.IntervalTree.shift_many
+    def count_shift(tree, where, inc):
+      calls.append('shift')
+      shift(tree, where, inc)
+    def count_shift_many(tree, shifts):
+      calls.append('shift_many')
+      shift_many(tree, shifts)
+    intervals.IntervalTree.shift = count_shift
+    intervals.IntervalTree.shift_many = count_shift_many
+    try:
+      blip.all('b').replace('xyz')
+      blip.all('y').delete()
+    finally:
+      intervals.IntervalTree.shift = shift
+      intervals.IntervalTree.shift_many = shift_many
+    # one pass per annotation name for each edit
+    self.assertEquals(['shift_many'] * 4, calls)
+    self.assertEquals('axz ' * 200 + ' ', blip.text)
+    self.assertEquals([(0, 800)], [(a.start, a.end) for a in
+                                   blip.annotations['style/fontWeight']])
+    self.assertEquals([(8, 10)], [(a.start, a.end) for a in
+                                  blip.annotations['style/color']])
+    self.assertEquals(800, list(blip.first(element.Gadget)._hits())[0][0])
+
+  def testEditsKeepContentUnmaterialized(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID, content='hello world',
+                         annotations=[])
+    blip.at(5).insert(',')
+    blip.range(0, 5).replace('howdy')
+    blip.range(0, 5).annotate('style/fontWeight', 'bold')
+    self.assertEquals(None, blip._rope._text)
+    self.assertEquals('howdy, world', blip.text)
+
+  def testPatternSearch(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID,
+                         content='Call 555-1234 or 555-9876')
+    self.assertEquals(['555-1234', '555-9876'],
+                      list(blip.find(re.compile(r'\d{3}-\d{4}'))))
+    self.assertEquals(['Call'], list(blip.find('call', ignore_case=True)))
+    self.assertEquals(2, len(list(blip.all('555', maxres=0)._hits())))
+    self.operation_queue.clear()
+    blip.all(re.compile(r'\d{3}-(\d{4})')).replace(
+        lambda content, start, end: 'XXX-' + content[end - 4:end])
+    self.assertEquals('Call XXX-1234 or XXX-9876', blip.text)
+    # the matches are sent as explicit ranges, last one first
+    ops = self.operation_queue.serialize()[1:]
+    self.assertEquals(2, len(ops))
+    self.assertEquals({'start': 17, 'end': 25}, ops[0]['params']['range'])
+    self.assertEquals(['XXX-9876'],
+                      ops[0]['params']['modifyAction']['values'])
+    self.assertEquals({'start': 5, 'end': 13}, ops[1]['params']['range'])
+    self.assertFalse('modifyQuery' in ops[1]['params'])
+
+  def testReplaceMany(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID,
+                         content='Dear {title}{name}, see you in {city}.')
+    self.assertEquals([(5, 12, '{title}'), (12, 18, '{name}'),
+                       (31, 37, '{city}')],
+                      blip.find_many(['{name}', '{city}', '{title}']))
+    self.operation_queue.clear()
+    blip.replace_many({'{title}': 'Dr. ', '{name}': 'Who',
+                       '{city}': 'London'})
+    self.assertEquals('Dear Dr. Who, see you in London.', blip.text)
+    # the adjacent placeholders are combined into one operation
+    ops = self.operation_queue.serialize()[1:]
+    self.assertEquals(2, len(ops))
+    self.assertEquals({'start': 31, 'end': 37}, ops[0]['params']['range'])
+    self.assertEquals({'start': 5, 'end': 18}, ops[1]['params']['range'])
+    self.assertEquals(['Dr. Who'], ops[1]['params']['modifyAction']['values'])
+
+  def testBlipRefsHitsCached(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID, content='hello hello')
+    refs = blip.all('hello')
+    searches = []
+    search = refs._search
+    def counting_search():
+      searches.append(1)
+      return search()
+    refs._search = counting_search
+    self.assertTrue(refs)
+    self.assertEquals('hello', refs.value())
+    self.assertEquals(1, len(searches))
+    blip.range(0, 1).delete()
+    self.assertEquals([(5, 10)], refs._hits())
+    self.assertEquals(2, len(searches))
+
+  def testBatch(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID, content='hello world',
+                         annotations=[])
+    self.operation_queue.clear()
+    with blip.batch():
+      blip.append('!')
+      blip.append('?')
+      blip.first('world').replace('there')
+      self.assertEquals('hello there!?', blip.text)
+      blip.range(0, 3).annotate('style/fontWeight', 'bold')
+      blip.range(3, 5).annotate('style/fontWeight', 'bold')
+      self.assertEquals(0, len(self.operation_queue))
+    self.assertEquals('hello there!?', blip.text)
+    ops = self.operation_queue.serialize()[1:]
+    self.assertEquals(2, len(ops))
+    self.assertEquals({'start': 6, 'end': 11}, ops[0]['params']['range'])
+    self.assertEquals(['there!?'], ops[0]['params']['modifyAction']['values'])
+    self.assertEquals({'start': 0, 'end': 5}, ops[1]['params']['range'])
+    self.assertEquals('ANNOTATE', ops[1]['params']['modifyAction']['modifyHow'])
+
+  def testBatchOperationsReplay(self):
+    generator = random.Random(3)
+    for i in range(20):
+      self.all_blips.clear()
+      self.operation_queue.clear()
+      blip = self.new_blip(blipId=ROOT_BLIP_ID, content='abcdefghij',
+                           annotations=[])
+      with blip.batch():
+        for j in range(10):
+          start = generator.randint(0, len(blip) - 1)
+          end = generator.randint(start + 1, len(blip))
+          choice = generator.randint(0, 3)
+          if choice == 0 and len(blip) > 2:
+            blip.range(start, end).delete()
+          elif choice == 1:
+            blip.range(start, end).replace('xy'[:generator.randint(1, 2)])
+          elif choice == 2:
+            blip.at(start).insert('1')
+          else:
+            blip.append('2')
+      ops = self.operation_queue.serialize()[1:]
+      self.assertTrue(len(ops) <= 10)
+      self.assertEquals(blip.text, apply_range_operations('abcdefghij', ops))
+
+  def testSetText(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID,
+                         content='the quick brown fox', annotations=[])
+    blip.range(16, 19).annotate('style/fontWeight', 'bold')
+    blip.append(element.Gadget('http://test.com/gadget.xml'))
+    self.operation_queue.clear()
+    blip.set_text('the quick red fox ')
+    self.assertEquals('the quick red fox ', blip.text)
+    self.assertEquals([(14, 17)], [(a.start, a.end) for a in
+                                   blip.annotations['style/fontWeight']])
+    self.assertEquals(17, blip.first(element.Gadget)._hits()[0][0])
+    ops = self.operation_queue.serialize()[1:]
+    self.assertEquals(1, len(ops))
+    self.assertEquals({'start': 10, 'end': 15}, ops[0]['params']['range'])
+
+    blip.set_text('a quick red fox jumps')
+    blip.set_text('')
+    self.assertEquals('', blip.text)
+    blip.set_text('new')
+    self.assertEquals('new', blip.text)
+    self.assertEquals('new', apply_range_operations(
+        'the quick brown fox ', self.operation_queue.serialize()[1:]))
+
+  def testSerializeCached(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID)
+    serialized = blip.serialize()
+    self.assertTrue(serialized is blip.serialize())
+    json = blip.to_json()
+    self.assertTrue(json is blip.to_json())
+    self.assertEquals(simplejson.loads(json), simplejson.loads(
+        simplejson.dumps(serialized)))
+    blip.range(0, 1).annotate('style/fontWeight', 'bold')
+    self.assertFalse(serialized is blip.serialize())
+    self.assertEquals(2, len(blip.serialize()['annotations']))
+    blip.append('!')
+    self.assertEquals(blip.text, simplejson.loads(blip.to_json())['content'])
+    reply = blip.reply()
+    self.assertEquals([reply.blip_id], blip.serialize()['childBlipIds'])
+
+  def testDirectElementChangeInvalidatesCaches(self):
+    blip = self.new_blip(blipId=ROOT_BLIP_ID)
+    blip.append(element.Image(url='http://test.com/a.png'))
+    position = len(blip) - 1
+    refs = blip.all(element.Image, url='http://test.com/b.png')
+    self.assertFalse(refs)
+    serialized = blip.serialize()
+    json = blip.to_json()
+    image = blip[position].value()
+    image.url = 'http://test.com/b.png'
+    self.assertFalse(serialized is blip.serialize())
+    self.assertEquals('http://test.com/b.png',
+                      blip.serialize()['elements'][position]
+                      ['properties']['url'])
+    self.assertNotEqual(json, blip.to_json())
+    self.assertTrue(refs)
+    self.assertEquals([position], [start for start, end in refs._hits()])
+    # an element that was removed from the blip no longer affects it
+    blip.all(element.Image).delete()
+    serialized = blip.serialize()
+    image.url = 'http://test.com/c.png'
+    self.assertTrue(serialized is blip.serialize())
+
   def testBlipRefValue(self):
     blip = self.new_blip(blipId=ROOT_BLIP_ID)
     content = blip.text
@@ -0,0 +1,220 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Defines the Conversation class, an index of the replies in a wavelet.
+
+The index keeps the parent and the ordered children of every blip, so
+threads can be walked without looking up each blip's relatives. It is
+built when first asked for through Wavelet.conversation and then kept up
+to date as blips are added or deleted through the model.
+"""
+
+
+def _blip_id(blip_or_id):
+  if hasattr(blip_or_id, 'blip_id'):
+    return blip_or_id.blip_id
+  return blip_or_id
+
+
+class Conversation(object):
+  """The reply structure of the blips of a wavelet.
+
+  Blips without a parent in the wavelet are the top level of the
+  conversation, starting with the root blip. Children are in the order
+  their parent lists them, followed by the ones added later.
+
+  Methods accept either a blip or a blip id.
+  """
+
+  __slots__ = ('_blips', '_parents', '_children', '_roots', '_depths',
+               '_sizes')
+
+  def __init__(self, blips, root_blip_id=None):
+    """Builds the index for all blips, which get constructed to do so.
+
+    Args:
+      blips: the blip.Blips of a wavelet.
+      root_blip_id: id of the root blip of the wavelet, if any.
+    """
+    self._blips = blips
+    self._parents = {}
+    self._children = {}
+    self._roots = []
+    self._depths = {}
+    self._sizes = {}
+    all_blips = [blips[blip_id] for blip_id in blips]
+    # parents are taken from the children, the lists of children from the
+    # parents, where one side is missing the other fills it in
+    for ablip in all_blips:
+      for child_id in ablip._child_blip_order:
+        if child_id in blips:
+          self._parents.setdefault(child_id, ablip.blip_id)
+    for ablip in all_blips:
+      if ablip.parent_blip_id in blips:
+        self._parents[ablip.blip_id] = ablip.parent_blip_id
+      self._children[ablip.blip_id] = []
+    for ablip in all_blips:
+      for child_id in ablip._child_blip_order:
+        if self._parents.get(child_id) == ablip.blip_id:
+          self._children[ablip.blip_id].append(child_id)
+    unlisted = []
+    for ablip in all_blips:
+      parent_id = self._parents.get(ablip.blip_id)
+      if parent_id is None:
+        if ablip.blip_id != root_blip_id:
+          unlisted.append((ablip.blip_id, None))
+      elif ablip.blip_id not in self._children[parent_id]:
+        unlisted.append((ablip.blip_id, parent_id))
+    if root_blip_id in self._children:
+      self._roots.append(root_blip_id)
+    unlisted.sort()
+    for blip_id, parent_id in unlisted:
+      self._siblings(parent_id).append(blip_id)
+
+  def _siblings(self, parent_id):
+    if parent_id is None:
+      return self._roots
+    return self._children[parent_id]
+
+  def _add(self, blip_id, parent_id):
+    """Adds a blip as the last child of parent_id or at the top level."""
+    if blip_id in self._children:
+      return
+    if parent_id not in self._children:
+      parent_id = None
+    if parent_id is not None:
+      self._parents[blip_id] = parent_id
+    self._children[blip_id] = []
+    self._siblings(parent_id).append(blip_id)
+    self._sizes.clear()
+
+  def _remove(self, blip_id):
+    """Removes a blip, its children take its place under its parent."""
+    if blip_id not in self._children:
+      return
+    parent_id = self._parents.pop(blip_id, None)
+    children = self._children.pop(blip_id)
+    for child_id in children:
+      if parent_id is None:
+        del self._parents[child_id]
+      else:
+        self._parents[child_id] = parent_id
+    siblings = self._siblings(parent_id)
+    index = siblings.index(blip_id)
+    siblings[index:index + 1] = children
+    self._depths.clear()
+    self._sizes.clear()
+
+  def __len__(self):
+    return len(self._children)
+
+  def __contains__(self, blip_or_id):
+    return _blip_id(blip_or_id) in self._children
+
+  def roots(self):
+    """Returns the blips at the top level of the conversation in order."""
+    return [self._blips[blip_id] for blip_id in self._roots]
+
+  def parent(self, blip_or_id):
+    """Returns the parent blip, or None for a blip at the top level."""
+    parent_id = self._parents.get(_blip_id(blip_or_id))
+    if parent_id is None:
+      return None
+    return self._blips[parent_id]
+
+  def children(self, blip_or_id):
+    """Returns the child blips in order."""
+    return [self._blips[child_id]
+            for child_id in self._children[_blip_id(blip_or_id)]]
+
+  def depth(self, blip_or_id):
+    """Returns the number of ancestors of a blip, 0 at the top level."""
+    blip_id = _blip_id(blip_or_id)
+    if blip_id not in self._children:
+      raise KeyError(blip_id)
+    path = []
+    while blip_id is not None and blip_id not in self._depths:
+      path.append(blip_id)
+      blip_id = self._parents.get(blip_id)
+    depth = self._depths.get(blip_id, -1)
+    for blip_id in reversed(path):
+      depth += 1
+      self._depths[blip_id] = depth
+    return depth
+
+  def subtree_size(self, blip_or_id):
+    """Returns the number of blips in the thread of a blip, itself included."""
+    blip_id = _blip_id(blip_or_id)
+    res = self._sizes.get(blip_id)
+    if res is None:
+      for child_id in self._post_order(blip_id):
+        self._sizes[child_id] = 1 + sum([self._sizes[grandchild_id]
+                                         for grandchild_id
+                                         in self._children[child_id]])
+      res = self._sizes[blip_id]
+    return res
+
+  def _post_order(self, blip_id):
+    """Returns the ids of the thread of blip_id with children first."""
+    res = []
+    stack = [blip_id]
+    while stack:
+      blip_id = stack.pop()
+      if blip_id in self._sizes:
+        continue
+      res.append(blip_id)
+      stack.extend(self._children[blip_id])
+    res.reverse()
+    return res
+
+  def _start(self, blip_or_id):
+    if blip_or_id is None:
+      return list(self._roots)
+    blip_id = _blip_id(blip_or_id)
+    if blip_id not in self._children:
+      raise KeyError(blip_id)
+    return [blip_id]
+
+  def depth_first(self, blip_or_id=None):
+    """Iterates over the blips in document order.
+
+    Args:
+      blip_or_id: the blip whose thread to walk, or None for the whole
+          conversation.
+    """
+    stack = self._start(blip_or_id)
+    stack.reverse()
+    while stack:
+      blip_id = stack.pop()
+      yield self._blips[blip_id]
+      children = self._children[blip_id]
+      for index in xrange(len(children) - 1, -1, -1):
+        stack.append(children[index])
+
+  def breadth_first(self, blip_or_id=None):
+    """Iterates over the blips level by level, each level in order.
+
+    Args:
+      blip_or_id: the blip whose thread to walk, or None for the whole
+          conversation.
+    """
+    queue = self._start(blip_or_id)
+    head = 0
+    while head < len(queue):
+      blip_id = queue[head]
+      head += 1
+      yield self._blips[blip_id]
+      queue.extend(self._children[blip_id])
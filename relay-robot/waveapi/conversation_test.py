@@ -0,0 +1,108 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the conversation module."""
+
+
+import unittest
+
+import blip
+import conversation
+import ops
+
+# blip id -> (parent id, child ids)
+TEST_TREE = {
+    'root': (None, ['b', 'a']),
+    'a': ('root', ['a1']),
+    'a1': ('a', []),
+    'b': ('root', []),
+    # a reply its parent does not know about yet
+    'c': ('root', []),
+    'top': (None, []),
+}
+
+
+def make_blips(tree):
+  operation_queue = ops.OperationQueue()
+  blips = blip.Blips({})
+  for blip_id, (parent_id, child_ids) in tree.items():
+    blips._add(blip.Blip({'blipId': blip_id,
+                          'parentBlipId': parent_id,
+                          'childBlipIds': child_ids,
+                          'content': '\n' + blip_id,
+                          'waveId': 'test.com!w+1',
+                          'waveletId': 'test.com!conv+root'},
+                         blips, operation_queue))
+  return blips
+
+
+def ids(blips):
+  return [ablip.blip_id for ablip in blips]
+
+
+class TestConversation(unittest.TestCase):
+  """Tests the conversation index."""
+
+  def setUp(self):
+    self.blips = make_blips(TEST_TREE)
+    self.conversation = conversation.Conversation(self.blips, 'root')
+
+  def testStructure(self):
+    conv = self.conversation
+    self.assertEquals(6, len(conv))
+    self.assertTrue('a1' in conv)
+    self.assertTrue(self.blips['a'] in conv)
+    self.assertEquals(['root', 'top'], ids(conv.roots()))
+    self.assertEquals(['b', 'a', 'c'], ids(conv.children('root')))
+    self.assertTrue(conv.parent('a1') is self.blips['a'])
+    self.assertEquals(None, conv.parent(self.blips['root']))
+    self.assertEquals(0, conv.depth('root'))
+    self.assertEquals(2, conv.depth('a1'))
+    self.assertEquals(5, conv.subtree_size('root'))
+    self.assertEquals(2, conv.subtree_size('a'))
+    self.assertRaises(KeyError, conv.depth, 'unknown')
+
+  def testTraversal(self):
+    conv = self.conversation
+    self.assertEquals(['root', 'b', 'a', 'a1', 'c', 'top'],
+                      ids(conv.depth_first()))
+    self.assertEquals(['root', 'top', 'b', 'a', 'c', 'a1'],
+                      ids(conv.breadth_first()))
+    self.assertEquals(['a', 'a1'], ids(conv.depth_first('a')))
+    self.assertEquals(['a1'], ids(conv.breadth_first(self.blips['a1'])))
+
+  def testMaintainedByModel(self):
+    self.blips._conversation = self.conversation
+    conv = self.conversation
+    self.assertEquals(5, conv.subtree_size('root'))
+    reply = self.blips['a1'].reply()
+    self.assertTrue(conv.parent(reply) is self.blips['a1'])
+    self.assertEquals(3, conv.depth(reply))
+    self.assertEquals(6, conv.subtree_size('root'))
+    inline = self.blips['b'].insert_inline_blip(1)
+    self.assertEquals([inline], conv.children('b'))
+    self.blips._remove_with_id('a')
+    self.assertEquals(['b', 'a1', 'c'], ids(conv.children('root')))
+    self.assertEquals(1, conv.depth('a1'))
+    self.assertEquals(['root', 'b', inline.blip_id, 'a1', reply.blip_id, 'c',
+                       'top'], ids(conv.depth_first()))
+    self.blips._remove_with_id('root')
+    self.assertEquals(['b', 'a1', 'c', 'top'], ids(conv.roots()))
+    self.assertEquals(None, conv.parent('b'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -35,8 +35,18 @@ class Element(object):
   Properties of elements are both accessible directly (image.url) and through
   the properties dictionary (image.properties['url']). In general Element
   should not be instantiated by robots, but rather rely on the derived classes.
+
+  The properties are kept in a single dictionary. Elements decoded from the
+  same bundle with identical properties share that dictionary; it is copied
+  the first time one of them is changed.
+
+  Changes to an element in a blip are reported to the blip's elements, so
+  cached searches and serializations of the blip are invalidated.
   """
 
+  __slots__ = ('_type', '_properties', '_shared', '_operation_queue',
+               '_container')
+
   def __init__(self, element_type, **properties):
     """Initializes self with the specified type and any properties.
 
@@ -51,28 +61,89 @@ class Element(object):
     """
     if len(properties) == 1 and 'properties' in properties:
       properties = properties['properties']
-    self.type = element_type
+    self._type = element_type
     # as long as the operation_queue of an element in None, it is
     # unattached. After an element is acquired by a blip, the blip
     # will set the operation_queue to make sure all changes to the
     # element are properly send to the server.
     self._operation_queue = None
-    for key, val in properties.items():
-      setattr(self, key, val)
+    self._properties = dict(properties)
+    self._shared = False
+    # the blip.Elements this element is in, if any
+    self._container = None
+
+  # Derived classes override this with the type string.
+  type = property(lambda self: self._type)
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    try:
+      return self._properties[name]
+    except KeyError:
+      raise AttributeError(name)
+
+  def __setattr__(self, name, value):
+    if name.startswith('_'):
+      object.__setattr__(self, name, value)
+    else:
+      self._set_property(name, value)
+      if self._container is not None:
+        self._container._element_changed()
+
+  def _set_property(self, name, value):
+    """Sets a property without reporting the change."""
+    if name == 'type':
+      self._type = value
+    else:
+      if self._shared:
+        self._properties = dict(self._properties)
+        self._shared = False
+      self._properties[name] = value
+
+  def __copy__(self):
+    res = self.__class__.__new__(self.__class__)
+    res._type = self._type
+    res._operation_queue = self._operation_queue
+    res._properties = self._properties
+    res._container = None
+    # both copies now copy the properties before changing them
+    res._shared = True
+    self._shared = True
+    return res
+
+  @property
+  def properties(self):
+    """A copy of the properties of this element."""
+    return dict(self._properties)
+
+  def _share_properties(self, interner):
+    """Replaces the properties by an equal dictionary shared via interner."""
+    shared = interner.share_properties(self._type, self._properties)
+    if shared is not None:
+      self._properties = shared
+      self._shared = True
 
   @classmethod
-  def from_json(cls, json):
-    """Class method to instantiate an Element based on a json string."""
+  def from_json(cls, json, interner=None):
+    """Class method to instantiate an Element based on a json string.
+
+    If an util.Interner is passed, elements with the same properties share
+    their properties dictionary.
+    """
     etype = json['type']
-    logging.info('constructing: ' + str(json))
+    logging.debug('constructing: %s', json)
     props = json['properties'].copy()
 
     element_class = ALL.get(etype)
     if not element_class:
       # Unknown type. Server could be newer than we are
-      return Element(element_type=etype, properties=props)
-
-    return element_class.from_props(props)
+      res = Element(element_type=etype, properties=props)
+    else:
+      res = element_class.from_props(props)
+    if interner is not None:
+      res._share_properties(interner)
+    return res
 
   def get(self, key, default=None):
     """Standard get interface"""
@@ -85,20 +156,14 @@ class Element(object):
     properties.
     """
     props = {}
-    data = {}
-    for attr in dir(self):
-      if attr.startswith('_'):
-        continue
-      val = getattr(self, attr)
+    for attr, val in self._properties.iteritems():
       if val is None or callable(val):
         continue
-      val = util.serialize(val)
-      if attr == 'type':
-        data[attr] = val
-      else:
-        props[attr] = val
-    data['properties'] = util.serialize(props)
-    return data
+      props[util.default_keywriter(attr)] = util.serialize(val)
+    return {'type': self.type,
+            'properties': props}
+
+util.register_serializer(Element, Element.serialize)
 
 
 class Input(Element):
@@ -106,6 +171,8 @@ class Input(Element):
 
   type = 'INPUT'
 
+  __slots__ = ()
+
   def __init__(self, name, value='', label=''):
     super(Input, self).__init__(Input.type,
           name=name, value=value, default_value=value, label=label)
@@ -120,6 +187,8 @@ class Check(Element):
 
   type = 'CHECK'
 
+  __slots__ = ()
+
   def __init__(self, name, value=''):
     super(Check, self).__init__(Check.type,
           name=name, value=value, default_value=value)
@@ -134,6 +203,8 @@ class Button(Element):
 
   type = 'BUTTON'
 
+  __slots__ = ()
+
   def __init__(self, name, caption):
     super(Button, self).__init__(Button.type,
           name=name, value=caption)
@@ -148,6 +219,8 @@ class Label(Element):
 
   type = 'LABEL'
 
+  __slots__ = ()
+
   def __init__(self, label_for, caption):
     super(Label, self).__init__(Label.type,
           name=label_for, value=caption)
@@ -162,6 +235,8 @@ class RadioButton(Element):
 
   type = 'RADIO_BUTTON'
 
+  __slots__ = ()
+
   def __init__(self, name, group):
     super(RadioButton, self).__init__(RadioButton.type,
           name=name, value=group)
@@ -176,6 +251,8 @@ class RadioButtonGroup(Element):
 
   type = 'RADIO_BUTTON_GROUP'
 
+  __slots__ = ()
+
   def __init__(self, name, value):
     super(RadioButtonGroup, self).__init__(RadioButtonGroup.type,
           name=name, value=value)
@@ -190,6 +267,8 @@ class Password(Element):
 
   type = 'PASSWORD'
 
+  __slots__ = ()
+
   def __init__(self, name, value):
     super(Password, self).__init__(Password.type,
           name=name, value=value)
@@ -204,6 +283,8 @@ class TextArea(Element):
 
   type = 'TEXTAREA'
 
+  __slots__ = ()
+
   def __init__(self, name, value):
     super(TextArea, self).__init__(TextArea.type,
           name=name, value=value)
@@ -215,9 +296,11 @@ class TextArea(Element):
 
 class Gadget(Element):
   """a Gadget element within the content of a document."""
-  
+
   type = 'GADGET'
 
+  __slots__ = ()
+
   def __init__(self, url, props=None):
     if props is None:
       props = {}
@@ -234,6 +317,8 @@ class Image(Element):
 
   type = 'IMAGE'
 
+  __slots__ = ()
+
   def __init__(self, url='', width=None, height=None,
       attachmentId=None, caption=None):
     super(Image, self).__init__(Image.type, url=url, width=width,
@@ -243,7 +328,6 @@ class Image(Element):
   def from_props(cls, props):
     props = dict([(key.encode('utf-8'), value)
                   for key, value in props.items()])
-    logging.info('from_props=' + str(props))
     return apply(Image, [], props)
 
 
@@ -252,7 +336,7 @@ def is_element(cls):
   try:
     if not issubclass(cls, Element):
       return False
-    return hasattr(cls, 'type')
+    return isinstance(getattr(cls, 'type', None), basestring)
   except TypeError:
     return False
 
@@ -17,6 +17,7 @@
 """Unit tests for the element module."""
 
 
+import copy
 import unittest
 
 import element
@@ -131,5 +132,23 @@ class TestElement(unittest.TestCase):
     self.assertEquals(types_required, types_constructed)
 
 
+  def testSharedProperties(self):
+    interner = util.Interner()
+    json = {'type': 'GADGET',
+            'properties': {'url': 'http://test.com/gadget.xml', 'title': 't'}}
+    first = element.Element.from_json(json, interner)
+    second = element.Element.from_json(json, interner)
+    self.assertFalse(hasattr(first, '__dict__'))
+    self.assertTrue(first._properties is second._properties)
+    second.title = 'changed'
+    self.assertEquals('t', first.title)
+    self.assertEquals('changed', second.title)
+    self.assertEquals('changed', second.properties['title'])
+    copied = copy.copy(first)
+    copied.url = 'http://test.com/other.xml'
+    self.assertEquals('http://test.com/gadget.xml', first.url)
+    self.assertEquals(element.Gadget.type, copied.type)
+    self.assertRaises(AttributeError, getattr, first, 'missing')
+
 if __name__ == '__main__':
   unittest.main()
@@ -24,6 +24,8 @@ properties depending on the type.
 import inspect
 import sys
 
+import util
+
 class Event(object):
   """Object describing a single event.
 
@@ -40,6 +42,9 @@ class Event(object):
 
   """
 
+  __slots__ = ('modified_by', 'timestamp', '_type', '_raw_data', 'properties',
+               'blip_id', 'blip')
+
   def __init__(self, json, wavelet):
     """Inits this event with JSON data.
 
@@ -48,12 +53,25 @@ class Event(object):
     """
     self.modified_by = json.get('modifiedBy')
     self.timestamp = json.get('timestamp', 0)
-    self.type = json.get('type')
-    self.raw_data = json
+    self._type = json.get('type')
+    self._raw_data = json
     self.properties = json.get('properties', {})
     self.blip_id = self.properties.get('blipId')
     self.blip = wavelet.blips.get(self.blip_id)
 
+  # Derived classes override this with the type string.
+  type = property(lambda self: self._type)
+
+  def _get_raw_data(self):
+    return util.decode_raw(self._raw_data)
+
+  def _set_raw_data(self, raw_data):
+    self._raw_data = raw_data
+
+  # The json of the event, decoded again on every access if it is kept as a
+  # util.RawJson.
+  raw_data = property(_get_raw_data, _set_raw_data)
+
 
 class WaveletBlipCreated(Event):
   """Event triggered when a new blip is created.
@@ -64,6 +82,8 @@ class WaveletBlipCreated(Event):
   """
   type = 'WAVELET_BLIP_CREATED'
 
+  __slots__ = ('new_blip_id', 'new_blip')
+
   def __init__(self, json, wavelet):
     super(WaveletBlipCreated, self).__init__(json, wavelet)
     self.new_blip_id = self.properties['newBlipId']
@@ -79,6 +99,8 @@ class WaveletBlipRemoved(Event):
   """
   type = 'WAVELET_BLIP_REMOVED'
 
+  __slots__ = ('removed_blip_id', 'removed_blip')
+
   def __init__(self, json, wavelet):
     super(WaveletBlipRemoved, self).__init__(json, wavelet)
     self.removed_blip_id = self.properties['removedBlipId']
@@ -88,6 +110,8 @@ class WaveletBlipRemoved(Event):
 class WaveletParticipantsChanged(Event):
   type = 'WAVELET_PARTICIPANTS_CHANGED'
 
+  __slots__ = ('participants_added', 'participants_removed')
+
   def __init__(self, json, wavelet):
     super(WaveletParticipantsChanged, self).__init__(json, wavelet)
     self.participants_added = self.properties['participantsAdded']
@@ -99,12 +123,16 @@ class WaveletSelfAdded(Event):
   """
   type = 'WAVELET_SELF_ADDED'
 
+  __slots__ = ()
+
 
 class WaveletSelfRemoved(Event):
   """Event triggered when the robot is removed from the wavelet.
   """
   type = 'WAVELET_SELF_REMOVED'
 
+  __slots__ = ()
+
 
 class WaveletTitleChanged(Event):
   """Event triggered when the title of the wavelet has changed.
@@ -114,6 +142,8 @@ class WaveletTitleChanged(Event):
   """
   type = 'WAVELET_TITLE_CHANGED'
 
+  __slots__ = ('title',)
+
   def __init__(self, json, wavelet):
     super(WaveletTitleChanged, self).__init__(json, wavelet)
     self.title = self.properties['title']
@@ -128,6 +158,8 @@ class BlipContributorsChanged(Event):
   """
   type = 'BLIP_CONTRIBUTORS_CHANGED'
 
+  __slots__ = ('contibutors_added', 'contibutors_removed')
+
   def __init__(self, json, wavelet):
     super(BlipContributorsChanged, self).__init__(json, wavelet)
     self.contibutors_added = self.properties['contributorsAdded']
@@ -139,6 +171,8 @@ class BlipSubmitted(Event):
   """
   type = 'BLIP_SUBMITTED'
 
+  __slots__ = ()
+
 
 class DocumentChanged(Event):
   """Event triggered when a document is changed.
@@ -149,6 +183,8 @@ class DocumentChanged(Event):
   """
   type = 'DOCUMENT_CHANGED'
 
+  __slots__ = ()
+
 
 class FormButtonClicked(Event):
   """Event triggered when a form button is clicked.
@@ -158,6 +194,8 @@ class FormButtonClicked(Event):
   """
   type = 'FORM_BUTTON_CLICKED'
 
+  __slots__ = ('button_name',)
+
   def __init__(self, json, wavelet):
     super(FormButtonClicked, self).__init__(json, wavelet)
     self.button_name = self.properties['button']
@@ -172,6 +210,8 @@ class GadgetStateChanged(Event):
   """
   type = 'GADGET_STATE_CHANGED'
 
+  __slots__ = ('index', 'old_state')
+
   def __init__(self, json, wavelet):
     super(GadgetStateChanged, self).__init__(json, wavelet)
     self.index = self.properties['index']
@@ -190,6 +230,8 @@ class AnnotatedTextChanged(Event):
   """
   type = 'ANNOTATED_TEXT_CHANGED'
 
+  __slots__ = ('name', 'value')
+
   def __init__(self, json, wavelet):
     super(AnnotatedTextChanged, self).__init__(json, wavelet)
     self.name = self.properties['name']
@@ -205,6 +247,8 @@ class OperationError(Event):
   """
   type = 'OPERATION_ERROR'
 
+  __slots__ = ('operation_id', 'error_message')
+
   def __init__(self, json, wavelet):
     super(OperationError, self).__init__(json, wavelet)
     self.operation_id = self.properties['operationId']
@@ -220,6 +264,8 @@ class OperationError(Event):
   """
   type = 'OPERATION_ERROR'
 
+  __slots__ = ('operation_id', 'error_message')
+
   def __init__(self, json, wavelet):
     super(OperationError, self).__init__(json, wavelet)
     self.operation_id = self.properties['operationId']
@@ -237,13 +283,18 @@ class WaveletCreated(Event):
 
   Attributes:
     message: whatever string was passed into the new_wave
-        call as message.
+        call as message. If the robot kept it in a message store,
+        it is looked up there.
   """
   type = 'WAVELET_CREATED'
 
+  __slots__ = ('message',)
+
   def __init__(self, json, wavelet):
     super(WaveletCreated, self).__init__(json, wavelet)
     self.message = self.properties['message']
+    if wavelet.robot is not None:
+      self.message = wavelet.robot.resolve_message(self.message)
 
 
 class WaveletFetched(Event):
@@ -259,6 +310,8 @@ class WaveletFetched(Event):
   """
   type = 'WAVELET_FETCHED'
 
+  __slots__ = ('message',)
+
   def __init__(self, json, wavelet):
     super(WaveletFetched, self).__init__(json, wavelet)
     self.message = self.properties['message']
@@ -269,7 +322,7 @@ def is_event(cls):
   try:
     if not issubclass(cls, Event):
       return False
-    return hasattr(cls, 'type')
+    return isinstance(getattr(cls, 'type', None), basestring)
   except TypeError:
     return False
 
@@ -0,0 +1,300 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Defines the IntervalTree class used to store annotations of a blip.
+
+An IntervalTree holds the ranges of a single annotation name. These never
+overlap (they can touch), so sorted on start they are also sorted on end.
+The ranges are kept in a treap ordered on start. Moving all ranges after
+some position is done by splitting the tree and tagging the right part
+with a pending offset that is pushed down lazily, so inserts, deletes,
+shifts and lookups all cost O(log n) plus the number of ranges touched.
+"""
+
+import random
+
+
+class _Node(object):
+  """A single range in the tree."""
+
+  __slots__ = ('start', 'end', 'value', 'priority', 'left', 'right', 'lazy',
+               'size')
+
+  def __init__(self, start, end, value):
+    self.start = start
+    self.end = end
+    self.value = value
+    self.priority = random.random()
+    self.left = None
+    self.right = None
+    self.lazy = 0
+    self.size = 1
+
+
+def _size(node):
+  if node is None:
+    return 0
+  return node.size
+
+
+def _update(node):
+  node.size = 1 + _size(node.left) + _size(node.right)
+
+
+def _move(node, inc):
+  """Moves all ranges in the subtree of node by inc."""
+  if node is not None:
+    node.start += inc
+    node.end += inc
+    node.lazy += inc
+
+
+def _push(node):
+  """Pushes the pending offset of node down to its children."""
+  if node.lazy:
+    _move(node.left, node.lazy)
+    _move(node.right, node.lazy)
+    node.lazy = 0
+
+
+def _merge(left, right):
+  """Merges two trees, with all ranges of left before those of right."""
+  if left is None:
+    return right
+  if right is None:
+    return left
+  if left.priority > right.priority:
+    _push(left)
+    left.right = _merge(left.right, right)
+    _update(left)
+    return left
+  _push(right)
+  right.left = _merge(left, right.left)
+  _update(right)
+  return right
+
+
+def _split(node, pred):
+  """Splits a tree in the ranges for which pred holds and the rest.
+
+  pred has to be monotone over the ranges in order: true for a (possibly
+  empty) prefix and false for the remainder.
+  """
+  if node is None:
+    return None, None
+  _push(node)
+  if pred(node):
+    node.right, right = _split(node.right, pred)
+    _update(node)
+    return node, right
+  left, node.left = _split(node.left, pred)
+  _update(node)
+  return left, node
+
+
+def _in_order(node):
+  """Returns the nodes of a tree in order, with all offsets applied."""
+  res = []
+  stack = []
+  while stack or node is not None:
+    if node is not None:
+      _push(node)
+      stack.append(node)
+      node = node.left
+    else:
+      node = stack.pop()
+      res.append(node)
+      node = node.right
+  return res
+
+
+def _build(nodes):
+  """Builds a tree out of a list of detached nodes in order."""
+  res = None
+  for node in nodes:
+    node.left = None
+    node.right = None
+    node.lazy = 0
+    node.size = 1
+    res = _merge(res, node)
+  return res
+
+
+def _shift_positions(positions, shifts):
+  """Maps sorted positions through shifts, see IntervalTree.shift_many."""
+  # Per shift: its low end, where, the final position of everything that
+  # collapses onto the low end and the total offset up to and including it.
+  bounds = []
+  offset = 0
+  last_where = None
+  target = None
+  for where, inc in shifts:
+    low = min(where, where + inc)
+    if low != last_where:
+      target = low + offset
+    # else low lands on the previous where, which ends up at that target
+    offset += inc
+    bounds.append((low, where, target, offset))
+    last_where = where
+  res = []
+  k = 0
+  for position in positions:
+    while k < len(bounds) and bounds[k][0] < position:
+      k += 1
+    if not k:
+      res.append(position)
+      continue
+    low, where, target, offset = bounds[k - 1]
+    if position <= where:
+      res.append(target)
+    else:
+      res.append(position + offset)
+  return res
+
+
+class IntervalTree(object):
+  """The ranges and values of a single annotation name."""
+
+  def __init__(self):
+    self._root = None
+
+  def __len__(self):
+    return _size(self._root)
+
+  def __iter__(self):
+    """Iterates over (start, end, value) tuples sorted on start."""
+    for node in _in_order(self._root):
+      yield node.start, node.end, node.value
+
+  def overlapping(self, start, end):
+    """Iterates over the (start, end, value) tuples overlapping start..end.
+
+    A range overlaps if it shares at least one position with start..end,
+    i.e. a range that just touches start or end does not count.
+    """
+    stack = []
+    node = self._root
+    # descend to the first range that ends after start, remembering the
+    # ranges that come after it on the way
+    while node is not None:
+      _push(node)
+      if node.end > start:
+        stack.append(node)
+        node = node.left
+      else:
+        node = node.right
+    while stack:
+      node = stack.pop()
+      if node.start >= end:
+        return
+      yield node.start, node.end, node.value
+      node = node.right
+      while node is not None:
+        _push(node)
+        stack.append(node)
+        node = node.left
+
+  def _extract(self, start, end):
+    """Splits off the ranges that overlap or touch start..end.
+
+    Returns:
+      A tuple of the tree before, the nodes in order and the tree after.
+    """
+    left, rest = _split(self._root, lambda n: n.end < start)
+    middle, right = _split(rest, lambda n: n.start <= end)
+    return left, _in_order(middle), right
+
+  def set(self, start, end, value):
+    """Sets value on start..end.
+
+    Ranges with the same value that overlap or touch are merged with the
+    new range, ranges with a different value are cut back.
+    """
+    left, touched, right = self._extract(start, end)
+    pieces = []
+    for node in touched:
+      if node.value == value:
+        start = min(node.start, start)
+        end = max(node.end, end)
+      else:
+        if node.start < start:
+          pieces.append(_Node(node.start, start, node.value))
+        if node.end > end:
+          pieces.append(_Node(end, node.end, node.value))
+    pieces.append(_Node(start, end, value))
+    pieces.sort(key=lambda node: node.start)
+    self._root = _merge(_merge(left, _build(pieces)), right)
+
+  def clear(self, start, end):
+    """Removes the ranges or parts of ranges within start..end."""
+    left, touched, right = self._extract(start, end)
+    pieces = []
+    for node in touched:
+      if start < node.start and end > node.end:
+        continue
+      if node.start < start:
+        pieces.append(_Node(node.start, start, node.value))
+      if node.end > end:
+        pieces.append(_Node(end, node.end, node.value))
+    self._root = _merge(_merge(left, _build(pieces)), right)
+
+  def shift(self, where, inc):
+    """Adjusts the ranges for inc characters inserted or removed at where.
+
+    For a positive inc, positions after where move up by inc. For a
+    negative inc the characters from where + inc up to where were removed:
+    positions in that stretch collapse onto where + inc, positions after
+    it move down. Ranges that end up empty are dropped.
+    """
+    if not inc:
+      return
+    low = min(where, where + inc)
+    left, rest = _split(self._root, lambda n: n.start <= low)
+    middle, right = _split(rest, lambda n: n.start <= where)
+    _move(right, inc)
+    left, straddling = _split(left, lambda n: n.end <= low)
+    kept = []
+    for node in _in_order(straddling) + _in_order(middle):
+      if node.start > low:
+        node.start = low
+      if node.end > where:
+        node.end += inc
+      else:
+        node.end = low
+      if node.start < node.end or inc > 0:
+        kept.append(node)
+    self._root = _merge(_merge(left, _build(kept)), right)
+
+  def shift_many(self, shifts):
+    """Applies a number of shifts in a single pass over the ranges.
+
+    shifts is a list of (where, inc) tuples for edits that do not overlap,
+    sorted on where and in the positions from before any of them. The
+    result is the same as calling shift for each of them from right to left.
+    """
+    nodes = _in_order(self._root)
+    positions = []
+    for node in nodes:
+      positions.append(node.start)
+      positions.append(node.end)
+    positions = _shift_positions(positions, shifts)
+    kept = []
+    for i, node in enumerate(nodes):
+      node.start = positions[2 * i]
+      node.end = positions[2 * i + 1]
+      if node.start < node.end:
+        kept.append(node)
+    self._root = _build(kept)
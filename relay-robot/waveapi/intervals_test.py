@@ -0,0 +1,118 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the intervals module."""
+
+
+import random
+import unittest
+
+import intervals
+
+
+class TestIntervalTree(unittest.TestCase):
+  """Tests for the intervals.IntervalTree class."""
+
+  def testSetMergesAndCuts(self):
+    tree = intervals.IntervalTree()
+    tree.set(3, 6, 'bold')
+    tree.set(5, 8, 'bold')
+    self.assertEquals([(3, 8, 'bold')], list(tree))
+    tree.set(4, 12, 'italic')
+    self.assertEquals([(3, 4, 'bold'), (4, 12, 'italic')], list(tree))
+    tree.set(20, 22, 'bold')
+    self.assertEquals(3, len(tree))
+
+  def testClear(self):
+    tree = intervals.IntervalTree()
+    tree.set(4, 12, 'italic')
+    tree.clear(6, 7)
+    self.assertEquals([(4, 6, 'italic'), (7, 12, 'italic')], list(tree))
+    tree.clear(0, 20)
+    self.assertEquals(0, len(tree))
+
+  def testShift(self):
+    tree = intervals.IntervalTree()
+    tree.set(2, 4, 'a')
+    tree.set(6, 10, 'b')
+    tree.set(12, 14, 'c')
+    tree.shift(3, 5)
+    self.assertEquals([(2, 9, 'a'), (11, 15, 'b'), (17, 19, 'c')], list(tree))
+    # remove the characters 8..12
+    tree.shift(12, -4)
+    self.assertEquals([(2, 8, 'a'), (8, 11, 'b'), (13, 15, 'c')], list(tree))
+    # remove everything covered by 'b'
+    tree.shift(11, -3)
+    self.assertEquals([(2, 8, 'a'), (10, 12, 'c')], list(tree))
+
+  def testShiftMany(self):
+    generator = random.Random(11)
+    for _ in range(200):
+      one_by_one = intervals.IntervalTree()
+      at_once = intervals.IntervalTree()
+      for _ in range(generator.randint(0, 8)):
+        start = generator.randint(0, 40)
+        end = start + generator.randint(1, 6)
+        value = generator.randint(0, 2)
+        one_by_one.set(start, end, value)
+        at_once.set(start, end, value)
+      # replace a few stretches that do not overlap, possibly touching
+      shifts = []
+      end = 0
+      for _ in range(generator.randint(1, 6)):
+        start = end + generator.randint(0, 5)
+        end = start + generator.randint(0, 4)
+        shifts.append((end, generator.randint(0, 5) + start - end))
+      for where, inc in reversed(shifts):
+        one_by_one.shift(where, inc)
+      at_once.shift_many(shifts)
+      self.assertEquals(list(one_by_one), list(at_once))
+
+  def testOverlapping(self):
+    tree = intervals.IntervalTree()
+    tree.set(2, 4, 'a')
+    tree.set(6, 10, 'b')
+    tree.set(12, 14, 'c')
+    tree.shift(0, 1)
+    self.assertEquals([(7, 11, 'b')], list(tree.overlapping(8, 9)))
+    self.assertEquals([(3, 5, 'a'), (7, 11, 'b')],
+                      list(tree.overlapping(4, 8)))
+    # touching ranges do not overlap
+    self.assertEquals([], list(tree.overlapping(11, 13)))
+    self.assertEquals(3, len(list(tree.overlapping(0, 100))))
+
+  def testManyRanges(self):
+    tree = intervals.IntervalTree()
+    generator = random.Random(7)
+    for i in range(2000):
+      start = generator.randint(0, 10000)
+      tree.set(start, start + generator.randint(1, 10), generator.randint(0, 3))
+      if i % 10 == 0:
+        tree.shift(generator.randint(0, 10000), generator.randint(-5, 5))
+    ranges = list(tree)
+    self.assertEquals(len(ranges), len(tree))
+    for (start, end, value), (next_start, next_end, next_value) in zip(
+        ranges, ranges[1:]):
+      self.assertTrue(start < end <= next_start)
+    for i in range(100):
+      start = generator.randint(0, 10000)
+      end = start + generator.randint(1, 50)
+      expected = [r for r in ranges if r[0] < end and r[1] > start]
+      self.assertEquals(expected, list(tree.overlapping(start, end)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,204 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stores for the messages passed to Robot.new_wave.
+
+A message is sent along with the wavelet.create operation and comes back
+in the WaveletCreated event. Rather than sending large messages around, a
+store keeps them locally and only a short key is sent. See
+Robot.set_message_store.
+"""
+
+import heapq
+import os
+import re
+import threading
+import time
+
+# Keys handed out by the stores start with this, anything else is a message
+# that was sent as is.
+KEY_PREFIX = 'msgstore:'
+
+_KEY_RE = re.compile('^' + KEY_PREFIX + '[0-9a-f]{24}$')
+
+DEFAULT_MAX_ENTRIES = 1000
+# Seconds after which a message is forgotten.
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+def is_key(message):
+  """Returns whether message is a key handed out by a store."""
+  return isinstance(message, basestring) and bool(_KEY_RE.match(message))
+
+
+def _new_key():
+  return KEY_PREFIX + os.urandom(12).encode('hex')
+
+
+class MessageStore(object):
+  """Abstract interface of the message stores.
+
+  Subclasses implement put and get.
+  """
+
+  def put(self, message):
+    """Stores a message string and returns the key to send instead."""
+    raise NotImplementedError()
+
+  def get(self, key):
+    """Returns the message stored under key, or None if it is not known.
+
+    Messages are not known anymore once they expire or are pushed out by
+    newer ones.
+    """
+    raise NotImplementedError()
+
+
+class MemoryMessageStore(MessageStore):
+  """Keeps messages in memory, useful if events come back to this process.
+
+  Past max_entries the oldest messages are dropped.
+  """
+
+  def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+               max_age=DEFAULT_MAX_AGE, clock=time.time):
+    self._max_entries = max_entries
+    self._max_age = max_age
+    self._clock = clock
+    # key -> (expiry time, message)
+    self._messages = {}
+    # keys in the order they were stored
+    self._order = []
+    self._lock = threading.Lock()
+
+  def put(self, message):
+    key = _new_key()
+    self._lock.acquire()
+    try:
+      self._messages[key] = (self._clock() + self._max_age, message)
+      self._order.append(key)
+      self._expire()
+    finally:
+      self._lock.release()
+    return key
+
+  def _expire(self):
+    """Drops the oldest messages while there are too many or they expired."""
+    now = self._clock()
+    drop = 0
+    while drop < len(self._order):
+      key = self._order[drop]
+      if (len(self._order) - drop <= self._max_entries and
+          self._messages[key][0] > now):
+        break
+      del self._messages[key]
+      drop += 1
+    del self._order[:drop]
+
+  def get(self, key):
+    entry = self._messages.get(key)
+    if entry is None or entry[0] <= self._clock():
+      return None
+    return entry[1]
+
+  def __len__(self):
+    return len(self._messages)
+
+
+class DiskMessageStore(MessageStore):
+  """Keeps messages as files in a directory.
+
+  This works across processes sharing the directory, so events may come
+  back to a different process than the one that created the wave.
+
+  The directory is listed once, when the store is created. From then on
+  the store keeps track of the files in memory, so expiring messages does
+  not touch the disk beyond removing files. Each process only counts and
+  expires the files it knows about.
+  """
+
+  def __init__(self, directory, max_entries=DEFAULT_MAX_ENTRIES,
+               max_age=DEFAULT_MAX_AGE, clock=time.time):
+    self._directory = directory
+    self._max_entries = max_entries
+    self._max_age = max_age
+    self._clock = clock
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    # heap of (mtime, path) of the stored files, oldest first
+    self._files = []
+    for name in os.listdir(directory):
+      if name.endswith('.tmp'):
+        continue
+      path = os.path.join(directory, name)
+      try:
+        self._files.append((os.path.getmtime(path), path))
+      except OSError:
+        # removed by another process in the meantime
+        pass
+    heapq.heapify(self._files)
+    self._lock = threading.Lock()
+
+  def _path(self, key):
+    return os.path.join(self._directory, key[len(KEY_PREFIX):])
+
+  def put(self, message):
+    if isinstance(message, unicode):
+      message = message.encode('utf-8')
+    key = _new_key()
+    path = self._path(key)
+    # written under another name first, so readers never see half a message
+    f = open(path + '.tmp', 'wb')
+    try:
+      f.write(message)
+    finally:
+      f.close()
+    os.rename(path + '.tmp', path)
+    now = self._clock()
+    os.utime(path, (now, now))
+    self._lock.acquire()
+    try:
+      heapq.heappush(self._files, (now, path))
+      self._expire()
+    finally:
+      self._lock.release()
+    return key
+
+  def _expire(self):
+    """Removes expired messages and the oldest ones past max_entries."""
+    oldest = self._clock() - self._max_age
+    files = self._files
+    while files and (len(files) > self._max_entries or files[0][0] <= oldest):
+      mtime, path = heapq.heappop(files)
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+  def get(self, key):
+    if not is_key(key):
+      return None
+    path = self._path(key)
+    try:
+      if os.path.getmtime(path) <= self._clock() - self._max_age:
+        return None
+      f = open(path, 'rb')
+    except (IOError, OSError):
+      return None
+    try:
+      return f.read().decode('utf-8')
+    finally:
+      f.close()
@@ -0,0 +1,137 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the message_store module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import message_store
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class TestMemoryMessageStore(unittest.TestCase):
+  """Tests the in memory store."""
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.store = message_store.MemoryMessageStore(max_entries=2, max_age=60,
+                                                  clock=self.clock)
+
+  def testPutAndGet(self):
+    key = self.store.put('{"some": "state"}')
+    self.assertTrue(message_store.is_key(key))
+    self.assertNotEqual(key, self.store.put('other'))
+    self.assertEquals('{"some": "state"}', self.store.get(key))
+    self.assertEquals(None, self.store.get('unknown'))
+
+  def testBounded(self):
+    first = self.store.put('first')
+    second = self.store.put('second')
+    third = self.store.put('third')
+    self.assertEquals(2, len(self.store))
+    self.assertEquals(None, self.store.get(first))
+    self.assertEquals('second', self.store.get(second))
+    self.assertEquals('third', self.store.get(third))
+
+  def testExpires(self):
+    first = self.store.put('first')
+    self.clock.now += 30
+    second = self.store.put('second')
+    self.clock.now += 40
+    self.assertEquals(None, self.store.get(first))
+    self.assertEquals('second', self.store.get(second))
+    self.store.put('third')
+    self.assertEquals(2, len(self.store))
+
+
+class TestDiskMessageStore(unittest.TestCase):
+  """Tests the store that keeps messages in files."""
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.directory = tempfile.mkdtemp()
+    self.store = message_store.DiskMessageStore(
+        os.path.join(self.directory, 'messages'), max_entries=2, max_age=60,
+        clock=self.clock)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testPutAndGet(self):
+    key = self.store.put(u'caf\xe9')
+    self.assertEquals(u'caf\xe9', self.store.get(key))
+    # another process sharing the directory sees the same messages
+    other = message_store.DiskMessageStore(
+        os.path.join(self.directory, 'messages'), clock=self.clock)
+    self.assertEquals(u'caf\xe9', other.get(key))
+    self.assertEquals(None, self.store.get(message_store.KEY_PREFIX +
+                                           '../../etc/passwd'))
+
+  def testBoundedAndExpires(self):
+    first = self.store.put('first')
+    self.clock.now += 10
+    second = self.store.put('second')
+    self.clock.now += 10
+    third = self.store.put('third')
+    self.assertEquals(None, self.store.get(first))
+    self.assertEquals('second', self.store.get(second))
+    self.clock.now += 55
+    self.assertEquals(None, self.store.get(second))
+    self.assertEquals('third', self.store.get(third))
+    self.store.put('fourth')
+    self.assertEquals(2, len(os.listdir(os.path.join(self.directory,
+                                                     'messages'))))
+
+  def testPutDoesNotListDirectory(self):
+    def listdir(path):
+      self.fail('listed %s' % path)
+    old_listdir = os.listdir
+    os.listdir = listdir
+    try:
+      for i in range(5):
+        self.store.put('message %d' % i)
+    finally:
+      os.listdir = old_listdir
+    self.assertEquals(2, len(os.listdir(os.path.join(self.directory,
+                                                     'messages'))))
+
+  def testKnowsExistingFiles(self):
+    first = self.store.put('first')
+    self.clock.now += 10
+    second = self.store.put('second')
+    reopened = message_store.DiskMessageStore(
+        os.path.join(self.directory, 'messages'), max_entries=2,
+        max_age=60, clock=self.clock)
+    self.clock.now += 10
+    reopened.put('third')
+    self.assertEquals(None, reopened.get(first))
+    self.assertEquals('second', reopened.get(second))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -20,8 +20,12 @@ Contains classes and utilities for creating operations that are to be
 applied on the server.
 """
 
+import array
+import copy
 import errors
 import logging
+import os
+import threading
 import util
 
 PROTOCOL_VERSION = '0.2'
@@ -74,6 +78,8 @@ class OpsRange(object):
   python API.
   """
 
+  __slots__ = ('start', 'end')
+
   def __init__(self, start, end):
     self.start = start
     self.end = end
@@ -86,6 +92,8 @@ class OpsAnnotation(object):
   found in the blip module.
   """
 
+  __slots__ = ('name', 'value', 'range')
+
   def __init__(self, name, value, r):
     self.name = name
     self.value = value
@@ -105,6 +113,8 @@ class Operation(object):
   model classes directly instead.
   """
 
+  __slots__ = ('method', 'id', 'params')
+
   def __init__(self, method, opid, params):
     """Initializes this operation with contextual data.
 
@@ -135,6 +145,478 @@ class Operation(object):
             'id': self.id,
             'params': util.serialize(self.params)}
 
+util.register_serializer(Operation, Operation.serialize)
+
+
+class ColumnarOperation(object):
+  """A view on a single operation stored in ColumnarOperations.
+
+  Behaves like an Operation, but reads from the columns of the store it
+  came from. Views are cheap and are not kept around by the store.
+
+  The params of a view are assembled from the columns on every access, so
+  changes to them are lost. Parameters have to be changed with set_param,
+  which writes through to the store.
+  """
+
+  __slots__ = ('_store', '_index')
+
+  def __init__(self, store, index):
+    self._store = store
+    self._index = index
+
+  @property
+  def method(self):
+    return self._store._method_at(self._index)
+
+  @property
+  def id(self):
+    return self._store._id_at(self._index)
+
+  @property
+  def params(self):
+    """Returns a copy of the parameters, see set_param to change them."""
+    return self._store._params_at(self._index)
+
+  def __str__(self):
+    return '%s[%s]%s' % (self.method, self.id, str(self.params))
+
+  def set_param(self, param, value):
+    self._store._set_param(self._index, param, value)
+
+  def serialize(self, method_prefix=''):
+    return self._store[self._index].serialize(method_prefix)
+
+
+class ColumnarOperations(object):
+  """Compact storage for a list of operations.
+
+  Instead of an Operation object with its own params dictionary per queued
+  operation, the method names, operation ids and the wave, wavelet and blip
+  ids are kept in parallel arrays. Strings are stored once in a string table
+  and referenced by index. Only the remaining, operation specific parameters
+  are kept as a (possibly absent) dictionary per operation.
+
+  Operations are expanded back into Operation instances when iterated over,
+  which typically only happens at serialization time.
+  """
+
+  # Parameters that are stored as references into the string table.
+  REF_PARAMS = ('waveId', 'waveletId', 'blipId', 'proxyingFor')
+
+  def __init__(self, opid_prefix='op'):
+    """Creates an empty store.
+
+    Args:
+      opid_prefix: operation ids of the form <opid_prefix><number> are
+          stored as the number alone.
+    """
+    self._opid_prefix = opid_prefix
+    self._strings = []
+    self._string_refs = {}
+    self._methods = array.array('l')
+    self._ids = array.array('l')
+    self._refs = [array.array('l') for _ in self.REF_PARAMS]
+    self._payloads = []
+
+  def _intern(self, value):
+    """Returns the index of value in the string table, adding it if needed."""
+    try:
+      return self._string_refs[value]
+    except KeyError:
+      ref = len(self._strings)
+      self._strings.append(value)
+      self._string_refs[value] = ref
+      return ref
+
+  def _encode_id(self, opid):
+    """Stores ids with the opid prefix as the number, others as -(ref+1)."""
+    if opid.startswith(self._opid_prefix):
+      number = opid[len(self._opid_prefix):]
+      if number.isdigit():
+        return int(number)
+    return -self._intern(opid) - 1
+
+  def add(self, method, opid, params):
+    """Adds an operation and returns a view on it.
+
+    Args:
+      method: Method to call or type of operation.
+      opid: The id of the operation.
+      params: An operation type dependent dictionary. The dictionary is not
+          retained, but split up over the columns.
+    Returns:
+      A ColumnarOperation for the newly added operation.
+    """
+    payload = None
+    refs = self._refs
+    ref_params = self.REF_PARAMS
+    for key, value in params.iteritems():
+      if key in ref_params:
+        continue
+      if payload is None:
+        payload = {}
+      payload[key] = value
+    for i in range(len(ref_params)):
+      key = ref_params[i]
+      if key in params:
+        refs[i].append(self._intern(params[key]))
+      else:
+        refs[i].append(-1)
+    self._methods.append(self._intern(method))
+    self._ids.append(self._encode_id(opid))
+    self._payloads.append(payload)
+    return ColumnarOperation(self, len(self._payloads) - 1)
+
+  def append(self, operation):
+    """Adds an existing operation to the store."""
+    self.add(operation.method, operation.id, operation.params)
+
+  def _method_at(self, index):
+    return self._strings[self._methods[index]]
+
+  def _id_at(self, index):
+    encoded = self._ids[index]
+    if encoded >= 0:
+      return '%s%d' % (self._opid_prefix, encoded)
+    return self._strings[-encoded - 1]
+
+  def _params_at(self, index):
+    payload = self._payloads[index]
+    if payload is None:
+      params = {}
+    else:
+      params = payload.copy()
+    strings = self._strings
+    ref_params = self.REF_PARAMS
+    for i in range(len(ref_params)):
+      ref = self._refs[i][index]
+      if ref != -1:
+        params[ref_params[i]] = strings[ref]
+    return params
+
+  def _set_param(self, index, param, value):
+    if param in self.REF_PARAMS:
+      self._refs[self.REF_PARAMS.index(param)][index] = self._intern(value)
+    else:
+      if self._payloads[index] is None:
+        self._payloads[index] = {}
+      self._payloads[index][param] = value
+
+  def __len__(self):
+    return len(self._payloads)
+
+  def __getitem__(self, index):
+    """Expands the operation at index into an Operation instance."""
+    if index < 0:
+      index += len(self)
+    if index < 0 or index >= len(self):
+      raise IndexError('operation index out of range')
+    return Operation(self._method_at(index),
+                     self._id_at(index),
+                     self._params_at(index))
+
+  def __iter__(self):
+    for index in xrange(len(self)):
+      yield self[index]
+
+  def assign(self, operations):
+    """Replaces the content of this store with operations."""
+    self.__init__()
+    for operation in operations:
+      self.append(operation)
+
+
+# Methods that only act on the content of a blip and can therefore be
+# dropped if the blip is deleted later on in the same queue.
+_BLIP_CONTENT_METHODS = frozenset([
+    BLIP_SET_AUTHOR,
+    BLIP_SET_CREATION_TIME,
+    DOCUMENT_ANNOTATION_DELETE,
+    DOCUMENT_ANNOTATION_SET,
+    DOCUMENT_ANNOTATION_SET_NORANGE,
+    DOCUMENT_APPEND,
+    DOCUMENT_APPEND_MARKUP,
+    DOCUMENT_APPEND_STYLED_TEXT,
+    DOCUMENT_INSERT,
+    DOCUMENT_DELETE,
+    DOCUMENT_REPLACE,
+    DOCUMENT_ELEMENT_APPEND,
+    DOCUMENT_ELEMENT_DELETE,
+    DOCUMENT_ELEMENT_INSERT,
+    DOCUMENT_ELEMENT_INSERT_AFTER,
+    DOCUMENT_ELEMENT_INSERT_BEFORE,
+    DOCUMENT_ELEMENT_MODIFY_ATTRS,
+    DOCUMENT_ELEMENT_REPLACE,
+    DOCUMENT_MODIFY,
+])
+
+
+def _blip_key(operation):
+  params = operation.params
+  return params.get('waveId'), params.get('waveletId'), params.get('blipId')
+
+
+def _element_properties(el):
+  """Returns the properties of an element as a dictionary."""
+  return el.properties
+
+
+def _merge_elements(first, second):
+  """Returns a copy of first with the properties of second applied."""
+  merged = copy.copy(first)
+  for key, value in _element_properties(second).items():
+    setattr(merged, key, value)
+  return merged
+
+
+def _is_whole_blip_append(operation):
+  """Returns whether this is a plain text append as done by blip.append."""
+  if operation.method != DOCUMENT_MODIFY:
+    return False
+  params = operation.params
+  if 'modifyQuery' in params or 'range' in params:
+    return False
+  action = params.get('modifyAction', {})
+  values = action.get('values')
+  return (action.get('modifyHow') == 'INSERT_AFTER' and
+          not 'elements' in action and
+          values and len(values) == 1 and
+          isinstance(values[0], basestring))
+
+
+def _is_update_element(operation):
+  return (operation.method == DOCUMENT_MODIFY and
+          operation.params.get('modifyAction', {}).get('modifyHow') ==
+          'UPDATE_ELEMENT')
+
+
+def _same_target(first, second):
+  """Returns whether two document operations address the same content."""
+  a = first.params
+  b = second.params
+  for key in ('waveId', 'waveletId', 'blipId', 'proxyingFor'):
+    if a.get(key) != b.get(key):
+      return False
+  return (a.get('modifyQuery') == b.get('modifyQuery') and
+          util.serialize(a.get('range')) == util.serialize(b.get('range')))
+
+
+def _element_identity(el):
+  return el.type, el.get('url'), el.get('name')
+
+
+def _merge_adjacent(previous, operation):
+  """Tries to fold operation into previous.
+
+  Returns:
+    The merged operation, or None if the two can't be merged.
+  """
+  if not _same_target(previous, operation):
+    return None
+  if previous.method == DOCUMENT_APPEND and operation.method == DOCUMENT_APPEND:
+    return Operation(previous.method, previous.id,
+                     dict(previous.params,
+                          content=(previous.params['content'] +
+                                   operation.params['content'])))
+  if _is_whole_blip_append(previous) and _is_whole_blip_append(operation):
+    action = dict(previous.params['modifyAction'])
+    action['values'] = [action['values'][0] +
+                        operation.params['modifyAction']['values'][0]]
+    return Operation(previous.method, previous.id,
+                     dict(previous.params, modifyAction=action))
+  if _is_update_element(previous) and _is_update_element(operation):
+    first = previous.params['modifyAction']['elements']
+    second = operation.params['modifyAction']['elements']
+    if len(first) != len(second):
+      return None
+    action = dict(previous.params['modifyAction'])
+    action['elements'] = [_merge_elements(a, b) for a, b in zip(first, second)]
+    return Operation(previous.method, previous.id,
+                     dict(previous.params, modifyAction=action))
+  if (previous.method == DOCUMENT_ELEMENT_MODIFY_ATTRS and
+      operation.method == DOCUMENT_ELEMENT_MODIFY_ATTRS):
+    first = previous.params['element']
+    second = operation.params['element']
+    if _element_identity(first) != _element_identity(second):
+      return None
+    return Operation(previous.method, previous.id,
+                     dict(previous.params,
+                          element=_merge_elements(first, second)))
+  return None
+
+
+def optimize_operations(operations):
+  """Returns a compacted list of operations with the same end result.
+
+  The following rewrites are done:
+    - only the last wavelet.setTitle per wavelet is kept
+    - only the last wavelet.datadoc.set per wavelet and key is kept
+    - operations on the content of a blip that is deleted later on in
+      the same list are dropped
+    - adjacent document.append operations on the same blip are merged,
+      as are adjacent plain text appends to the end of a blip
+    - consecutive element updates of the same element(s) are folded
+      into one.
+
+  Args:
+    operations: the list of operations to optimize. It is not modified.
+  Returns:
+    The optimized list of operations.
+  """
+  last_title = {}
+  last_datadoc = {}
+  deleted_at = {}
+  for index, operation in enumerate(operations):
+    params = operation.params
+    wavelet_key = params.get('waveId'), params.get('waveletId')
+    if operation.method == WAVELET_SET_TITLE:
+      last_title[wavelet_key] = index
+    elif operation.method == WAVELET_DATADOC_SET:
+      last_datadoc[wavelet_key + (params.get('datadocName'),)] = index
+    elif operation.method == BLIP_DELETE:
+      deleted_at[_blip_key(operation)] = index
+
+  res = []
+  for index, operation in enumerate(operations):
+    params = operation.params
+    wavelet_key = params.get('waveId'), params.get('waveletId')
+    if operation.method == WAVELET_SET_TITLE:
+      if last_title[wavelet_key] != index:
+        continue
+    elif operation.method == WAVELET_DATADOC_SET:
+      if last_datadoc[wavelet_key + (params.get('datadocName'),)] != index:
+        continue
+    elif (operation.method in _BLIP_CONTENT_METHODS and
+          not 'blipData' in params and
+          deleted_at.get(_blip_key(operation), -1) > index):
+      continue
+    if res:
+      merged = _merge_adjacent(res[-1], operation)
+      if merged:
+        res[-1] = merged
+        continue
+    res.append(operation)
+  return res
+
+
+def _wavelet_key(operation):
+  params = operation.params
+  if operation.method == WAVELET_CREATE:
+    # the new wavelet is only known by the ids in the wavelet data
+    params = params.get('waveletData') or params
+  return params.get('waveId'), params.get('waveletId')
+
+
+def partition_operations(operations):
+  """Splits operations into groups that can be applied independently.
+
+  Operations on different wavelets are independent, as are operations on
+  different blips of a wavelet, unless the wavelet also has wavelet level
+  operations (like adding a participant or appending a blip) in the list.
+  Operations creating a new blip are grouped with the blip they are
+  applied to, so that later operations on the new blip stay behind them.
+
+  Args:
+    operations: the list of operations to partition.
+  Returns:
+    A list of groups, each a list of indices into operations in their
+    original order. Groups are ordered by their first operation.
+  """
+  whole_wavelet = set()
+  for operation in operations:
+    method = operation.method
+    if (not (method.startswith('blip.') or method.startswith('document.')) or
+        not 'blipId' in operation.params):
+      whole_wavelet.add(_wavelet_key(operation))
+
+  parents = {}
+
+  def find(key):
+    root = key
+    while parents.setdefault(root, root) != root:
+      root = parents[root]
+    while key != root:
+      key, parents[key] = parents[key], root
+    return root
+
+  def union(a, b):
+    root_a = find(a)
+    root_b = find(b)
+    if root_a != root_b:
+      parents[root_b] = root_a
+
+  keys = []
+  for operation in operations:
+    wavelet_key = _wavelet_key(operation)
+    if wavelet_key in whole_wavelet:
+      key = wavelet_key
+    else:
+      params = operation.params
+      key = wavelet_key + (params['blipId'],)
+      for related in ('blipData', 'childBlipId'):
+        related_id = params.get(related)
+        if isinstance(related_id, dict):
+          related_id = related_id.get('blipId')
+        if related_id:
+          union(key, wavelet_key + (related_id,))
+    keys.append(key)
+
+  groups = {}
+  res = []
+  for index, key in enumerate(keys):
+    root = find(key)
+    if not root in groups:
+      groups[root] = []
+      res.append(groups[root])
+    groups[root].append(index)
+  return res
+
+
+def _created_ids(operation):
+  """Returns the temporary ids of the entities an operation creates."""
+  params = operation.params
+  res = []
+  blip_data = params.get('blipData')
+  if isinstance(blip_data, dict):
+    res.append(blip_data.get('blipId'))
+  wavelet_data = params.get('waveletData')
+  if isinstance(wavelet_data, dict):
+    res.append(wavelet_data.get('waveId'))
+    res.append(wavelet_data.get('rootBlipId'))
+  return [id for id in res if id]
+
+
+def dependent_runs(operations):
+  """Splits operations into runs that have to be sent in the same rpc.
+
+  Operations creating a wave or blip get a temporary id for it, which the
+  server only resolves within the rpc the creating operation is in. Every
+  later operation on such an entity has to be in that rpc as well, as do
+  the operations in between to keep the order.
+
+  Args:
+    operations: the list of operations to split.
+  Returns:
+    A list of runs, each a list of consecutive indices into operations.
+  """
+  # index of the operation that created each temporary id
+  creators = {}
+  run_starts = []
+  for index, operation in enumerate(operations):
+    run_starts.append(index)
+    params = operation.params
+    for id in (params.get('waveId'), params.get('blipId')):
+      creator = creators.get(id)
+      # join the run of the creator and all runs since
+      while creator is not None and run_starts[-1] > creator:
+        run_starts.pop()
+    for id in _created_ids(operation):
+      creators[id] = index
+  run_starts.append(len(operations))
+  return [range(run_starts[i], run_starts[i + 1])
+          for i in xrange(len(run_starts) - 1)]
+
 
 class BlipData(dict):
   """Temporary class for storing ephemeral blip data.
@@ -174,6 +656,62 @@ class WaveletData(dict):
     self['participants'] = participants
 
 
+class IdAllocator(object):
+  """Hands out the temporary ids for new waves, blips and operations.
+
+  The counters of an allocator start at 1, so ids are only unique per
+  allocator unless the allocator is given a prefix. The robot keeps one
+  allocator per request, queues created on their own get one with a random
+  prefix. Allocators are thread safe.
+  """
+
+  def __init__(self, prefix=''):
+    """Creates an allocator.
+
+    Args:
+      prefix: put in front of the numbers in all ids, so they do not clash
+          with those of allocators with another prefix. A non empty prefix
+          should end in a character that is not a digit.
+    """
+    self._lock = threading.Lock()
+    self._prefix = prefix
+    self._next_blip_id = 1
+    self._next_wave_id = 1
+    self._next_operation_id = 1
+
+  def _next(self, counter):
+    self._lock.acquire()
+    try:
+      res = getattr(self, counter)
+      setattr(self, counter, res + 1)
+      return res
+    finally:
+      self._lock.release()
+
+  @property
+  def operation_id_prefix(self):
+    """The part of the operation ids in front of the number."""
+    return 'op' + self._prefix
+
+  def next_blip_id(self, wavelet_id):
+    """Returns a new temporary blip id for a blip in wavelet_id."""
+    return 'TBD_%s_%s%s' % (wavelet_id, self._prefix,
+                            self._next('_next_blip_id'))
+
+  def next_wave_id(self, domain):
+    """Returns a new temporary wave id in domain."""
+    return '%s!TBD_%s%s' % (domain, self._prefix, self._next('_next_wave_id'))
+
+  def next_operation_id(self):
+    """Returns a new operation id."""
+    return '%s%s' % (self.operation_id_prefix,
+                     self._next('_next_operation_id'))
+
+
+def _random_id_prefix():
+  return os.urandom(4).encode('hex') + '.'
+
+
 class OperationQueue(object):
   """Wraps the queuing of operations using easily callable functions.
 
@@ -188,20 +726,31 @@ class OperationQueue(object):
   For example, calling WaveletAppendBlip will not result in a new blip
   being added to the robot, only an operation to be applied on the
   server.
-  """
 
-  # Some class global counters:
-  __nextBlipId = 1
-  __nextWaveId = 1
-  __nextOperationId = 1
+  By default pending operations are kept as a list of Operation instances.
+  Batch jobs that queue very many operations can pass columnar=True to
+  keep them in a ColumnarOperations store instead, which uses a fraction
+  of the memory per operation.
+
+  Passing auto_optimize=True runs optimize() on the queue before it is
+  serialized or submitted.
+
+  Temporary ids are taken from id_allocator. If none is passed, the queue
+  gets an allocator of its own with a random prefix, so queues merged with
+  copy_operations do not hand out the same ids.
+  """
 
-  def __init__(self):
+  def __init__(self, columnar=False, auto_optimize=False, id_allocator=None):
+    self._columnar = columnar
+    self._auto_optimize = auto_optimize
+    if id_allocator is None:
+      id_allocator = IdAllocator(_random_id_prefix())
+    self._id_allocator = id_allocator
     self.clear()
 
   def __CreateNewBlipData(self, wave_id, wavelet_id, initial_content=''):
     """Creates JSON of the blip used for this session."""
-    temp_blip_id = 'TBD_%s_%s' % (wavelet_id, OperationQueue.__nextBlipId)
-    OperationQueue.__nextBlipId += 1
+    temp_blip_id = self._id_allocator.next_blip_id(wavelet_id)
     return BlipData(wave_id, wavelet_id, temp_blip_id, initial_content)
 
   def CreateNewWaveletData(self, domain, participants):
@@ -212,8 +761,7 @@ class OperationQueue(object):
       participants initially on the wavelet
     Returns:
       Blipdata (for the rootblip), WaveletData."""
-    wave_id = domain + '!TBD_%s' % OperationQueue.__nextWaveId
-    OperationQueue.__nextWaveId += 1
+    wave_id = self._id_allocator.next_wave_id(domain)
     wavelet_id = domain + '!conv+root'
     root_blip_data = self.__CreateNewBlipData(wave_id, wavelet_id)
     participants = set(participants)
@@ -228,7 +776,11 @@ class OperationQueue(object):
     return self.__pending.__iter__()
 
   def clear(self):
-    self.__pending = []
+    if self._columnar:
+      self.__pending = ColumnarOperations(
+          self._id_allocator.operation_id_prefix)
+    else:
+      self.__pending = []
     self._capability_hash = 0
     self._proxy_for_id = None
 
@@ -239,7 +791,8 @@ class OperationQueue(object):
     operation list, but has a different proxying_for_id set so the robot using
     this new queue will send out operations with the proxying_for field set.
     """
-    res = OperationQueue()
+    res = OperationQueue(self._columnar, self._auto_optimize,
+                         self._id_allocator)
     res.__pending = self.__pending
     res._capability_hash = self._capability_hash
     res._proxy_for_id = id
@@ -248,11 +801,34 @@ class OperationQueue(object):
   def set_capability_hash(self, capability_hash):
     self._capability_hash = capability_hash
 
+  @property
+  def auto_optimize(self):
+    """Whether optimize() is run before serializing or submitting."""
+    return self._auto_optimize
+
+  def optimize(self):
+    """Compacts the pending operations in place.
+
+    See optimize_operations for the rewrites that are done.
+
+    Returns:
+      The number of operations that were removed.
+    """
+    before = len(self.__pending)
+    optimized = optimize_operations(list(self.__pending))
+    if self._columnar:
+      self.__pending.assign(optimized)
+    else:
+      self.__pending[:] = optimized
+    return before - len(optimized)
+
   def serialize(self):
+    if self._auto_optimize:
+      self.optimize()
     first = Operation(ROBOT_NOTIFY_CAPABILITIES_HASH,
                       '0',
                       {'capabilitiesHash': self._capability_hash})
-    operations = [first] + self.__pending
+    operations = [first] + list(self.__pending)
     res = util.serialize(operations)
     logging.info('>>>>>' + str(res))
     return res
@@ -271,11 +847,12 @@ class OperationQueue(object):
     props['waveletId'] = wavelet_id
     if self._proxy_for_id:
       props['proxyingFor'] = self._proxy_for_id
-    operation = Operation(method,
-                          'op%s' % OperationQueue.__nextOperationId,
-                          props)
-    self.__pending.append(operation)
-    OperationQueue.__nextOperationId += 1
+    opid = self._id_allocator.next_operation_id()
+    if self._columnar:
+      operation = self.__pending.add(method, opid, props)
+    else:
+      operation = Operation(method, opid, props)
+      self.__pending.append(operation)
     return operation
 
   def WaveletAppendBlip(self, wave_id, wavelet_id, initial_content=''):
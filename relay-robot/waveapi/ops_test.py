@@ -17,8 +17,10 @@
 """Unit tests for the ops module."""
 
 
+import threading
 import unittest
 
+import element
 import ops
 
 
@@ -34,5 +36,148 @@ class TestOperation(unittest.TestCase):
     self.assertEquals(2, len(op.params))
 
 
+class TestOperationQueue(unittest.TestCase):
+  """Test case for the OperationQueue class."""
+
+  def fill(self, queue):
+    queue.DocumentAppend('wave-id', 'wavelet-id', 'blip-id', 'hello')
+    queue.BlipDelete('wave-id', 'wavelet-id', 'other-blip-id')
+    op = queue.DocumentModify('wave-id', 'wavelet-id', 'blip-id')
+    op.set_param('modifyAction', {'modifyHow': 'DELETE'})
+    queue.WaveletSetTitle('wave-id', 'wavelet-id', 'title')
+
+  def strip_ids(self, serialized):
+    for op in serialized:
+      del op['id']
+    return serialized
+
+  def testColumnarQueue(self):
+    queue = ops.OperationQueue()
+    columnar = ops.OperationQueue(columnar=True)
+    self.fill(queue)
+    self.fill(columnar)
+    self.assertEquals(4, len(columnar))
+    self.assertEquals(self.strip_ids(queue.serialize()),
+                      self.strip_ids(columnar.serialize()))
+    op = list(columnar)[2]
+    self.assertEquals(ops.DOCUMENT_MODIFY, op.method)
+    self.assertEquals('blip-id', op.params['blipId'])
+    self.assertEquals({'modifyHow': 'DELETE'}, op.params['modifyAction'])
+
+  def testColumnarParams(self):
+    columnar = ops.OperationQueue(columnar=True)
+    op = columnar.DocumentAppend('wave-id', 'wavelet-id', 'blip-id', 'hello')
+    op.params['content'] = 'lost'
+    self.assertEquals('hello', op.params['content'])
+    op.set_param('content', 'kept')
+    op.set_param('blipId', 'other-blip-id')
+    op = list(columnar)[0]
+    self.assertEquals('kept', op.params['content'])
+    self.assertEquals('other-blip-id', op.params['blipId'])
+
+  def testColumnarCopyOperations(self):
+    columnar = ops.OperationQueue(columnar=True)
+    columnar.copy_operations(
+        [ops.Operation(ops.BLIP_DELETE, 'custom-id', {'blipId': 'b'})])
+    op = list(columnar)[0]
+    self.assertEquals('custom-id', op.id)
+    self.assertEquals({'blipId': 'b'}, op.params)
+
+  def testMergedQueuesHaveUniqueIds(self):
+    first = ops.OperationQueue()
+    second = ops.OperationQueue(columnar=True)
+    blip_ids = []
+    for queue in (first, second):
+      blip_data = queue.BlipCreateChild('wave-id', 'wavelet-id', 'blip-id')
+      blip_ids.append(blip_data.blipId)
+      blip_data = queue.WaveletAppendBlip('wave-id', 'wavelet-id')
+      blip_ids.append(blip_data.blipId)
+      queue.DocumentAppend('wave-id', 'wavelet-id', blip_data.blipId, 'hi')
+    first.copy_operations(second)
+    op_ids = [op.id for op in first]
+    self.assertEquals(6, len(op_ids))
+    self.assertEquals(len(op_ids), len(set(op_ids)))
+    self.assertEquals(4, len(set(blip_ids)))
+
+  def testQueuesHaveOwnCounters(self):
+    first = ops.OperationQueue()
+    second = ops.OperationQueue(columnar=True)
+    ids = []
+    for queue in (first, second):
+      op = queue.DocumentAppend('wave-id', 'wavelet-id', 'blip-id', 'hi')
+      ids.append(op.id)
+      self.assertTrue(op.id.startswith('op'))
+      self.assertTrue(op.id.endswith('.1'))
+    self.assertNotEqual(ids[0], ids[1])
+
+  def testOptimize(self):
+    queue = ops.OperationQueue()
+    queue.WaveletSetTitle('wave-id', 'wavelet-id', 'first')
+    queue.DocumentAppend('wave-id', 'wavelet-id', 'blip-id', 'hello ')
+    queue.DocumentAppend('wave-id', 'wavelet-id', 'blip-id', 'world')
+    queue.WaveletSetDataDoc('wave-id', 'wavelet-id', 'key', 'a')
+    queue.DocumentAppend('wave-id', 'wavelet-id', 'doomed-id', 'gone')
+    queue.WaveletSetDataDoc('wave-id', 'wavelet-id', 'other', 'x')
+    queue.WaveletSetTitle('wave-id', 'wavelet-id', 'second')
+    queue.WaveletSetDataDoc('wave-id', 'wavelet-id', 'key', 'b')
+    queue.BlipDelete('wave-id', 'wavelet-id', 'doomed-id')
+    self.assertEquals(4, queue.optimize())
+    operations = list(queue)
+    self.assertEquals([ops.DOCUMENT_APPEND,
+                       ops.WAVELET_DATADOC_SET,
+                       ops.WAVELET_SET_TITLE,
+                       ops.WAVELET_DATADOC_SET,
+                       ops.BLIP_DELETE],
+                      [op.method for op in operations])
+    self.assertEquals('hello world', operations[0].params['content'])
+    self.assertEquals('second', operations[2].params['waveletTitle'])
+    self.assertEquals('b', operations[3].params['datadocValue'])
+
+  def testOptimizeFoldsElementUpdates(self):
+    queue = ops.OperationQueue(columnar=True, auto_optimize=True)
+    for props in ({'a': '1'}, {'b': '2'}, {'a': '3'}):
+      op = queue.DocumentModify('wave-id', 'wavelet-id', 'blip-id')
+      op.set_param('modifyQuery', {'elementMatch': 'GADGET', 'maxRes': 1})
+      op.set_param('modifyAction',
+                   {'modifyHow': 'UPDATE_ELEMENT',
+                    'elements': [element.Element('GADGET', properties=props)]})
+    serialized = queue.serialize()
+    # the capabilities hash followed by a single merged update
+    self.assertEquals(2, len(serialized))
+    action = serialized[1]['params']['modifyAction']
+    self.assertEquals({'a': '3', 'b': '2'}, action['elements'][0]['properties'])
+
+
+class TestIdAllocator(unittest.TestCase):
+  """Test case for the IdAllocator class."""
+
+  def testThreadSafe(self):
+    allocator = ops.IdAllocator()
+    ids = []
+    def allocate():
+      res = [allocator.next_operation_id() for _ in xrange(1000)]
+      # list.extend holds the interpreter lock, appending is atomic
+      ids.extend(res)
+    threads = [threading.Thread(target=allocate) for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEquals(8000, len(ids))
+    self.assertEquals(8000, len(set(ids)))
+    self.assertEquals('op8001', allocator.next_operation_id())
+
+  def testPrefix(self):
+    allocator = ops.IdAllocator('q.')
+    self.assertEquals('opq.1', allocator.next_operation_id())
+    self.assertEquals('TBD_wl_q.1', allocator.next_blip_id('wl'))
+    self.assertEquals('test.com!TBD_q.1', allocator.next_wave_id('test.com'))
+    # operation ids with the prefix are stored as their number
+    store = ops.ColumnarOperations(allocator.operation_id_prefix)
+    store.add(ops.BLIP_DELETE, 'opq.7', {})
+    self.assertEquals([], store._strings[1:])
+    self.assertEquals('opq.7', store[0].id)
+
+
 if __name__ == '__main__':
   unittest.main()
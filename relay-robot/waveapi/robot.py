@@ -24,6 +24,7 @@ from google.appengine.api import urlfetch
 import base64
 import logging
 import sys
+import threading
 import urllib
 
 try:
@@ -34,8 +35,11 @@ except ImportError:
 import simplejson
 
 import blip
+import errors
 import events
+import message_store
 import ops
+import snapshot
 import util
 import wavelet
 
@@ -45,6 +49,21 @@ oauth = None
 DEFAULT_PROFILE_URL = (
     'http://code.google.com/apis/wave/extensions/robots/python-tutorial.html')
 
+# What blips and wavelets keep of the json they were built from, see
+# Robot.set_raw_data_retention.
+RAW_DATA_KEEP = 'keep'
+RAW_DATA_DROP = 'drop'
+RAW_DATA_LAZY = 'lazy'
+
+
+def _add_results(results, response):
+  """Adds the results in the response to a batch of rpcs to results."""
+  if isinstance(response, list):
+    results.extend(response)
+  else:
+    results.append(response)
+
+
 class Robot(object):
   """Robot metadata class.
 
@@ -74,6 +93,12 @@ class Robot(object):
     self._image_url = image_url
     self._profile_url = profile_url
     self._capability_hash = 0
+    self._request_state = threading.local()
+    self._rpc_max_body_size = None
+    self._rpc_max_operations = None
+    self._rpc_max_parallel = 1
+    self._raw_data_retention = RAW_DATA_KEEP
+    self._message_store = None
 
   @property
   def name(self):
@@ -111,6 +136,36 @@ class Robot(object):
     except urllib2.URLError, e:
       return e.code, e.read()
 
+  def http_post_async(self, url, data, headers):
+    """Start an http post without waiting for the response.
+
+    Monkey patch this method to post concurrently with something other
+    than the default urlfetch rpcs.
+    Args:
+        url: to post to
+        data: post body
+        headers: extra headers to pass along
+    Returns:
+        a function that waits for the post and returns
+        response_code, returned_page
+    """
+    rpc = urlfetch.create_rpc()
+    urlfetch.make_fetch_call(rpc, url,
+                             payload=data,
+                             method=urlfetch.POST,
+                             headers=headers)
+    def wait():
+      response = rpc.get_result()
+      return response.status_code, response.content
+    return wait
+
+  def _posts_async(self):
+    """Returns whether http_post_async can be used to post concurrently."""
+    default = Robot.http_post_async.im_func
+    if getattr(self.http_post_async, 'im_func', None) is not default:
+      return True
+    return getattr(urlfetch, 'create_rpc', None) is not None
+
   def get_verification_token_info(self):
     return self._verification_token, self._st
 
@@ -209,18 +264,69 @@ class Robot(object):
     return base64.b64encode(hashed.digest())
 
 
-  def make_rpc(self, operations):
-    """Make an rpc call, submitting the specified operations."""
+  def set_rpc_limits(self, max_body_size=None, max_operations=None,
+                     max_parallel=1):
+    """Configure how make_rpc splits up large sets of operations.
 
-    if not oauth or not self._oauth_consumer.key:
-      raise errors.Error('OAuth has not been configured')
-    if (not type(operations) == list and
-        not isinstance(operations, ops.OperationQueue)):
-      operations = [operations]
+    Args:
+      max_body_size: maximum size in bytes of a single rpc body, or None
+          for no limit. Operations that are larger on their own are sent
+          in an rpc of their own.
+      max_operations: maximum number of operations per rpc, or None for
+          no limit.
+      max_parallel: number of rpcs that can be in flight at the same time.
+          Only rpcs with operations that do not depend on each other are
+          sent concurrently.
+    """
+    self._rpc_max_body_size = max_body_size
+    self._rpc_max_operations = max_operations
+    self._rpc_max_parallel = max(1, max_parallel)
 
-    rpcs = [op.serialize(method_prefix='wave') for op in operations]
+  def set_raw_data_retention(self, retention):
+    """Configure what the model keeps of the json it was built from.
+
+    By default every blip and wavelet holds on to its decoded json as
+    raw_data, next to the parsed model, which doubles the memory a bundle
+    takes.
+
+    Args:
+      retention: RAW_DATA_KEEP to keep the decoded json, RAW_DATA_DROP to
+          let go of it once the model is built, in which case raw_data is
+          None, or RAW_DATA_LAZY to keep only the body the json came in.
+          raw_data then decodes the slice of the body for the object on
+          every access.
+    """
+    if retention not in (RAW_DATA_KEEP, RAW_DATA_DROP, RAW_DATA_LAZY):
+      raise ValueError('Unknown raw data retention: %r' % retention)
+    self._raw_data_retention = retention
+
+  def set_message_store(self, store):
+    """Keep the messages passed to new_wave locally.
+
+    Only a short key is sent along with the new wave then, which the
+    WaveletCreated event resolves back to the message.
+
+    Args:
+      store: a message_store.MessageStore, or None to send messages as is.
+    """
+    self._message_store = store
 
-    post_body = simplejson.dumps(rpcs)
+  def resolve_message(self, message):
+    """Returns the message passed to new_wave for what came back.
+
+    Returns:
+      The message as passed to new_wave, as a string. If the message was
+      kept in a store that no longer has it, None.
+    """
+    if self._message_store is None or not message_store.is_key(message):
+      return message
+    res = self._message_store.get(message)
+    if res is None:
+      logging.warning('Message %s is not in the message store' % message)
+    return res
+
+  def _sign_rpc(self, post_body):
+    """Returns the signed url to post a single rpc body to."""
     body_hash = self._hash(post_body)
     params = {
       'oauth_consumer_key': 'google.com:' + self._oauth_consumer.key,
@@ -235,16 +341,142 @@ class Robot(object):
     oauth_request.sign_request(self._oauth_signature_method,
                                self._oauth_consumer,
                                None)
-    code, content = self.http_post(
-        url=oauth_request.to_url(),
-        data=post_body,
-        headers={'Content-Type': 'application/json'})
+    return oauth_request.to_url()
+
+  def _decode_rpc_response(self, url, code, content):
     if code != 200:
-      logging.info(oauth_request.to_url())
+      logging.info(url)
       logging.info(content)
       raise IOError('HttpError ' + str(code))
     return simplejson.loads(content)
 
+  def _post_rpc(self, post_body):
+    """Signs and posts a single rpc body, returning the decoded response."""
+    url = self._sign_rpc(post_body)
+    code, content = self.http_post(
+        url=url,
+        data=post_body,
+        headers={'Content-Type': 'application/json'})
+    return self._decode_rpc_response(url, code, content)
+
+  def _start_rpc(self, post_body):
+    """Signs a single rpc body and starts posting it with http_post_async.
+
+    Returns:
+      A function that waits for the response and returns it decoded.
+    """
+    url = self._sign_rpc(post_body)
+    wait_post = self.http_post_async(
+        url=url,
+        data=post_body,
+        headers={'Content-Type': 'application/json'})
+    def wait():
+      code, content = wait_post()
+      return self._decode_rpc_response(url, code, content)
+    return wait
+
+  def _chunk_rpcs(self, encoded, runs):
+    """Splits json encoded rpcs into lists that fit the limits.
+
+    Args:
+      encoded: the json encoded rpcs.
+      runs: lists of consecutive indices into encoded that have to end up
+          in the same chunk, see ops.dependent_runs. A run that does not
+          fit the limits on its own gets a chunk of its own.
+    """
+    max_size = self._rpc_max_body_size
+    max_operations = self._rpc_max_operations
+    chunks = []
+    chunk = []
+    size = 2
+    for run in runs:
+      run_size = sum([len(encoded[index]) + 1 for index in run])
+      if chunk and ((max_operations and
+                     len(chunk) + len(run) > max_operations) or
+                    (max_size and size + run_size > max_size)):
+        chunks.append(chunk)
+        chunk = []
+        size = 2
+      chunk.extend([encoded[index] for index in run])
+      size += run_size
+    if chunk:
+      chunks.append(chunk)
+    return chunks
+
+  def _post_chunks(self, chunks):
+    """Posts chunks of encoded rpcs in order, returning all results."""
+    results = []
+    for chunk in chunks:
+      _add_results(results, self._post_rpc('[' + ','.join(chunk) + ']'))
+    return results
+
+  def _post_groups(self, groups):
+    """Posts independent groups of chunks concurrently.
+
+    The chunks within a group are posted one after the other. At most
+    max_parallel groups are in flight at the same time, using
+    http_post_async. If that has not been replaced and urlfetch has no
+    asynchronous calls, the groups are posted one by one.
+    """
+    if not self._posts_async():
+      return self._post_chunks([chunk for group in groups for chunk in group])
+    pending = [group for group in groups if group]
+    # (wait for the response, chunks of the group left to post)
+    in_flight = []
+    results = []
+    while pending or in_flight:
+      while pending and len(in_flight) < self._rpc_max_parallel:
+        group = pending.pop(0)
+        in_flight.append((self._start_rpc('[' + ','.join(group[0]) + ']'),
+                          group[1:]))
+      wait, rest = in_flight.pop(0)
+      _add_results(results, wait())
+      if rest:
+        in_flight.append((self._start_rpc('[' + ','.join(rest[0]) + ']'),
+                          rest[1:]))
+    return results
+
+  def make_rpc(self, operations):
+    """Make an rpc call, submitting the specified operations.
+
+    If limits were configured with set_rpc_limits, the operations are split
+    over multiple rpcs and independent ones can be sent concurrently. The
+    results are returned merged, in the order of the operations.
+    """
+
+    if not oauth or not self._oauth_consumer.key:
+      raise errors.Error('OAuth has not been configured')
+    if (not type(operations) == list and
+        not isinstance(operations, ops.OperationQueue)):
+      operations = [operations]
+    elif getattr(operations, 'auto_optimize', False):
+      operations.optimize()
+
+    rpcs = [op.serialize(method_prefix='wave') for op in operations]
+    if (not self._rpc_max_body_size and not self._rpc_max_operations and
+        self._rpc_max_parallel == 1):
+      return self._post_rpc(simplejson.dumps(rpcs))
+
+    encoded = [simplejson.dumps(rpc) for rpc in rpcs]
+    operations = list(operations)
+    if self._rpc_max_parallel == 1:
+      results = self._post_chunks(
+          self._chunk_rpcs(encoded, ops.dependent_runs(operations)))
+    else:
+      groups = []
+      for group in ops.partition_operations(operations):
+        runs = ops.dependent_runs([operations[i] for i in group])
+        groups.append(self._chunk_rpcs([encoded[i] for i in group], runs))
+      results = self._post_groups(groups)
+
+    order = dict([(rpc['id'], index) for index, rpc in enumerate(rpcs)])
+    def position(result):
+      if isinstance(result, dict):
+        return order.get(result.get('id'), len(order))
+      return len(order)
+    results.sort(key=position)
+    return results
+
   def capabilities_xml(self):
     """Return this robot's capabilities as an XML string."""
     lines = []
@@ -286,6 +518,23 @@ class Robot(object):
               'profileUrl': self.profile_url}
     return simplejson.dumps(data)
 
+  def _start_request(self):
+    """Starts a new request scope for the current thread.
+
+    Operation queues created from here on by this thread share a fresh
+    IdAllocator, so temporary ids are unique within the request without
+    interfering with requests handled by other threads.
+    """
+    self._request_state.id_allocator = ops.IdAllocator()
+
+  def new_operation_queue(self):
+    """Returns a new operation queue scoped to the current request."""
+    allocator = getattr(self._request_state, 'id_allocator', None)
+    if allocator is None:
+      self._start_request()
+      allocator = self._request_state.id_allocator
+    return ops.OperationQueue(id_allocator=allocator)
+
   def _wavelet_from_json(self, json, pending_ops):
     """Construct a wavelet from the passed json.
 
@@ -297,31 +546,81 @@ class Robot(object):
     wavelet.serialize() call. In that case the blips will
     be contaned in the wavelet record.
     """
-    if isinstance(json, basestring):
-      json = simplejson.loads(json)
-
-    blips = {}
-    for blip_id, raw_blip_data in json['blips'].items():
-      blips[blip_id] = blip.Blip(raw_blip_data, blips, pending_ops)
-
-    if 'wavelet' in json:
-      raw_wavelet_data = json['wavelet']
+    retention = self._raw_data_retention
+    if isinstance(json, basestring) and retention == RAW_DATA_LAZY:
+      # Only find where the blips are in the body, each is decoded from
+      # its own slice when it is first looked up.
+      members = util.RawJson(json).members()
+      raw_blips = members['blips'].members()
+      raw_wavelet = members.get('wavelet')
+      if raw_wavelet is None:
+        # A serialized wavelet, its fields are next to the blips. Those are
+        # decoded on their own, raw_data still covers the whole body.
+        raw_wavelet = util.RawJson(json)
+        raw_wavelet_data = dict([(name, value.decode())
+                                 for name, value in members.items()
+                                 if name != 'blips'])
+      else:
+        raw_wavelet_data = raw_wavelet.decode()
+      robot_address = util.decode_raw(members.get('robotAddress'))
     else:
-      raw_wavelet_data = json
-    wavelet_blips = {}
+      if isinstance(json, basestring):
+        json = simplejson.loads(json)
+      raw_blips = dict(json['blips'])
+      raw_wavelet = json.get('wavelet', json)
+      raw_wavelet_data = raw_wavelet
+      robot_address = json.get('robotAddress')
+
     wavelet_id = raw_wavelet_data['waveletId']
     wave_id = raw_wavelet_data['waveId']
-    for blip_id, instance in blips.items():
-      if instance.wavelet_id == wavelet_id and instance.wave_id == wave_id:
-        wavelet_blips[blip_id] = instance
-    result = wavelet.Wavelet(raw_wavelet_data, wavelet_blips, self, pending_ops)
-    robot_address = json.get('robotAddress')
+
+    # Group the raw blips by the wavelet they belong to. Blips are only
+    # constructed when a handler looks them up, and replies made to them
+    # end up in the group of their wavelet. The ids and element properties
+    # repeated between them are shared.
+    groups = {}
+    for blip_id, raw in raw_blips.items():
+      if isinstance(raw, util.RawJson):
+        fields = raw.members()
+        key = (util.decode_raw(fields.get('waveId')),
+               util.decode_raw(fields.get('waveletId')))
+      elif isinstance(raw, snapshot.RawBlip):
+        key = (raw.wave_id, raw.wavelet_id)
+      else:
+        key = (raw.get('waveId'), raw.get('waveletId'))
+      groups.setdefault(key, {})[blip_id] = raw
+    interner = util.Interner()
+    def blips_of_group(raw_group):
+      def build_blip(blip_id, raw):
+        if isinstance(raw, snapshot.RawBlip):
+          raw = raw.decode()
+        res = blip.Blip(util.decode_raw(raw), blips, pending_ops, interner)
+        if retention == RAW_DATA_DROP:
+          res._retain_raw_data(None)
+        elif isinstance(raw, util.RawJson):
+          res._retain_raw_data(raw)
+        return res
+      blips = blip.Blips({}, raw_group, build_blip)
+      return blips
+    views = {}
+    for key, raw_group in groups.items():
+      views[key] = blips_of_group(raw_group)
+    wavelet_blips = views.pop((wave_id, wavelet_id), None)
+    if wavelet_blips is None:
+      wavelet_blips = blip.Blips({})
+    result = wavelet.Wavelet(raw_wavelet_data, wavelet_blips, self, pending_ops,
+                             other_wavelet_blips=views, interner=interner)
+    if retention == RAW_DATA_DROP:
+      result._retain_raw_data(None)
+    elif isinstance(raw_wavelet, util.RawJson):
+      result._retain_raw_data(raw_wavelet)
     if robot_address:
       result.robot_address = robot_address
     return result
 
   def process_events(self, json):
     """Process an incoming set of events encoded as json."""
+    self._start_request()
     parsed = simplejson.loads(json)
 
     proxying_for = parsed['proxyingFor']
@@ -359,12 +658,15 @@ class Robot(object):
           as the creator of the wave is always added.
       message: a string that will be passed back to the robot
           when the WAVELET_CREATOR event is fired. This is a
-          lightweight way to pass around state.
+          lightweight way to pass around state. If a message store is
+          set, only a key for the message is sent.
 
     """
-    operation_queue = ops.OperationQueue()
+    operation_queue = self.new_operation_queue()
     if not isinstance(message, basestring):
       message = simplejson.dumps(message)
+    if message and self._message_store is not None:
+      message = self._message_store.put(message)
 
     blip_data, wavelet_data = operation_queue.WaveletCreate(
         domain,
@@ -405,14 +707,33 @@ class Robot(object):
     Args:
       json: a json object or string containing at least a key
         wavelet defining the wavelet and a key blips defining the
-        blips in the view.
+        blips in the view. May also be a message key, as handed out
+        by the message store, of such a string.
 
     A new wavelet is returned with its own operation queue. It the
     responsibility of the caller to make sure this wavelet gets
     submited to the server, either by calling robot.submit() or
     by calling .submit_with() on the returned wavelet.
+
+    Raises:
+      KeyError: if json is a message key the message store does not know,
+          for example because the message expired.
+    """
+    key = json
+    json = self.resolve_message(key)
+    if json is None:
+      raise KeyError('Message %s is not in the message store' % key)
+    return self._wavelet_from_json(json, self.new_operation_queue())
+
+  def wavelet_from_bytes(self, data):
+    """Restores a wavelet from a snapshot made by Wavelet.to_bytes.
+
+    The result is the same as passing the serialized wavelet to
+    blind_wavelet, with its own operation queue. Blips are only decoded
+    from the snapshot when they are first looked up.
     """
-    return self._wavelet_from_json(json, ops.OperationQueue())
+    return self._wavelet_from_json(snapshot.loads(data, lazy=True),
+                                   self.new_operation_queue())
 
   def submit(self, wavelet):
     """Submit the pending operations associated with this wavelet.
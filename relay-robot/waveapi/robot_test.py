@@ -19,9 +19,11 @@
 import unittest
 
 import events
+import message_store
 import ops
 import robot
 import simplejson
+import util
 
 BLIP_JSON = ('{"wdykLROk*13":'
                '{"lastModifiedTime":1242079608457,'
@@ -132,6 +134,266 @@ class TestRobot(unittest.TestCase):
     self.assertEquals(wavelet.wavelet_id, unserialized.wavelet_id)
     self.assertEquals(wavelet.domain, unserialized.domain)
 
+  def testWaveletToJson(self):
+    wavelet = self.robot.blind_wavelet(TEST_JSON)
+    wavelet.root_blip.append('!')
+    self.assertEquals(wavelet.serialize(), simplejson.loads(wavelet.to_json()))
+
+    # blips that were not looked up are copied from the body
+    json = simplejson.loads(TEST_JSON)
+    other = dict(json['blips']['wdykLROk*13'])
+    other['blipId'] = 'wdykLROk*14'
+    json['blips']['wdykLROk*14'] = other
+    self.robot.set_raw_data_retention(robot.RAW_DATA_LAZY)
+    wavelet = self.robot.blind_wavelet(simplejson.dumps(json))
+    self.assertEquals(other, simplejson.loads(
+        wavelet.blips.to_json())['wdykLROk*14'])
+    self.assertEquals(wavelet.serialize(), simplejson.loads(wavelet.to_json()))
+
+  def testWaveletFromBytes(self):
+    wavelet = self.robot.blind_wavelet(TEST_JSON)
+    wavelet.robot_address = 'robot@test.com'
+    for compress in (False, True):
+      restored = self.robot.wavelet_from_bytes(wavelet.to_bytes(compress))
+      self.assertEquals(wavelet.wave_id, restored.wave_id)
+      self.assertEquals(wavelet.title, restored.title)
+      self.assertEquals('robot@test.com', restored.robot_address)
+      self.assertEquals(wavelet.root_blip.text, restored.root_blip.text)
+      self.assertEquals(1, len(restored.root_blip.annotations))
+      self.assertEquals(len(wavelet.blips), len(restored.blips))
+      self.assertEquals(
+          self.robot.blind_wavelet(wavelet.to_json()).serialize(),
+          restored.serialize())
+
+  def testBlipsAreBuiltLazily(self):
+    json = simplejson.loads(TEST_JSON)
+    other = dict(json['blips']['wdykLROk*13'])
+    other['blipId'] = 'wdykLROk*14'
+    other['parentBlipId'] = 'wdykLROk*13'
+    json['blips']['wdykLROk*14'] = other
+    wavelet = self.robot.blind_wavelet(simplejson.dumps(json))
+    self.assertEquals(2, len(wavelet.blips))
+    self.assertTrue('wdykLROk*14' in wavelet.blips)
+    self.assertEquals(['wdykLROk*14'], wavelet.blips._raw_blips.keys())
+    child = wavelet.blips['wdykLROk*14']
+    self.assertEquals('\nContent!', child.text)
+    self.assertTrue(child is wavelet.blips.get('wdykLROk*14'))
+    self.assertTrue(child.parent_blip is wavelet.root_blip)
+    self.assertEquals({}, wavelet.blips._raw_blips)
+    self.assertEquals(1, len(child.annotations))
+    # ids are shared between the objects of one bundle
+    self.assertTrue(child.wave_id is wavelet.root_blip.wave_id)
+    self.assertTrue(child.parent_blip_id is wavelet.root_blip.blip_id)
+
+  def testRawDataRetention(self):
+    self.assertRaises(ValueError, self.robot.set_raw_data_retention, 'some')
+    self.robot.set_raw_data_retention(robot.RAW_DATA_DROP)
+    wavelet = self.robot.blind_wavelet(TEST_JSON)
+    self.assertEquals(None, wavelet.raw_data)
+    self.assertEquals(None, wavelet.root_blip.raw_data)
+    self.assertEquals(1, len(wavelet.root_blip.annotations))
+    self.assertEquals('\nContent!', wavelet.root_blip.text)
+
+    self.robot.set_raw_data_retention(robot.RAW_DATA_LAZY)
+    wavelet = self.robot.blind_wavelet(TEST_JSON)
+    expected = simplejson.loads(TEST_JSON)
+    self.assertTrue(isinstance(wavelet._raw_data, util.RawJson))
+    self.assertEquals(expected['wavelet'], wavelet.raw_data)
+    root_blip = wavelet.root_blip
+    self.assertTrue(isinstance(root_blip._raw_data, util.RawJson))
+    self.assertEquals(expected['blips']['wdykLROk*13'], root_blip.raw_data)
+    self.assertEquals(1, len(root_blip.annotations))
+
+  def testLazySerializedWavelet(self):
+    source = self.robot.blind_wavelet(TEST_JSON)
+    source.root_blip.reply().append('reply text')
+    body = simplejson.dumps(source.serialize())
+    decoded = []
+    old_decode = util.RawJson.decode
+    def decode(raw):
+      decoded.append(raw.text())
+      return old_decode(raw)
+    self.robot.set_raw_data_retention(robot.RAW_DATA_LAZY)
+    util.RawJson.decode = decode
+    try:
+      wavelet = self.robot.blind_wavelet(body)
+    finally:
+      util.RawJson.decode = old_decode
+    # the wavelet fields and the root blip were decoded, not the body or
+    # the other blips
+    self.assertFalse([text for text in decoded if '"blips"' in text or
+                      'reply text' in text])
+    self.assertEquals(source.wave_id, wavelet.wave_id)
+    self.assertEquals(source.title, wavelet.title)
+    self.assertEquals(simplejson.loads(body), wavelet.raw_data)
+    self.assertEquals(source.root_blip.text, wavelet.root_blip.text)
+
+  def testBlipsArePartitionedByWavelet(self):
+    json = simplejson.loads(TEST_JSON)
+    other = dict(json['blips']['wdykLROk*13'])
+    other['blipId'] = 'other*1'
+    other['waveletId'] = 'test.com!conv+other'
+    json['blips']['other*1'] = other
+    wavelet = self.robot.blind_wavelet(simplejson.dumps(json))
+    self.assertEquals(1, len(wavelet.blips))
+    self.assertFalse('other*1' in wavelet.blips)
+    self.assertTrue(wavelet.blips is
+                    wavelet.get_blips(wavelet.wave_id, wavelet.wavelet_id))
+    others = wavelet.get_blips(wavelet.wave_id, 'test.com!conv+other')
+    self.assertEquals(['other*1'], others._raw_blips.keys())
+    self.assertEquals('test.com!conv+other', others['other*1'].wavelet_id)
+    self.assertEquals(None, wavelet.get_blips(wavelet.wave_id, 'unknown'))
+
+  def testRequestScopedIds(self):
+    self.robot._start_request()
+    first = self.robot.new_wave('test.com')
+    second = self.robot.new_wave('test.com')
+    self.assertNotEqual(first.wave_id, second.wave_id)
+    self.assertNotEqual(first.root_blip.blip_id, second.root_blip.blip_id)
+    self.robot._start_request()
+    third = self.robot.new_wave('test.com')
+    self.assertEquals(first.wave_id, third.wave_id)
+
+  def testMessageStore(self):
+    store = message_store.MemoryMessageStore()
+    self.robot.set_message_store(store)
+    source = self.robot.blind_wavelet(TEST_JSON)
+    new_wave = self.robot.new_wave('test.com', message=source.serialize())
+    op = new_wave.get_operation_queue().serialize()[-1]
+    key = op['params']['message']
+    self.assertTrue(message_store.is_key(key))
+    event = events.WaveletCreated(
+        {'type': events.WaveletCreated.type,
+         'properties': {'message': key}}, new_wave)
+    self.assertEquals(source.serialize(), simplejson.loads(event.message))
+    self.assertEquals(source.wave_id,
+                      self.robot.blind_wavelet(key).wave_id)
+    self.assertEquals('plain', self.robot.resolve_message('plain'))
+    self.assertEquals(None, self.robot.resolve_message(
+        message_store.KEY_PREFIX + '0' * 24))
+
+  def testBlindWaveletExpiredMessage(self):
+    now = [1000.0]
+    store = message_store.MemoryMessageStore(max_age=60,
+                                             clock=lambda: now[0])
+    self.robot.set_message_store(store)
+    key = store.put(TEST_JSON)
+    self.assertEquals(TEST_JSON, self.robot.resolve_message(key))
+    now[0] += 61
+    self.assertRaises(KeyError, self.robot.blind_wavelet, key)
+
+
+class TestMakeRpc(unittest.TestCase):
+  """Tests for splitting up rpcs in make_rpc."""
+
+  class Consumer(object):
+    key = 'key'
+
+  class NoAsyncUrlfetch(object):
+    POST = 'POST'
+
+  def setUp(self):
+    self.robot = robot.Robot('Testy')
+    self.robot._oauth_consumer = self.Consumer()
+    self.posted = []
+    self.started = []
+    self.robot._post_rpc = self.post_rpc
+    self.robot._start_rpc = self.start_rpc
+    self.old_oauth = robot.oauth
+    robot.oauth = True
+    self.old_urlfetch = robot.urlfetch
+
+  def tearDown(self):
+    robot.oauth = self.old_oauth
+    robot.urlfetch = self.old_urlfetch
+
+  def post_rpc(self, body):
+    rpcs = simplejson.loads(body)
+    self.posted.append([rpc['id'] for rpc in rpcs])
+    return [{'id': rpc['id'], 'data': {}} for rpc in reversed(rpcs)]
+
+  def start_rpc(self, body):
+    self.started.append(len(self.posted))
+    return lambda: self.post_rpc(body)
+
+  def fill(self):
+    queue = ops.OperationQueue(id_allocator=ops.IdAllocator())
+    for i in range(5):
+      queue.DocumentAppend('w', 'wl', 'b%d' % (i % 2), 'text')
+    return queue
+
+  def testSingleRpc(self):
+    queue = self.fill()
+    self.robot.make_rpc(queue)
+    self.assertEquals([['op1', 'op2', 'op3', 'op4', 'op5']], self.posted)
+
+  def testChunkedRpc(self):
+    queue = self.fill()
+    self.robot.set_rpc_limits(max_operations=2)
+    results = self.robot.make_rpc(queue)
+    self.assertEquals([['op1', 'op2'], ['op3', 'op4'], ['op5']], self.posted)
+    self.assertEquals(['op1', 'op2', 'op3', 'op4', 'op5'],
+                      [result['id'] for result in results])
+
+  def testParallelRpc(self):
+    queue = self.fill()
+    self.robot.set_rpc_limits(max_operations=2, max_parallel=2)
+    results = self.robot.make_rpc(queue)
+    self.assertEquals([['op1', 'op3'], ['op2', 'op4'], ['op5']],
+                      sorted(self.posted))
+    self.assertEquals(['op1', 'op2', 'op3', 'op4', 'op5'],
+                      [result['id'] for result in results])
+    # both groups were started before waiting for either
+    self.assertEquals([0, 0, 1], self.started)
+
+  def testSequentialFallback(self):
+    robot.urlfetch = self.NoAsyncUrlfetch()
+    queue = self.fill()
+    self.robot.set_rpc_limits(max_operations=2, max_parallel=2)
+    results = self.robot.make_rpc(queue)
+    self.assertEquals([], self.started)
+    self.assertEquals([['op1', 'op3'], ['op5'], ['op2', 'op4']], self.posted)
+    self.assertEquals(['op1', 'op2', 'op3', 'op4', 'op5'],
+                      [result['id'] for result in results])
+
+  def testHttpPostAsyncHook(self):
+    # a replaced hook is used even without asynchronous urlfetch calls
+    robot.urlfetch = self.NoAsyncUrlfetch()
+    del self.robot._start_rpc
+    self.robot._sign_rpc = lambda body: 'http://example.com/rpc'
+    waited = []
+    started = []
+    def http_post_async(url, data, headers):
+      started.append(len(waited))
+      def wait():
+        waited.append(url)
+        return 200, simplejson.dumps(self.post_rpc(data))
+      return wait
+    self.robot.http_post_async = http_post_async
+    queue = self.fill()
+    self.robot.set_rpc_limits(max_operations=2, max_parallel=2)
+    results = self.robot.make_rpc(queue)
+    self.assertEquals([0, 0, 1], started)
+    self.assertEquals([['op1', 'op3'], ['op2', 'op4'], ['op5']],
+                      sorted(self.posted))
+    self.assertEquals(['op1', 'op2', 'op3', 'op4', 'op5'],
+                      [result['id'] for result in results])
+
+  def testTempIdsStayInOneRpc(self):
+    queue = ops.OperationQueue(id_allocator=ops.IdAllocator())
+    queue.DocumentAppend('w', 'wl', 'b0', 'text')
+    child = queue.BlipCreateChild('w', 'wl', 'b0')
+    queue.DocumentAppend('w', 'wl', 'b1', 'other')
+    queue.DocumentAppend('w', 'wl', child.blipId, 'reply')
+    root_blip, wavelet_data = queue.WaveletCreate('example.com')
+    queue.DocumentAppend(wavelet_data.waveId, wavelet_data.waveletId,
+                         root_blip.blipId, 'new wave')
+    queue.DocumentAppend('w', 'wl', 'b1', 'last')
+    self.robot.set_rpc_limits(max_operations=2)
+    self.robot.make_rpc(queue)
+    self.assertEquals([['op1'], ['op2', 'op3', 'op4'], ['op5', 'op6'],
+                       ['op7']], self.posted)
+
 
 class TestGetCapabilitiesXml(unittest.TestCase):
 
@@ -0,0 +1,202 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Defines the Rope class used to store the text content of blips.
+
+A rope keeps a string as a sequence of chunks in a balanced tree, so
+inserting or deleting text costs O(log n) instead of copying the whole
+string. The tree used here is a treap ordered on position.
+"""
+
+import random
+
+# Strings are split up into chunks of at most this size when added.
+MAX_CHUNK_SIZE = 512
+
+
+class _Node(object):
+  """A chunk of text in the rope with its subtrees."""
+
+  __slots__ = ('text', 'priority', 'left', 'right', 'length')
+
+  def __init__(self, text, priority=None):
+    self.text = text
+    if priority is None:
+      priority = random.random()
+    self.priority = priority
+    self.left = None
+    self.right = None
+    self.length = len(text)
+
+
+def _length(node):
+  if node is None:
+    return 0
+  return node.length
+
+
+def _update(node):
+  node.length = len(node.text) + _length(node.left) + _length(node.right)
+
+
+def _merge(left, right):
+  """Merges two trees, with all of left before all of right."""
+  if left is None:
+    return right
+  if right is None:
+    return left
+  if left.priority > right.priority:
+    left.right = _merge(left.right, right)
+    _update(left)
+    return left
+  right.left = _merge(left, right.left)
+  _update(right)
+  return right
+
+
+def _split(node, index):
+  """Splits a tree into the first index characters and the rest."""
+  if node is None:
+    return None, None
+  left_length = _length(node.left)
+  if index <= left_length:
+    left, node.left = _split(node.left, index)
+    _update(node)
+    return left, node
+  index -= left_length
+  if index >= len(node.text):
+    node.right, right = _split(node.right, index - len(node.text))
+    _update(node)
+    return node, right
+  # The split falls within the text of this node. The tail keeps the
+  # priority of the node so the heap property holds for its subtree.
+  tail = _Node(node.text[index:], node.priority)
+  tail.right = node.right
+  _update(tail)
+  node.text = node.text[:index]
+  node.right = None
+  _update(node)
+  return node, tail
+
+
+def _build(text):
+  """Builds a tree for text, splitting it up into chunks."""
+  res = None
+  for start in xrange(0, len(text), MAX_CHUNK_SIZE):
+    res = _merge(res, _Node(text[start:start + MAX_CHUNK_SIZE]))
+  return res
+
+
+def _collect(node, chunks):
+  """Appends the text of all chunks in node to chunks, in order."""
+  stack = []
+  while stack or node is not None:
+    if node is not None:
+      stack.append(node)
+      node = node.left
+    else:
+      node = stack.pop()
+      chunks.append(node.text)
+      node = node.right
+
+
+class Rope(object):
+  """A mutable string supporting O(log n) inserts and deletes.
+
+  The plain string value is materialized on demand by text() and cached
+  until the next modification.
+  """
+
+  __slots__ = ('_root', '_text')
+
+  def __init__(self, text=''):
+    self._root = _build(text)
+    self._text = text
+
+  def __len__(self):
+    return _length(self._root)
+
+  def text(self):
+    """Returns the content of the rope as a plain string."""
+    if self._text is None:
+      chunks = []
+      _collect(self._root, chunks)
+      self._text = ''.join(chunks)
+    return self._text
+
+  def slice(self, start, end):
+    """Returns the characters from start up to end.
+
+    Only the chunks in the range are visited, so this does not materialize
+    the whole string after a modification.
+    """
+    if self._text is not None:
+      return self._text[start:end]
+    start = max(start, 0)
+    end = min(end, len(self))
+    chunks = []
+    node = self._root
+    # offset of the start of node in the rope
+    offset = 0
+    stack = []
+    while stack or node is not None:
+      if node is not None:
+        if offset + _length(node.left) <= start:
+          # nothing before the text of node is in the range
+          offset += _length(node.left)
+          stack.append((node, offset))
+          node = None
+        else:
+          stack.append((node, offset + _length(node.left)))
+          node = node.left
+      else:
+        node, offset = stack.pop()
+        if offset >= end:
+          break
+        chunks.append(node.text[max(start - offset, 0):end - offset])
+        offset += len(node.text)
+        node = node.right
+    return ''.join(chunks)
+
+  def __getitem__(self, item):
+    if isinstance(item, slice) and item.step is None:
+      start, end, _ = item.indices(len(self))
+      return self.slice(start, end)
+    return self.text()[item]
+
+  def insert(self, index, text):
+    """Inserts text before position index."""
+    if not text:
+      return
+    left, right = _split(self._root, index)
+    self._root = _merge(_merge(left, _build(text)), right)
+    self._text = None
+
+  def delete(self, start, end):
+    """Deletes the characters from start up to end."""
+    if end <= start:
+      return
+    left, rest = _split(self._root, start)
+    middle, right = _split(rest, end - start)
+    self._root = _merge(left, right)
+    self._text = None
+
+  def replace(self, start, end, text):
+    """Replaces the characters from start up to end with text."""
+    left, rest = _split(self._root, start)
+    middle, right = _split(rest, end - start)
+    self._root = _merge(_merge(left, _build(text)), right)
+    self._text = None
@@ -0,0 +1,79 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the rope module."""
+
+
+import random
+import unittest
+
+import rope
+
+
+class TestRope(unittest.TestCase):
+  """Tests for the rope.Rope class."""
+
+  def testEditing(self):
+    r = rope.Rope('hello world')
+    self.assertEquals(11, len(r))
+    r.insert(5, ',')
+    r.replace(7, 12, 'jupiter')
+    r.delete(0, 1)
+    r.insert(len(r), '!')
+    self.assertEquals('ello, jupiter!', r.text())
+    self.assertEquals(14, len(r))
+    self.assertEquals('jupiter', r[6:13])
+
+  def testEmpty(self):
+    r = rope.Rope()
+    self.assertEquals(0, len(r))
+    self.assertEquals('', r.text())
+    r.insert(0, 'a')
+    r.delete(0, 1)
+    self.assertEquals('', r.text())
+
+  def testRandomEditsMatchString(self):
+    generator = random.Random(42)
+    text = 'x' * (3 * rope.MAX_CHUNK_SIZE + 7)
+    r = rope.Rope(text)
+    for i in range(500):
+      start = generator.randint(0, len(text))
+      end = generator.randint(start, min(len(text), start + 20))
+      insert = 'abc'[:generator.randint(0, 3)]
+      text = text[:start] + insert + text[end:]
+      r.replace(start, end, insert)
+      self.assertEquals(len(text), len(r))
+    self.assertEquals(text, r.text())
+
+  def testSliceDoesNotMaterialize(self):
+    generator = random.Random(7)
+    text = ''.join([chr(ord('a') + i % 26)
+                    for i in range(4 * rope.MAX_CHUNK_SIZE)])
+    r = rope.Rope(text)
+    for i in range(50):
+      start = generator.randint(0, len(text))
+      text = text[:start] + 'XY' + text[start:]
+      r.insert(start, 'XY')
+      start = generator.randint(0, len(text))
+      end = generator.randint(start, len(text))
+      self.assertEquals(text[start:end], r[start:end])
+      self.assertEquals(None, r._text)
+    self.assertEquals(text[-10:], r[-10:])
+    self.assertEquals(text, r.text())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -17,11 +17,19 @@
 """Script to run all unit tests in this package."""
 
 
+import archive_test
 import blip_test
+import conversation_test
 import element_test
+import intervals_test
+import message_store_test
 import module_test_runner
 import ops_test
 import robot_test
+import rope_test
+import search_test
+import snapshot_test
+import textdiff_test
 import util_test
 import wavelet_test
 
@@ -30,10 +38,18 @@ def RunUnitTests():
   """Runs all registered unit tests."""
   test_runner = module_test_runner.ModuleTestRunner()
   test_runner.modules = [
+      archive_test,
       blip_test,
+      conversation_test,
       element_test,
+      intervals_test,
+      message_store_test,
       ops_test,
       robot_test,
+      rope_test,
+      search_test,
+      snapshot_test,
+      textdiff_test,
       util_test,
       wavelet_test,
   ]
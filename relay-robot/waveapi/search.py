@@ -0,0 +1,215 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Text search helpers used by BlipRefs to find matches in blip content."""
+
+import heapq
+import re
+
+# Compiled patterns are cached up to this many, after which the cache is
+# emptied and starts over.
+MAX_CACHED_PATTERNS = 100
+
+_pattern_cache = {}
+
+
+def is_pattern(what):
+  """Returns whether what is a compiled regular expression."""
+  return hasattr(what, 'finditer')
+
+
+def compile_pattern(what, ignore_case=False):
+  """Returns a compiled regular expression for a string or pattern.
+
+  Args:
+    what: a plain string, matched literally, or a compiled pattern.
+    ignore_case: whether the match should be case insensitive.
+  Returns:
+    A compiled pattern, shared between calls with the same arguments.
+  """
+  if is_pattern(what) and not ignore_case:
+    return what
+  key = (what, ignore_case)
+  res = _pattern_cache.get(key)
+  if res is None:
+    flags = 0
+    if ignore_case:
+      flags = re.IGNORECASE | re.UNICODE
+    if is_pattern(what):
+      res = re.compile(what.pattern, what.flags | flags)
+    else:
+      res = re.compile(re.escape(what), flags)
+    if len(_pattern_cache) >= MAX_CACHED_PATTERNS:
+      _pattern_cache.clear()
+    _pattern_cache[key] = res
+  return res
+
+
+def find_text(content, what, maxres=-1, ignore_case=False):
+  """Returns the ranges where what occurs in content.
+
+  Args:
+    content: the text to search.
+    what: a string or a compiled regular expression.
+    maxres: number of results to return at most, or <= 0 for all.
+    ignore_case: whether to match case insensitively.
+  Returns:
+    A list of (start, end) tuples of non overlapping, non empty matches
+    in order.
+  """
+  res = []
+  if not is_pattern(what) and not ignore_case:
+    if not what:
+      return res
+    idx = content.find(what)
+    while idx != -1 and (maxres <= 0 or len(res) < maxres):
+      res.append((idx, idx + len(what)))
+      idx = content.find(what, idx + len(what))
+    return res
+  for match in compile_pattern(what, ignore_case).finditer(content):
+    start, end = match.span()
+    if start == end:
+      continue
+    res.append((start, end))
+    if 0 < maxres <= len(res):
+      break
+  return res
+
+
+class MultiMatcher(object):
+  """Finds the occurrences of many strings in a single pass over the text.
+
+  This is an Aho-Corasick automaton: a trie of the strings with failure
+  links, so the text is scanned once whatever the number of strings.
+  """
+
+  def __init__(self, patterns):
+    # per state: the transitions, the failure link, the strings that end
+    # in that state and the length of the prefix the state stands for
+    self._goto = [{}]
+    self._fail = [0]
+    self._output = [[]]
+    self._depth = [0]
+    for pattern in patterns:
+      if pattern:
+        self._add(pattern)
+    self._link()
+
+  def _add(self, pattern):
+    state = 0
+    for char in pattern:
+      next = self._goto[state].get(char)
+      if next is None:
+        next = len(self._goto)
+        self._goto[state][char] = next
+        self._goto.append({})
+        self._fail.append(0)
+        self._output.append([])
+        self._depth.append(self._depth[state] + 1)
+      state = next
+    self._output[state].append(pattern)
+
+  def _link(self):
+    """Computes the failure links breadth first."""
+    queue = self._goto[0].values()
+    head = 0
+    while head < len(queue):
+      state = queue[head]
+      head += 1
+      for char, next in self._goto[state].items():
+        queue.append(next)
+        fail = self._fail[state]
+        while fail and char not in self._goto[fail]:
+          fail = self._fail[fail]
+        self._fail[next] = self._goto[fail].get(char, 0)
+        self._output[next] = (self._output[next] +
+                              self._output[self._fail[next]])
+
+  def find(self, content, maxres=-1):
+    """Returns where the strings occur in content.
+
+    Where matches overlap, the one that starts first wins, and of those
+    starting at the same position the longest. Matches are resolved while
+    scanning, so the scan stops once maxres of them are found.
+
+    Args:
+      content: the text to search.
+      maxres: number of results to return at most, or <= 0 for all.
+    Returns:
+      A list of (start, end, string) tuples in order.
+    """
+    goto = self._goto
+    fail = self._fail
+    output = self._output
+    depth = self._depth
+    res = []
+    # matches that are not resolved yet, as (start, -length, string)
+    candidates = []
+    # end of the last match taken
+    pos = 0
+    state = 0
+    for index, char in enumerate(content):
+      while state and char not in goto[state]:
+        state = fail[state]
+      state = goto[state].get(char, 0)
+      # every match from here on starts at horizon or later, so whatever
+      # starts before it is known to be the leftmost longest there
+      horizon = index + 1 - depth[state]
+      while candidates and candidates[0][0] < horizon:
+        start, length, pattern = heapq.heappop(candidates)
+        if start >= pos:
+          pos = start - length
+          res.append((start, pos, pattern))
+          if 0 < maxres <= len(res):
+            return res
+      for pattern in output[state]:
+        start = index + 1 - len(pattern)
+        if start >= pos:
+          heapq.heappush(candidates, (start, -len(pattern), pattern))
+    while candidates:
+      start, length, pattern = heapq.heappop(candidates)
+      if start >= pos:
+        pos = start - length
+        res.append((start, pos, pattern))
+        if 0 < maxres <= len(res):
+          break
+    return res
+
+
+_matcher_cache = {}
+
+
+def find_many(content, patterns, maxres=-1):
+  """Returns where any of patterns occurs in content.
+
+  The matcher for a set of patterns is cached, so repeatedly searching for
+  the same strings only builds it once.
+
+  Args:
+    content: the text to search.
+    patterns: a sequence of strings.
+    maxres: number of results to return at most, or <= 0 for all.
+  Returns:
+    A list of (start, end, pattern) tuples, see MultiMatcher.find.
+  """
+  key = tuple(sorted(patterns))
+  matcher = _matcher_cache.get(key)
+  if matcher is None:
+    matcher = MultiMatcher(key)
+    if len(_matcher_cache) >= MAX_CACHED_PATTERNS:
+      _matcher_cache.clear()
+    _matcher_cache[key] = matcher
+  return matcher.find(content, maxres)
@@ -0,0 +1,104 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the search module."""
+
+
+import re
+import unittest
+
+import search
+
+
+class TestFindText(unittest.TestCase):
+  """Tests for search.find_text."""
+
+  def testExact(self):
+    self.assertEquals([(0, 2), (2, 4)], search.find_text('aaaaa', 'aa'))
+    self.assertEquals([(0, 2)], search.find_text('aaaaa', 'aa', maxres=1))
+    self.assertEquals([], search.find_text('aaaaa', 'b'))
+    self.assertEquals([], search.find_text('aaaaa', ''))
+
+  def testZeroMaxresFindsAll(self):
+    self.assertEquals([(0, 2), (2, 4)],
+                      search.find_text('aaaaa', 'aa', maxres=0))
+    self.assertEquals([(0, 2), (2, 4)],
+                      search.find_text('aAaaa', 'aa', maxres=0,
+                                       ignore_case=True))
+    self.assertEquals([(0, 2), (3, 5)],
+                      search.find_text('12 34', re.compile(r'\d+'),
+                                       maxres=0))
+    self.assertEquals([(0, 1, 'a'), (1, 2, 'a')],
+                      search.MultiMatcher(['a']).find('aa', maxres=0))
+
+  def testIgnoreCase(self):
+    self.assertEquals([(0, 5), (6, 11)],
+                      search.find_text(u'Hello hELLo', 'hello',
+                                       ignore_case=True))
+    self.assertEquals([(0, 2)],
+                      search.find_text('a.ab', 'A.', ignore_case=True))
+
+  def testPattern(self):
+    pattern = re.compile(r'\d+')
+    self.assertEquals([(2, 4), (5, 6)], search.find_text('a 12 3', pattern))
+    self.assertEquals([(2, 4)], search.find_text('a 12 3', pattern, maxres=1))
+    # empty matches are skipped
+    self.assertEquals([(1, 2)], search.find_text('a1b', re.compile(r'\d*')))
+
+  def testPatternsAreCached(self):
+    pattern = re.compile('abc')
+    self.assertTrue(pattern is search.compile_pattern(pattern))
+    self.assertTrue(search.compile_pattern('abc', True) is
+                    search.compile_pattern('abc', True))
+    self.assertEquals([(0, 3)],
+                      search.find_text('ABC', pattern, ignore_case=True))
+
+
+class TestMultiMatcher(unittest.TestCase):
+  """Tests for search.MultiMatcher and search.find_many."""
+
+  def testFind(self):
+    matcher = search.MultiMatcher(['he', 'she', 'his', 'hers'])
+    self.assertEquals([(1, 4, 'she'), (7, 10, 'his')],
+                      matcher.find('ushers his'))
+    self.assertEquals([(0, 4, 'hers')], matcher.find('hers'))
+    self.assertEquals([(1, 4, 'she')], matcher.find('ushers his', maxres=1))
+
+  def testLeftmostLongest(self):
+    matcher = search.MultiMatcher(['a', 'ab', 'bc', 'abcd'])
+    self.assertEquals([(0, 4, 'abcd'), (4, 5, 'a')], matcher.find('abcda'))
+    self.assertEquals([(0, 2, 'ab')], matcher.find('abc'))
+
+  def testMaxresStopsScan(self):
+    read = []
+    def content():
+      for char in 'xab' + 'ab' * 1000:
+        read.append(char)
+        yield char
+    matcher = search.MultiMatcher(['a', 'ab', 'abx'])
+    self.assertEquals([(1, 3, 'ab')], matcher.find(content(), maxres=1))
+    self.assertTrue(len(read) < 10)
+
+  def testFindMany(self):
+    content = '{name} lives in {city}, {name}!'
+    self.assertEquals([(0, 6, '{name}'), (16, 22, '{city}'),
+                       (24, 30, '{name}')],
+                      search.find_many(content, ['{city}', '{name}']))
+    self.assertEquals([], search.find_many(content, []))
+
+
+if __name__ == '__main__':
+  unittest.main()
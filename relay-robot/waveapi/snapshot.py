@@ -0,0 +1,372 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A binary format to save wavelets in and restore them from.
+
+A snapshot holds what Wavelet.serialize returns, packed with struct so it
+can be read back without a JSON decode:
+
+  header: magic 'WVSN', format version byte, flags byte
+  payload: zlib compressed if the COMPRESSED flag is set
+    string table: count, then per string its length and utf-8 bytes
+    wavelet: the _WAVELET_FIELDS
+    blip count, then per blip: its blip, wave and wavelet id, the length
+        of its record and the record
+    blip record: the _BLIP_RECORD_FIELDS, annotations and elements
+
+All numbers are big endian. Ids and other strings that repeat between
+blips are indices into the string table, -1 for None, other values are
+tagged with their type. The length in front of each blip record lets a
+restore skip over it, a blip is only decoded when it is first looked up.
+Any change to this layout has to come with a new format version.
+"""
+
+import struct
+import zlib
+
+MAGIC = 'WVSN'
+FORMAT_VERSION = 3
+
+# Flags in the header.
+COMPRESSED = 1
+
+_HEADER = '>4sBB'
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+_COUNT = struct.Struct('>I')
+_ID = struct.Struct('>i')
+_INT = struct.Struct('>q')
+_FLOAT = struct.Struct('>d')
+# blip id, wave id, wavelet id, length of the record
+_BLIP_ENTRY = struct.Struct('>iiiI')
+# name, start, end
+_ANNOTATION = struct.Struct('>iii')
+# position, type
+_ELEMENT = struct.Struct('>ii')
+
+# Tags of the values that are not ids.
+_NONE_TAG = 'N'
+_TRUE_TAG = 'T'
+_FALSE_TAG = 'F'
+_INT_TAG = 'i'
+_FLOAT_TAG = 'f'
+_STRING_TAG = 's'
+_LIST_TAG = 'l'
+_DICT_TAG = 'd'
+
+# Order of the fields in the payload. Those in _ID_FIELDS are string table
+# indices, counted lists of those for _ID_LIST_FIELDS, the others tagged
+# values.
+_WAVELET_FIELDS = ('waveId', 'waveletId', 'creator', 'creationTime',
+                   'dataDocuments', 'lastModifiedTime', 'participants',
+                   'title', 'rootBlipId', 'robotAddress')
+_BLIP_RECORD_FIELDS = ('childBlipIds', 'content', 'creator', 'contributors',
+                       'lastModifiedTime', 'parentBlipId')
+_ID_FIELDS = frozenset(['waveId', 'waveletId', 'creator', 'rootBlipId',
+                        'robotAddress', 'blipId', 'parentBlipId'])
+_ID_LIST_FIELDS = frozenset(['participants', 'childBlipIds', 'contributors'])
+
+
+class _StringTable(object):
+  """Hands out an index per distinct string."""
+
+  def __init__(self):
+    self.strings = []
+    self._indices = {}
+
+  def index(self, value):
+    if value is None:
+      return -1
+    res = self._indices.get(value)
+    if res is None:
+      res = len(self.strings)
+      self._indices[value] = res
+      self.strings.append(value)
+    return res
+
+
+def _write_string(out, value):
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  out.append(_COUNT.pack(len(value)))
+  out.append(value)
+
+
+def _write_value(out, value):
+  if value is None:
+    out.append(_NONE_TAG)
+  elif value is True:
+    out.append(_TRUE_TAG)
+  elif value is False:
+    out.append(_FALSE_TAG)
+  elif isinstance(value, (int, long)):
+    out.append(_INT_TAG)
+    out.append(_INT.pack(value))
+  elif isinstance(value, float):
+    out.append(_FLOAT_TAG)
+    out.append(_FLOAT.pack(value))
+  elif isinstance(value, basestring):
+    out.append(_STRING_TAG)
+    _write_string(out, value)
+  elif isinstance(value, (list, tuple)):
+    out.append(_LIST_TAG)
+    out.append(_COUNT.pack(len(value)))
+    for item in value:
+      _write_value(out, item)
+  elif isinstance(value, dict):
+    out.append(_DICT_TAG)
+    out.append(_COUNT.pack(len(value)))
+    for key, item in value.items():
+      _write_string(out, key)
+      _write_value(out, item)
+  else:
+    raise TypeError('Cannot save %r in a snapshot' % (value,))
+
+
+def _write_fields(out, json, fields, table):
+  for field in fields:
+    value = json.get(field)
+    if field in _ID_FIELDS:
+      out.append(_ID.pack(table.index(value)))
+    elif field in _ID_LIST_FIELDS:
+      value = value or []
+      out.append(_COUNT.pack(len(value)))
+      out.extend([_ID.pack(table.index(id)) for id in value])
+    else:
+      _write_value(out, value)
+
+
+def _blip_record(json, table):
+  out = []
+  _write_fields(out, json, _BLIP_RECORD_FIELDS, table)
+  annotations = json.get('annotations', [])
+  out.append(_COUNT.pack(len(annotations)))
+  for ann in annotations:
+    out.append(_ANNOTATION.pack(table.index(ann['name']),
+                                ann['range']['start'], ann['range']['end']))
+    _write_value(out, ann['value'])
+  elements = json.get('elements', {})
+  out.append(_COUNT.pack(len(elements)))
+  for index, el in elements.items():
+    out.append(_ELEMENT.pack(int(index), table.index(el['type'])))
+    _write_value(out, el['properties'])
+  return ''.join(out)
+
+
+class _Reader(object):
+  """Reads the numbers and values of a payload from some offset on."""
+
+  def __init__(self, data, offset=0):
+    self._data = data
+    self.offset = offset
+
+  def unpack(self, fmt):
+    res = fmt.unpack_from(self._data, self.offset)
+    self.offset += fmt.size
+    return res
+
+  def count(self):
+    return self.unpack(_COUNT)[0]
+
+  def string(self):
+    start = self.offset + _COUNT.size
+    self.offset = start + self.count()
+    if self.offset > len(self._data):
+      raise ValueError('String runs past the end')
+    return self._data[start:self.offset].decode('utf-8')
+
+  def value(self):
+    tag = self._data[self.offset]
+    self.offset += 1
+    if tag == _STRING_TAG:
+      return self.string()
+    elif tag == _INT_TAG:
+      return self.unpack(_INT)[0]
+    elif tag == _NONE_TAG:
+      return None
+    elif tag == _DICT_TAG:
+      res = {}
+      for _ in xrange(self.count()):
+        key = self.string()
+        res[key] = self.value()
+      return res
+    elif tag == _LIST_TAG:
+      return [self.value() for _ in xrange(self.count())]
+    elif tag == _TRUE_TAG:
+      return True
+    elif tag == _FALSE_TAG:
+      return False
+    elif tag == _FLOAT_TAG:
+      return self.unpack(_FLOAT)[0]
+    raise ValueError('Unknown value tag %r' % tag)
+
+  def id(self, strings):
+    return _string_at(strings, self.unpack(_ID)[0])
+
+  def fields(self, fields, strings, res):
+    for field in fields:
+      if field in _ID_FIELDS:
+        value = self.id(strings)
+      elif field in _ID_LIST_FIELDS:
+        value = [self.id(strings) for _ in xrange(self.count())]
+      else:
+        value = self.value()
+      res[field] = value
+    return res
+
+
+def _string_at(strings, index):
+  if index == -1:
+    return None
+  return strings[index]
+
+
+def _corrupt(e):
+  return ValueError('Corrupt wavelet snapshot: %s' % e)
+
+
+class RawBlip(object):
+  """A blip of a snapshot that is decoded when it is asked for.
+
+  Attributes:
+    blip_id: the id of the blip.
+    wave_id: the id of the wave the blip belongs to.
+    wavelet_id: the id of the wavelet the blip belongs to.
+  """
+
+  __slots__ = ('blip_id', 'wave_id', 'wavelet_id', '_data', '_offset',
+               '_strings')
+
+  def __init__(self, blip_id, wave_id, wavelet_id, data, offset, strings):
+    self.blip_id = blip_id
+    self.wave_id = wave_id
+    self.wavelet_id = wavelet_id
+    self._data = data
+    self._offset = offset
+    self._strings = strings
+
+  def decode(self):
+    """Returns the json of the blip, in the format of Blip.serialize.
+
+    Raises:
+      ValueError: if the record of the blip is corrupt.
+    """
+    strings = self._strings
+    reader = _Reader(self._data, self._offset)
+    res = {'blipId': self.blip_id}
+    try:
+      reader.fields(_BLIP_RECORD_FIELDS, strings, res)
+      annotations = []
+      for _ in xrange(reader.count()):
+        name, start, end = reader.unpack(_ANNOTATION)
+        annotations.append({'name': strings[name],
+                            'value': reader.value(),
+                            'range': {'start': start, 'end': end}})
+      elements = {}
+      for _ in xrange(reader.count()):
+        index, el_type = reader.unpack(_ELEMENT)
+        elements[index] = {'type': strings[el_type],
+                           'properties': reader.value()}
+    except (struct.error, IndexError, UnicodeDecodeError), e:
+      raise _corrupt(e)
+    res['annotations'] = annotations
+    res['elements'] = elements
+    res['waveId'] = self.wave_id
+    res['waveletId'] = self.wavelet_id
+    return res
+
+
+def dumps(wavelet, compress=False):
+  """Returns a snapshot of wavelet and its blips as a string.
+
+  Args:
+    wavelet: the wavelet.Wavelet to save.
+    compress: whether to compress the payload with zlib.
+  """
+  json = wavelet.serialize()
+  json['robotAddress'] = wavelet.robot_address
+  table = _StringTable()
+  body = []
+  _write_fields(body, json, _WAVELET_FIELDS, table)
+  blips = json['blips'].values()
+  body.append(_COUNT.pack(len(blips)))
+  for blip_json in blips:
+    record = _blip_record(blip_json, table)
+    body.append(_BLIP_ENTRY.pack(table.index(blip_json.get('blipId')),
+                                 table.index(blip_json.get('waveId')),
+                                 table.index(blip_json.get('waveletId')),
+                                 len(record)))
+    body.append(record)
+  # the string table goes first, but is only complete now
+  out = [_COUNT.pack(len(table.strings))]
+  for value in table.strings:
+    _write_string(out, value)
+  payload = ''.join(out + body)
+  flags = 0
+  if compress:
+    payload = zlib.compress(payload)
+    flags |= COMPRESSED
+  return struct.pack(_HEADER, MAGIC, FORMAT_VERSION, flags) + payload
+
+
+def loads(data, lazy=False):
+  """Returns the json of a snapshot, in the format Robot.blind_wavelet takes.
+
+  Args:
+    data: the snapshot, a string or buffer.
+    lazy: whether to leave the blips as RawBlip objects that are decoded
+        when asked for. The wavelet fields then go under a 'wavelet' key and
+        the robot address under 'robotAddress', like in an event bundle.
+        Otherwise the robot address is one of the wavelet fields.
+
+  Raises:
+    ValueError: if data is not a snapshot of a version this module reads.
+  """
+  if len(data) < _HEADER_SIZE:
+    raise ValueError('Not a wavelet snapshot')
+  magic, version, flags = struct.unpack(_HEADER, data[:_HEADER_SIZE])
+  if magic != MAGIC:
+    raise ValueError('Not a wavelet snapshot')
+  if version != FORMAT_VERSION:
+    raise ValueError('Unsupported snapshot version %d' % version)
+  payload = str(data[_HEADER_SIZE:])
+  try:
+    if flags & COMPRESSED:
+      payload = zlib.decompress(payload)
+    reader = _Reader(payload)
+    strings = [reader.string() for _ in xrange(reader.count())]
+    fields = reader.fields(_WAVELET_FIELDS, strings, {})
+    blips = {}
+    for _ in xrange(reader.count()):
+      blip_id, wave_id, wavelet_id, length = reader.unpack(_BLIP_ENTRY)
+      blip_id = _string_at(strings, blip_id)
+      blips[blip_id] = RawBlip(blip_id, _string_at(strings, wave_id),
+                               _string_at(strings, wavelet_id),
+                               payload, reader.offset, strings)
+      reader.offset += length
+    if reader.offset != len(payload):
+      raise ValueError('%d bytes left' % (len(payload) - reader.offset))
+  except (zlib.error, struct.error, IndexError, UnicodeDecodeError,
+          ValueError), e:
+    raise _corrupt(e)
+  if lazy:
+    return {'wavelet': fields,
+            'robotAddress': fields.pop('robotAddress'),
+            'blips': blips}
+  for blip_id, raw in blips.items():
+    blips[blip_id] = raw.decode()
+  fields['blips'] = blips
+  return fields
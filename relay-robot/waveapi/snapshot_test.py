@@ -0,0 +1,90 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the snapshot module."""
+
+
+import unittest
+
+import blip
+import element
+import ops
+import snapshot
+import wavelet
+import wavelet_test
+
+
+class TestSnapshot(unittest.TestCase):
+  """Tests saving and loading snapshots."""
+
+  def setUp(self):
+    operation_queue = ops.OperationQueue()
+    blips = blip.Blips({})
+    root_blip = blip.Blip(wavelet_test.TEST_BLIP_DATA, blips, operation_queue)
+    blips._add(root_blip)
+    self.wavelet = wavelet.Wavelet(wavelet_test.TEST_WAVELET_DATA, blips,
+                                   None, operation_queue)
+    self.wavelet.robot_address = 'robot@test.com'
+    root_blip.range(1, 4).annotate('style/fontWeight', 'bold')
+    root_blip.append(element.Gadget('http://test.com/gadget.xml'))
+    reply = root_blip.reply()
+    reply.append(u'caf\xe9')
+
+  def testRoundTrip(self):
+    for compress in (False, True):
+      expected = self.wavelet.serialize()
+      loaded = snapshot.loads(snapshot.dumps(self.wavelet, compress))
+      self.assertEquals('robot@test.com', loaded.pop('robotAddress'))
+      expected_blips = expected.pop('blips')
+      loaded_blips = loaded.pop('blips')
+      self.assertEquals(expected, loaded)
+      self.assertEquals(sorted(expected_blips), sorted(loaded_blips))
+      for blip_id, blip_json in expected_blips.items():
+        self.assertEquals(blip_json, loaded_blips[blip_id])
+
+  def testLazyBlips(self):
+    data = snapshot.dumps(self.wavelet)
+    loaded = snapshot.loads(data)
+    lazy = snapshot.loads(data, lazy=True)
+    self.assertEquals('robot@test.com', lazy['robotAddress'])
+    self.assertEquals(loaded.pop('blips').keys(), lazy['blips'].keys())
+    del loaded['robotAddress']
+    self.assertEquals(loaded, lazy['wavelet'])
+    for blip_id, raw in lazy['blips'].items():
+      self.assertTrue(isinstance(raw, snapshot.RawBlip))
+      self.assertEquals(self.wavelet.wave_id, raw.wave_id)
+      self.assertEquals(self.wavelet.blips[blip_id].serialize(), raw.decode())
+
+  def testCompressedIsSmaller(self):
+    self.wavelet.root_blip.append('abc' * 1000)
+    self.assertTrue(len(snapshot.dumps(self.wavelet, True)) <
+                    len(snapshot.dumps(self.wavelet)))
+
+  def testBadHeader(self):
+    data = snapshot.dumps(self.wavelet)
+    self.assertRaises(ValueError, snapshot.loads, 'WV')
+    self.assertRaises(ValueError, snapshot.loads, 'JSON' + data[4:])
+    self.assertRaises(ValueError, snapshot.loads,
+                      data[:4] + chr(snapshot.FORMAT_VERSION + 1) + data[5:])
+    self.assertRaises(ValueError, snapshot.loads, data[:-3])
+    compressed = snapshot.dumps(self.wavelet, True)
+    self.assertRaises(ValueError, snapshot.loads, compressed[:-3])
+    # a blip record that does not match its length
+    self.assertRaises(ValueError, snapshot.loads, data + 'x')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Computes the edits that turn one text into another.
+
+The common prefix and suffix are stripped first, the remainder is diffed
+character by character with Myers' O(ND) algorithm.
+"""
+
+# Above this many inserted plus deleted characters the diff gives up and
+# replaces everything between the common prefix and suffix.
+MAX_DIFF_COST = 1000
+
+
+def _common_prefix(a, b):
+  n = min(len(a), len(b))
+  i = 0
+  while i < n and a[i] == b[i]:
+    i += 1
+  return i
+
+
+def _common_suffix(a, b, limit):
+  """Returns the length of the common suffix, at most limit."""
+  i = 0
+  while i < limit and a[-1 - i] == b[-1 - i]:
+    i += 1
+  return i
+
+
+def _shortest_edit(a, b, max_cost):
+  """Runs the forward pass of Myers' algorithm.
+
+  Returns:
+    The furthest reaching x per diagonal before every round, or None if
+    more than max_cost edits are needed.
+  """
+  n = len(a)
+  m = len(b)
+  v = {1: 0}
+  trace = []
+  for d in xrange(min(n + m, max_cost) + 1):
+    trace.append(v.copy())
+    for k in xrange(-d, d + 1, 2):
+      if k == -d or (k != d and v[k - 1] < v[k + 1]):
+        x = v[k + 1]
+      else:
+        x = v[k - 1] + 1
+      y = x - k
+      while x < n and y < m and a[x] == b[y]:
+        x += 1
+        y += 1
+      v[k] = x
+      if x >= n and y >= m:
+        return trace
+  return None
+
+
+def _edits_from_trace(a, b, trace):
+  """Walks back through the trace and groups the changes into edits."""
+  x = len(a)
+  y = len(b)
+  # (kind, x, y) from the end backwards: '=' keeps a[x], '-' deletes a[x],
+  # '+' inserts b[y] before a[x]
+  script = []
+  for d in xrange(len(trace) - 1, -1, -1):
+    v = trace[d]
+    k = x - y
+    if k == -d or (k != d and v[k - 1] < v[k + 1]):
+      prev_k = k + 1
+    else:
+      prev_k = k - 1
+    prev_x = v[prev_k]
+    prev_y = prev_x - prev_k
+    while x > prev_x and y > prev_y:
+      x -= 1
+      y -= 1
+      script.append(('=', x, y))
+    if d > 0:
+      if x == prev_x:
+        script.append(('+', x, prev_y))
+      else:
+        script.append(('-', prev_x, y))
+    x = prev_x
+    y = prev_y
+  script.reverse()
+
+  res = []
+  current = None
+  for kind, x, y in script:
+    if kind == '=':
+      if current is not None:
+        res.append((current[0], current[1], ''.join(current[2])))
+        current = None
+      continue
+    if current is None:
+      current = [x, x, []]
+    if kind == '-':
+      current[1] = x + 1
+    else:
+      current[2].append(b[y])
+  if current is not None:
+    res.append((current[0], current[1], ''.join(current[2])))
+  return res
+
+
+def _merge_short_gaps(old, edits):
+  """Merges edits separated by less unchanged text than they change.
+
+  A single character in common often splits a replacement of one word by
+  another in several edits. Those are not worth an operation each.
+  """
+  res = []
+  for start, end, text in edits:
+    if res:
+      last_start, last_end, last_text = res[-1]
+      gap = start - last_end
+      if (gap <= max(last_end - last_start, len(last_text)) and
+          gap <= max(end - start, len(text))):
+        res[-1] = (last_start, end, last_text + old[last_end:start] + text)
+        continue
+    res.append((start, end, text))
+  return res
+
+
+def diff(old, new, max_cost=MAX_DIFF_COST):
+  """Returns the edits that turn old into new.
+
+  Args:
+    old: the original text.
+    new: the text to end up with.
+    max_cost: above this many changed characters, the part between the
+        common prefix and suffix is replaced as a whole.
+  Returns:
+    A list of (start, end, text) tuples, meaning replace old[start:end]
+    with text, sorted on start and not touching each other. Positions are
+    all relative to old, so applying them from last to first works. Edits
+    separated by only a few unchanged characters are combined.
+  """
+  if old == new:
+    return []
+  prefix = _common_prefix(old, new)
+  suffix = _common_suffix(old, new, min(len(old), len(new)) - prefix)
+  a = old[prefix:len(old) - suffix]
+  b = new[prefix:len(new) - suffix]
+  if not a or not b:
+    return [(prefix, prefix + len(a), b)]
+  trace = _shortest_edit(a, b, max_cost)
+  if trace is None:
+    return [(prefix, prefix + len(a), b)]
+  return _merge_short_gaps(old, [(prefix + start, prefix + end, text)
+                                 for start, end, text
+                                 in _edits_from_trace(a, b, trace)])
@@ -0,0 +1,68 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the textdiff module."""
+
+
+import random
+import unittest
+
+import textdiff
+
+
+def apply_edits(text, edits):
+  for start, end, replacement in reversed(edits):
+    text = text[:start] + replacement + text[end:]
+  return text
+
+
+class TestDiff(unittest.TestCase):
+  """Tests for textdiff.diff."""
+
+  def testSimpleEdits(self):
+    self.assertEquals([], textdiff.diff('same', 'same'))
+    self.assertEquals([(6, 6, 'there ')],
+                      textdiff.diff('hello world', 'hello there world'))
+    self.assertEquals([(0, 6, '')], textdiff.diff('hello world', 'world'))
+    self.assertEquals([(6, 11, 'there')],
+                      textdiff.diff('hello world', 'hello there'))
+    self.assertEquals([(0, 0, 'abc')], textdiff.diff('', 'abc'))
+
+  def testSeparateEdits(self):
+    edits = textdiff.diff('the quick brown fox', 'the quick red fox!')
+    self.assertEquals('the quick red fox!',
+                      apply_edits('the quick brown fox', edits))
+    self.assertEquals((19, 19, '!'), edits[-1])
+    self.assertTrue(edits[0][0] >= len('the quick '))
+
+  def testGivesUpAboveMaxCost(self):
+    self.assertEquals([(1, 4, 'xyz')], textdiff.diff('abcde', 'axyze',
+                                                     max_cost=2))
+
+  def testRandomRoundTrip(self):
+    generator = random.Random(11)
+    for i in range(200):
+      old = ''.join([generator.choice('abc') for j in range(20)])
+      new = ''.join([generator.choice('abc') for j in range(20)])
+      edits = textdiff.diff(old, new)
+      self.assertEquals(new, apply_edits(old, edits))
+      for (start, end, text), (next_start, next_end, next_text) in zip(
+          edits, edits[1:]):
+        self.assertTrue(end < next_start)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -16,6 +16,9 @@
 
 """Utility library containing various helpers used by the API."""
 
+import re
+
+import simplejson
 
 CUSTOM_SERIALIZE_METHOD_NAME = 'serialize'
 
@@ -74,6 +77,12 @@ def upper_camel_case(s):
   return ''.join(fragment.capitalize() for fragment in s.split('_'))
 
 
+# Cache of key names that went through lower_camel_case already. The set
+# of attribute and parameter names used on the wire is small and fixed, so
+# this never grows beyond a few hundred entries.
+_lower_camel_case_cache = {}
+
+
 def default_keywriter(key_name):
   """This key writer rewrites keys as lower camel case.
 
@@ -85,14 +94,111 @@ def default_keywriter(key_name):
   Returns:
     Key name in lower camel-cased form.
   """
-  return lower_camel_case(key_name)
+  try:
+    return _lower_camel_case_cache[key_name]
+  except KeyError:
+    res = lower_camel_case(key_name)
+    _lower_camel_case_cache[key_name] = res
+    return res
+
+
+# Serializers registered explicitly through register_serializer, keyed
+# on the class they were registered for.
+_registered_serializers = {}
+
+# Compiled serializers keyed on the exact type of the instance. Filled
+# lazily by _serializer_for.
+_compiled_serializers = {}
+
+
+def register_serializer(cls, serializer):
+  """Registers a serializer for instances of cls and its subclasses.
+
+  Registered serializers take precedence over a custom serialize method
+  and over serializing public attributes.
+
+  Args:
+    cls: The class to register the serializer for.
+    serializer: A function taking the instance and returning its
+        serialized form.
+  """
+  _registered_serializers[cls] = serializer
+  _compiled_serializers.clear()
+
+
+def _class_fields(cls):
+  """Returns the names of the public, non callable class level attributes.
+
+  These are things like properties and slots that dir() would report for
+  every instance. Instance attributes are picked up from __dict__ at
+  serialization time.
+  """
+  return tuple([attr_name for attr_name in dir(cls)
+                if not attr_name.startswith('_') and
+                not callable(getattr(cls, attr_name, None))])
+
+
+def _compile_attribute_serializer(cls):
+  """Returns a function that serializes the public attributes of cls."""
+  class_fields = _class_fields(cls)
+
+  def serialize_attributes(obj, key_writer=default_keywriter):
+    data = {}
+    names = getattr(obj, '__dict__', None)
+    if names:
+      names = [name for name in names
+               if not name.startswith('_') and name not in class_fields]
+      names.extend(class_fields)
+    else:
+      names = class_fields
+    for attr_name in names:
+      attr = getattr(obj, attr_name, None)
+      if attr is None or callable(attr):
+        continue
+      data[key_writer(attr_name)] = serialize(attr)
+    return data
+  return serialize_attributes
+
+
+def _compile_serializer(cls):
+  """Compiles a serializer for instances of exactly type cls."""
+  for base in cls.__mro__:
+    if base in _registered_serializers:
+      registered = _registered_serializers[base]
+      return lambda obj, key_writer: registered(obj)
+  if cls.__module__ == '__builtin__':
+    if hasattr(cls, 'iteritems'):
+      return _serialize_dict
+    elif hasattr(cls, '__iter__'):
+      return _serialize_list
+    return lambda obj, key_writer: obj
+  serialize_attributes = _compile_attribute_serializer(cls)
+  method = getattr(cls, CUSTOM_SERIALIZE_METHOD_NAME, None)
+  if callable(method):
+    def serialize_custom(obj, key_writer):
+      if obj:
+        return obj.serialize()
+      return serialize_attributes(obj, key_writer)
+    return serialize_custom
+  return serialize_attributes
+
+
+def _serializer_for(cls):
+  """Returns the compiled serializer for cls, compiling it if needed."""
+  try:
+    return _compiled_serializers[cls]
+  except KeyError:
+    serializer = _compile_serializer(cls)
+    _compiled_serializers[cls] = serializer
+    return serializer
 
 
 def _serialize_attributes(obj, key_writer=default_keywriter):
   """Serializes attributes of an instance.
 
   Iterates all attributes of an object and invokes serialize if they are
-  public and not callable.
+  public and not callable. The list of class level attributes is computed
+  once per class.
 
   Args:
     obj: The instance to serialize.
@@ -105,19 +211,16 @@ def _serialize_attributes(obj, key_writer=default_keywriter):
   Returns:
     The serialized object.
   """
-  data = {}
-  for attr_name in dir(obj):
-    if attr_name.startswith('_'):
-      continue
-    attr = getattr(obj, attr_name)
-    if attr is None or callable(attr):
-      continue
-    # Looks okay, serialize it.
-    data[key_writer(attr_name)] = serialize(attr)
-  return data
+  cls = type(obj)
+  try:
+    serializer = _compiled_serializers[('attributes', cls)]
+  except KeyError:
+    serializer = _compile_attribute_serializer(cls)
+    _compiled_serializers[('attributes', cls)] = serializer
+  return serializer(obj, key_writer)
 
 
-def _serialize_list(l, key_writer):
+def _serialize_list(l, key_writer=default_keywriter):
   """Invokes serialize on all of its elements.
 
   Args:
@@ -149,11 +252,14 @@ def _serialize_dict(d, key_writer=default_keywriter):
 def serialize(obj, key_writer=default_keywriter):
   """Serializes any instance.
 
-  If this is a user-defined instance
+  If a serializer was registered for the type of the instance (or one of
+  its base classes) that is used. If this is a user-defined instance
   type, it will first check for a custom Serialize() function and use that
   if it exists. Otherwise, it will invoke serialize all of its public
   attributes. Lists and dicts are serialized trivially.
 
+  The decision which of these applies is made once per type and cached.
+
   Args:
     obj: The instance to serialize.
     key_writer: Optional key writer function.
@@ -161,17 +267,11 @@ def serialize(obj, key_writer=default_keywriter):
   Returns:
     The serialized object.
   """
-  if is_user_defined_new_style_class(obj):
-    if obj and hasattr(obj, CUSTOM_SERIALIZE_METHOD_NAME):
-      method = getattr(obj, CUSTOM_SERIALIZE_METHOD_NAME)
-      if callable(method):
-        return method()
-    return _serialize_attributes(obj, key_writer)
-  elif is_dict(obj):
-    return _serialize_dict(obj, key_writer)
-  elif is_iterable(obj):
-    return _serialize_list(obj, key_writer)
-  return obj
+  try:
+    serializer = _compiled_serializers[type(obj)]
+  except KeyError:
+    serializer = _serializer_for(type(obj))
+  return serializer(obj, key_writer)
 
 
 class StringEnum(object):
@@ -183,3 +283,160 @@ class StringEnum(object):
   def __init__(self, *values):
     for name in values:
       setattr(self, name, name)
+
+
+class Interner(object):
+  """Shares equal values between the objects decoded from one bundle.
+
+  Ids such as wave and wavelet ids are repeated in every blip of a bundle.
+  Passing them through intern() makes all of them refer to one string.
+  """
+
+  __slots__ = ('_values', '_properties')
+
+  def __init__(self):
+    self._values = {}
+    self._properties = {}
+
+  def intern(self, value):
+    """Returns the shared instance of value."""
+    if value is None:
+      return None
+    return self._values.setdefault(value, value)
+
+  def intern_all(self, values):
+    """Returns a list with the shared instances of values."""
+    return [self.intern(value) for value in values]
+
+  def share_properties(self, element_type, properties):
+    """Returns a shared dictionary equal to properties.
+
+    Returns:
+      The dictionary, or None if properties contains unhashable values. The
+      caller should not modify the returned dictionary.
+    """
+    try:
+      key = (element_type, frozenset(properties.items()))
+      return self._properties.setdefault(key, properties)
+    except TypeError:
+      return None
+
+
+class _NullInterner(Interner):
+  """An Interner that does not share anything."""
+
+  __slots__ = ()
+
+  def intern(self, value):
+    return value
+
+  def share_properties(self, element_type, properties):
+    return None
+
+
+# Used where no interner for a bundle is available.
+NULL_INTERNER = _NullInterner()
+
+
+# A JSON string, or one of the characters that matter for the structure.
+# Numbers and literals are skipped over as they cannot contain those.
+_JSON_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\],:]')
+
+_JSON_WHITESPACE = ' \t\n\r'
+
+
+def _strip_span(text, start, end):
+  while start < end and text[start] in _JSON_WHITESPACE:
+    start += 1
+  while end > start and text[end - 1] in _JSON_WHITESPACE:
+    end -= 1
+  return start, end
+
+
+def json_member_spans(text, start=0):
+  """Finds where the members of a JSON object are, without decoding them.
+
+  Args:
+    text: JSON text.
+    start: the position of the object in text.
+  Returns:
+    A dictionary from member name to the (start, end) of its value in text.
+  Raises:
+    ValueError: if text does not have an object at start.
+  """
+  res = {}
+  depth = 0
+  key = None
+  value_start = None
+  for match in _JSON_TOKEN.finditer(text, start):
+    token = match.group()
+    if token == '{' or token == '[':
+      if not depth and token != '{':
+        raise ValueError('No JSON object at %d' % start)
+      depth += 1
+    elif token == '}' or token == ']':
+      depth -= 1
+      if not depth:
+        if key is not None:
+          res[key] = _strip_span(text, value_start, match.start())
+        return res
+    elif depth == 1:
+      if token == ':':
+        value_start = match.end()
+      elif token == ',':
+        res[key] = _strip_span(text, value_start, match.start())
+        key = None
+      elif key is None:
+        key = simplejson.loads(token)
+    elif not depth:
+      raise ValueError('No JSON object at %d' % start)
+  raise ValueError('Unterminated JSON object at %d' % start)
+
+
+class RawJson(object):
+  """A slice of a JSON body that is decoded each time it is asked for.
+
+  Model objects can hold on to this instead of the decoded data. The body
+  is kept as a single string, which takes a lot less memory than the
+  dictionaries and lists it decodes to.
+  """
+
+  __slots__ = ('_text', '_start', '_end')
+
+  def __init__(self, text, start=0, end=None):
+    if end is None:
+      end = len(text)
+    self._text = text
+    self._start = start
+    self._end = end
+
+  def text(self):
+    """Returns the JSON text of the slice."""
+    return self._text[self._start:self._end]
+
+  def decode(self):
+    """Returns a newly decoded copy of the data."""
+    return simplejson.loads(self.text())
+
+  def member(self, name):
+    """Returns a RawJson for a member of this object, or None if absent."""
+    span = json_member_spans(self._text, self._start).get(name)
+    if span is None:
+      return None
+    return RawJson(self._text, span[0], span[1])
+
+  def members(self):
+    """Returns a dictionary from member name to RawJson of its value."""
+    return dict((name, RawJson(self._text, start, end)) for name, (start, end)
+                in json_member_spans(self._text, self._start).items())
+
+
+def decode_raw(raw):
+  """Returns the data of raw json kept by a model object.
+
+  Args:
+    raw: decoded data, a RawJson or None if it was dropped.
+  """
+  if isinstance(raw, RawJson):
+    return raw.decode()
+  return raw
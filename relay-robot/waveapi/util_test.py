@@ -105,6 +105,11 @@ class TestUtils(unittest.TestCase):
     output = util.serialize(data)
     self.assertDictsEqual(data, output)
 
+  def testKeyWriterOnlyAppliesAtTopLevel(self):
+    data = {'outer_key': {'inner_key': [{'list_key': 1}]}}
+    output = util.serialize(data, lambda key: key.upper())
+    self.assertEquals({'OUTER_KEY': {'innerKey': [{'listKey': 1}]}}, output)
+
   def testSerializeAttributes(self):
 
     class Data(object):
@@ -122,6 +127,70 @@ class TestUtils(unittest.TestCase):
     self.assertEquals(1, len(output.keys()))
     self.assertEquals(data.public, output['public'])
 
+  def testSerializeProperties(self):
+
+    class Data(object):
+      __slots__ = ('slot_value', '_hidden')
+
+      def __init__(self):
+        self.slot_value = 1
+        self._hidden = 2
+
+      @property
+      def computed_value(self):
+        return 3
+
+    output = util.serialize(Data())
+    self.assertEquals(2, len(output.keys()))
+    self.assertEquals(1, output['slotValue'])
+    self.assertEquals(3, output['computedValue'])
+
+  def testRegisterSerializer(self):
+
+    class Base(object):
+      def serialize(self):
+        return 'method'
+
+    class Derived(Base):
+      pass
+
+    self.assertEquals('method', util.serialize(Derived()))
+    util.register_serializer(Base, lambda obj: 'registered')
+    self.assertEquals('registered', util.serialize(Derived()))
+    self.assertEquals(['registered'], util.serialize([Base()]))
+
+  def testDefaultKeywriterCached(self):
+    self.assertEquals('fooBarBaz', util.default_keywriter('foo_bar_baz'))
+    self.assertEquals('fooBarBaz', util.default_keywriter('foo_bar_baz'))
+
+  def testInterner(self):
+    interner = util.Interner()
+    first = interner.intern(''.join(['wave', '!', 'id']))
+    self.assertTrue(first is interner.intern(''.join(['wave', '!', 'id'])))
+    self.assertEquals(None, interner.intern(None))
+    props = {'url': 'http://test.com/gadget.xml'}
+    self.assertTrue(props is interner.share_properties('GADGET', props))
+    self.assertTrue(props is interner.share_properties('GADGET', dict(props)))
+    self.assertEquals(None, interner.share_properties('GADGET', {'l': []}))
+    self.assertEquals(None, util.NULL_INTERNER.share_properties('GADGET',
+                                                                props))
+
+  def testRawJson(self):
+    text = ' {"a": [1, {"b": "}"}], "c" : "q\\"" ,"d":{"e": 2}} '
+    spans = util.json_member_spans(text, 1)
+    self.assertEquals('[1, {"b": "}"}]', text[spans['a'][0]:spans['a'][1]])
+    self.assertEquals('"q\\""', text[spans['c'][0]:spans['c'][1]])
+    self.assertEquals('{"e": 2}', text[spans['d'][0]:spans['d'][1]])
+    self.assertRaises(ValueError, util.json_member_spans, '[1, 2]')
+    raw = util.RawJson(text)
+    self.assertEquals(['a', 'c', 'd'], sorted(raw.members()))
+    self.assertEquals('q"', raw.member('c').decode())
+    self.assertEquals(2, raw.member('d').member('e').decode())
+    self.assertEquals(None, raw.member('e'))
+    self.assertEquals(raw.decode(), util.decode_raw(raw))
+    self.assertEquals({}, util.decode_raw({}))
+    self.assertEquals(None, util.decode_raw(None))
+
   def testStringEnum(self):
     empty = util.StringEnum()
     single = util.StringEnum('foo')
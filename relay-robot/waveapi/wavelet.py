@@ -25,6 +25,11 @@ camel-cased characters to match the wire protocol format.
 
 import logging
 import blip
+import conversation
+import snapshot
+import util
+
+import simplejson
 
 ROOT_WAVELET_ID_SUFFIX = '!conv+root'
 
@@ -99,17 +104,33 @@ class Wavelet(object):
     blips: the blips in this wavelet
   """
 
-  def __init__(self, json, blips, robot, operation_queue):
+  __slots__ = ('_robot', '_operation_queue', '_wave_id', '_wavelet_id',
+               '_creator', '_creation_time', '_data_documents',
+               '_last_modified_time', '_participants', '_title', '_raw_data',
+               '_blips', '_other_wavelet_blips', '_root_blip_id', '_root_blip',
+               '_robot_address')
+
+  def __init__(self, json, blips, robot, operation_queue,
+               other_wavelet_blips=None, interner=None):
     """Inits this wavelet with JSON data.
 
     Args:
       json: JSON data dictionary from Wave server.
+      blips: the blips of this wavelet, a dictionary or blip.Blips.
+      robot: the robot this wavelet belongs to.
+      operation_queue: the queue to add operations to.
+      other_wavelet_blips: optional dictionary from (wave id, wavelet id)
+          to the blip.Blips of other wavelets that came with this one.
+      interner: optional util.Interner shared with the blips, used to share
+          the id strings.
     """
+    if interner is None:
+      interner = util.NULL_INTERNER
     self._robot = robot
     self._operation_queue = operation_queue
-    self._wave_id = json.get('waveId')
-    self._wavelet_id = json.get('waveletId')
-    self._creator = json.get('creator')
+    self._wave_id = interner.intern(json.get('waveId'))
+    self._wavelet_id = interner.intern(json.get('waveletId'))
+    self._creator = interner.intern(json.get('creator'))
     self._creation_time = json.get('creationTime', 0)
     self._data_documents = DataDocs(json.get('dataDocuments', {}),
                                     self._wave_id,
@@ -122,14 +143,29 @@ class Wavelet(object):
                                       operation_queue)
     self._title = json.get('title', '')
     self._raw_data = json
-    self._blips = blip.Blips(blips)
-    self._root_blip_id = json.get('rootBlipId')
+    if isinstance(blips, blip.Blips):
+      self._blips = blips
+    else:
+      self._blips = blip.Blips(blips)
+    if other_wavelet_blips is None:
+      other_wavelet_blips = {}
+    self._other_wavelet_blips = other_wavelet_blips
+    self._root_blip_id = interner.intern(json.get('rootBlipId'))
     if self._root_blip_id and self._root_blip_id in self._blips:
       self._root_blip = self._blips[self._root_blip_id]
     else:
       self._root_blip = None
     self._robot_address = None
 
+  def _retain_raw_data(self, raw):
+    """Replaces the raw json, by a util.RawJson or None to drop it."""
+    self._raw_data = raw
+
+  @property
+  def raw_data(self):
+    """Returns the json this wavelet was built from, or None if dropped."""
+    return util.decode_raw(self._raw_data)
+
   @property
   def wavelet_id(self):
     """Returns this wavelet's id."""
@@ -211,11 +247,44 @@ class Wavelet(object):
     """Returns the blips for this wavelet."""
     return self._blips
 
+  @property
+  def conversation(self):
+    """Returns the conversation.Conversation index of this wavelet's blips.
+
+    The index is built on first use, which constructs all blips, and is
+    kept up to date by reply, insert_inline_blip and delete.
+    """
+    if self._blips._conversation is None:
+      self._blips._conversation = conversation.Conversation(
+          self._blips, self._root_blip_id)
+    return self._blips._conversation
+
+  def get_blips(self, wave_id, wavelet_id):
+    """Returns the blips sent along for the specified wavelet.
+
+    Events can carry blips of other wavelets than the one they are about.
+    Those are only turned into Blip instances when looked up.
+
+    Returns:
+      A blip.Blips or None if no blips of that wavelet are known.
+    """
+    if wave_id == self._wave_id and wavelet_id == self._wavelet_id:
+      return self._blips
+    return self._other_wavelet_blips.get((wave_id, wavelet_id))
+
+  def blips_with_element(self, clz, **restrictions):
+    """Returns the blips of this wavelet that contain a matching element.
+
+    For example wavelet.blips_with_element(element.Gadget, url=url) returns
+    the blips with that gadget.
+    """
+    return self._blips.with_element(clz, **restrictions)
+
   def get_operation_queue(self):
     return self._operation_queue
 
-  def serialize(self):
-    """Return a dictionary representation of the wavelet ready for json."""
+  def _serialize_fields(self):
+    """Returns the serialized wavelet without the blips."""
     return {'waveId': self._wave_id,
             'waveletId': self._wavelet_id,
             'creator': self._creator,
@@ -224,10 +293,39 @@ class Wavelet(object):
             'lastModifiedTime': self._last_modified_time,
             'participants': self._participants.serialize(),
             'title': self._title,
-            'blips': self._blips.serialize(),
             'rootBlipId': self._root_blip_id
            }
 
+  def serialize(self):
+    """Return a dictionary representation of the wavelet ready for json.
+
+    Blips that were not modified since they were last serialized return
+    the same dictionary again, which should not be changed.
+    """
+    res = self._serialize_fields()
+    res['blips'] = self._blips.serialize()
+    return res
+
+  def to_json(self):
+    """Returns serialize() encoded as json.
+
+    Only the wavelet fields are encoded anew, the blips reuse their cached
+    json.
+    """
+    fields = simplejson.dumps(self._serialize_fields())
+    return '%s, "blips": %s}' % (fields[:-1], self._blips.to_json())
+
+  def to_bytes(self, compress=False):
+    """Returns a binary snapshot of this wavelet.
+
+    Robot.wavelet_from_bytes restores it without decoding any json, blips
+    are only decoded when they are first looked up.
+
+    Args:
+      compress: whether to compress the snapshot.
+    """
+    return snapshot.dumps(self, compress)
+
   def proxy_for(self, proxy_for_id):
     """Return a view on this wavelet that will proxy for the specified id.
 
@@ -252,6 +350,7 @@ class Wavelet(object):
     res._title = self._title
     res._raw_data = self._raw_data
     res._blips = self._blips
+    res._other_wavelet_blips = self._other_wavelet_blips
     res._root_blip = self._root_blip
     return res
 
@@ -21,6 +21,7 @@
 import unittest
 
 import blip
+import element
 import ops
 import wavelet
 
@@ -91,5 +92,26 @@ class TestWavelet(unittest.TestCase):
     self.wavelet.data_documents['key'] = None
     self.assertEquals(0, len(self.wavelet.data_documents))
 
+  def testBlipsWithElement(self):
+    url = 'http://test.com/gadget.xml'
+    reply = self.wavelet.reply()
+    reply.append(element.Gadget(url))
+    self.assertEquals([reply],
+                      self.wavelet.blips_with_element(element.Gadget, url=url))
+    self.assertEquals([], self.wavelet.blips_with_element(element.Image))
+
+  def testConversation(self):
+    conversation = self.wavelet.conversation
+    self.assertEquals([self.blip], conversation.roots())
+    reply = self.wavelet.reply()
+    nested = reply.reply()
+    self.assertEquals([self.blip, reply], conversation.roots())
+    self.assertEquals([nested], conversation.children(reply))
+    self.assertEquals(1, conversation.depth(nested))
+    self.assertEquals([self.blip, reply, nested],
+                      list(conversation.depth_first()))
+    self.wavelet.delete(reply)
+    self.assertEquals([self.blip, nested], conversation.roots())
+
 if __name__ == '__main__':
   unittest.main()